@@ -0,0 +1,416 @@
+import itertools
+import os
+import select
+import shlex
+import socket
+import stat
+import struct
+import threading
+import time
+
+
+class AdbError(Exception):
+    pass
+
+
+class AdbCommandLost(AdbError):
+    # the command was sent but its result never came: it may have run, so it is not run again
+    pass
+
+
+def wrap_command(command):
+    # a subshell, so exit, cd or set -e stay in the command; it must not read the
+    # shell's stdin: in a session that is the protocol stream
+    return '( ' + command + '\n) </dev/null 2>&1'
+
+
+def server_address():
+    # the same variables the adb binary reads
+    host = os.environ.get("ANDROID_ADB_SERVER_ADDRESS", "127.0.0.1")
+    port = int(os.environ.get("ANDROID_ADB_SERVER_PORT", "5037"))
+    return host, port
+
+
+def shell_command(*args):
+    return " ".join(shlex.quote(str(arg)) for arg in args)
+
+
+class ShellCommand(object):
+    # a command of a ShellBatch, status and output are set once the batch ran
+
+    __slots__ = ("command", "status", "output")
+
+    def __init__(self, command):
+        self.command = command
+        self.status = None
+        self.output = None
+
+
+class ShellBatch(object):
+    """
+    Shell commands run as one shell invocation: each command is followed by
+    a marker line with its index and exit status, which splits the output
+    back into the commands.
+    """
+
+    MARKER = "__regdroid_batch__"
+
+    def __init__(self):
+        self.commands = []
+        # commands before this index have run
+        self.done = 0
+
+    def add(self, command):
+        shell = ShellCommand(command)
+        self.commands.append(shell)
+        return shell
+
+    def pending(self):
+        return len(self.commands) > self.done
+
+    def script(self):
+        return "\n".join(
+            f'{wrap_command(shell.command)}; echo "{self.MARKER} {index} $?"'
+            for index, shell in enumerate(self.commands[self.done:], self.done)
+        )
+
+    def read(self, status, output):
+        """
+        Give the commands their status and output from those of the script.
+        Commands without a marker (the shell died) get the script's status.
+        """
+        lines = []
+        for line in output.splitlines(True):
+            # the marker ends the line, after any output without a newline
+            start = line.find(self.MARKER + " ")
+            if start < 0:
+                lines.append(line)
+                continue
+            try:
+                index, command_status = line[start:].split()[1:3]
+                shell = self.commands[int(index)]
+                shell.status = int(command_status)
+            except (ValueError, IndexError):
+                lines.append(line)
+                continue
+            shell.output = "".join(lines) + line[:start]
+            lines = []
+        for shell in self.commands[self.done:]:
+            if shell.status is None:
+                shell.status = status if status else 255
+                shell.output = "".join(lines)
+        self.done = len(self.commands)
+
+
+class AdbConnection(object):
+    """
+    One socket to the adb server, speaking its smart-socket protocol:
+    a request is 4 hex digits of length and the request, the answer
+    OKAY or FAIL with a length-prefixed message.
+    """
+
+    def __init__(self, address, timeout=None):
+        self.sock = socket.create_connection(address, timeout)
+
+    def send_request(self, request):
+        data = request.encode('utf-8')
+        self.sock.sendall(b'%04x' % len(data) + data)
+        self.check_status()
+
+    def check_status(self):
+        status = self.read_exactly(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbError(self.read_string())
+        raise AdbError(f"Unexpected adb server reply {status!r}")
+
+    def read_string(self):
+        length = int(self.read_exactly(4), 16)
+        return self.read_exactly(length).decode('utf-8', 'replace')
+
+    def read_exactly(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise AdbError("adb server closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read_all(self):
+        chunks = []
+        while True:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ShellSession(object):
+    """
+    A shell kept open on a device: commands are written to its stdin with
+    shell protocol v2 frames ([id][length][data]) and their end is found by
+    a marker line echoing the exit status.
+    """
+
+    STDIN, STDOUT, STDERR, EXIT = 0, 1, 2, 3
+
+    def __init__(self, device):
+        self.device = device
+        self.markers = itertools.count()
+        self.connection = device.transport()
+        self.connection.send_request("shell,v2,raw:")
+
+    def send(self, data):
+        self.connection.sock.sendall(struct.pack('<BI', self.STDIN, len(data)) + data)
+
+    def read_frame(self):
+        kind, length = struct.unpack('<BI', self.connection.read_exactly(5))
+        return kind, self.connection.read_exactly(length)
+
+    def alive(self):
+        # an idle session has nothing to read: readable means closed by the device (or out of step)
+        try:
+            readable, _, _ = select.select([self.connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def run(self, command, timeout):
+        """
+        Run command, at most timeout seconds for its result. AdbError when
+        it could not be sent, AdbCommandLost when it was sent but did not end.
+        """
+        marker = f"__regdroid_{next(self.markers)}__".encode('utf-8')
+        try:
+            self.send(wrap_command(command).encode('utf-8') + b'; echo "' + marker + b' $?"\n')
+        except OSError as e:
+            raise AdbError(f"Cannot send to the shell of {self.device.serial}: {e}")
+        self.connection.sock.settimeout(timeout)
+        output = b''
+        try:
+            while True:
+                kind, data = self.read_frame()
+                if kind == self.EXIT:
+                    raise AdbCommandLost(f"Shell of {self.device.serial} exited")
+                output += data
+                end = output.find(marker + b' ')
+                if end >= 0 and output.endswith(b'\n'):
+                    status = output[end + len(marker):].strip()
+                    return int(status or 0), output[:end].decode('utf-8', 'replace')
+        except AdbCommandLost:
+            raise
+        except (AdbError, OSError) as e:
+            # socket.timeout is an OSError
+            raise AdbCommandLost(f"No result of {command!r} on {self.device.serial}: {e}")
+
+    def close(self):
+        self.connection.close()
+
+
+class AdbDevice(object):
+    """
+    The commands of one device, run through the adb server without an adb
+    process. Shell commands share one persistent shell session; devices
+    without shell protocol v2 get one shell connection per command.
+    """
+
+    SYNC_CHUNK = 64 * 1024
+    # pm install of a large APK answers only once it is done
+    INSTALL_TIMEOUT = 600
+
+    def __init__(self, client, serial):
+        self.client = client
+        self.serial = serial
+        self.lock = threading.Lock()
+        self.session = None
+        self.shell_v2 = True
+
+    def transport(self):
+        connection = self.client.connect()
+        try:
+            connection.send_request(f"host:transport:{self.serial}")
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def get_state(self):
+        return self.client.host(f"host-serial:{self.serial}:get-state")
+
+    def wait_for_device(self, timeout=60, interval=1):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if self.get_state() == "device":
+                    return True
+            except (AdbError, OSError):
+                pass
+            time.sleep(interval)
+        return False
+
+    def shell(self, *args, timeout=None):
+        return self.run(shell_command(*args), timeout)
+
+    def run(self, command, timeout=None):
+        """
+        Run a command line in the device shell, returns (exit status, output
+        with stderr). timeout (default the client's) bounds the wait for the
+        result. A session that broke since the last command (the device
+        restarted) is opened again; a command that was sent is never run
+        again: it raises AdbCommandLost when its result does not come.
+        """
+        if timeout is None:
+            timeout = self.client.timeout
+        with self.lock:
+            if self.session is not None and not self.session.alive():
+                self.close()
+            while self.shell_v2:
+                fresh = self.session is None
+                try:
+                    if fresh:
+                        self.session = ShellSession(self)
+                    return self.session.run(command, timeout)
+                except AdbCommandLost:
+                    # the session is out of step with the marker
+                    self.close()
+                    raise
+                except AdbError as e:
+                    self.close()
+                    if fresh and ("shell,v2" in str(e) or "unknown" in str(e).lower()):
+                        # old adbd
+                        self.shell_v2 = False
+                    elif fresh:
+                        raise
+                except OSError:
+                    self.close()
+                    if fresh:
+                        raise
+            return self.shell_once(command, timeout)
+
+    def shell_once(self, command, timeout):
+        connection = self.transport()
+        try:
+            connection.send_request(f"shell:{wrap_command(command)}; echo __regdroid__ $?")
+            connection.sock.settimeout(timeout)
+            try:
+                output = connection.read_all()
+            except OSError as e:
+                raise AdbCommandLost(f"No result of {command!r} on {self.serial}: {e}")
+            output = output.decode('utf-8', 'replace').replace('\r\n', '\n')
+        finally:
+            connection.close()
+        end = output.rfind("__regdroid__ ")
+        if end < 0:
+            return 255, output
+        return int(output[end + len("__regdroid__ "):].strip() or 0), output[:end]
+
+    def install(self, apk, grant_all=False, timeout=INSTALL_TIMEOUT):
+        """
+        Streamed install (adb install without the adb process), returns the
+        output of pm. AdbCommandLost when the APK was sent but pm did not
+        answer within timeout seconds: it may still be installing.
+        """
+        size = os.path.getsize(apk)
+        options = "-g " if grant_all else ""
+        connection = self.transport()
+        try:
+            connection.sock.settimeout(timeout)
+            connection.send_request(f"exec:cmd package 'install' {options}-S {size}")
+            with open(apk, 'rb') as f:
+                while True:
+                    chunk = f.read(self.SYNC_CHUNK)
+                    if not chunk:
+                        break
+                    connection.sock.sendall(chunk)
+            try:
+                output = connection.read_all().decode('utf-8', 'replace').strip()
+            except OSError as e:
+                raise AdbCommandLost(f"No result of the install of {apk} on {self.serial}: {e}")
+        finally:
+            connection.close()
+        if not output.startswith("Success"):
+            raise AdbError(f"Install of {apk} on {self.serial} failed: {output}")
+        return output
+
+    def push(self, local, remote, mode=0o644):
+        # adb push over the sync protocol, into remote when it is a directory
+        connection = self.transport()
+        try:
+            connection.send_request("sync:")
+            remote_mode = self.sync_stat(connection, remote)
+            if stat.S_ISDIR(remote_mode):
+                remote = remote.rstrip('/') + '/' + os.path.basename(local)
+            spec = f"{remote},{mode}".encode('utf-8')
+            connection.sock.sendall(b'SEND' + struct.pack('<I', len(spec)) + spec)
+            with open(local, 'rb') as f:
+                while True:
+                    chunk = f.read(self.SYNC_CHUNK)
+                    if not chunk:
+                        break
+                    connection.sock.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+            connection.sock.sendall(b'DONE' + struct.pack('<I', int(os.path.getmtime(local))))
+            status, length = struct.unpack('<4sI', connection.read_exactly(8))
+            if status != b'OKAY':
+                raise AdbError(connection.read_exactly(length).decode('utf-8', 'replace'))
+            connection.sock.sendall(b'QUIT' + struct.pack('<I', 0))
+        finally:
+            connection.close()
+
+    @staticmethod
+    def sync_stat(connection, path):
+        data = path.encode('utf-8')
+        connection.sock.sendall(b'STAT' + struct.pack('<I', len(data)) + data)
+        reply, mode, size, mtime = struct.unpack('<4sIII', connection.read_exactly(16))
+        if reply != b'STAT':
+            raise AdbError(f"Unexpected sync reply {reply!r}")
+        return mode
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class AdbClient(object):
+    """
+    Talks to the adb server socket (localhost:5037, or the address in
+    ANDROID_ADB_SERVER_ADDRESS / ANDROID_ADB_SERVER_PORT) directly, so a
+    command costs a request on a socket instead of starting an adb process.
+    """
+
+    def __init__(self, address=None, timeout=30):
+        self.address = address or server_address()
+        self.timeout = timeout
+        self.devices = {}
+
+    def connect(self):
+        try:
+            return AdbConnection(self.address, self.timeout)
+        except OSError as e:
+            raise AdbError(f"Cannot reach the adb server at {self.address[0]}:{self.address[1]}: {e}")
+
+    def host(self, request):
+        connection = self.connect()
+        try:
+            connection.send_request(request)
+            return connection.read_string()
+        finally:
+            connection.close()
+
+    def device(self, serial):
+        if serial not in self.devices:
+            self.devices[serial] = AdbDevice(self, serial)
+        return self.devices[serial]
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
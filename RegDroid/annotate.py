@@ -0,0 +1,145 @@
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+# BGR colour of the rectangle around the view of an event, by action
+VIEW_COLOURS = {
+    "click": (0, 0, 255),
+    "longclick": (0, 225, 255),
+    "edit": (225, 0, 255),
+}
+DEFAULT_VIEW_COLOUR = (225, 225, 255)
+
+# the annotations of a replay, for all its devices
+ANNOTATIONS_FILE = "annotations.jsonl"
+# and those of the devices of a run, annotations_{num}_{serial}.jsonl (devices may share a run directory)
+ANNOTATIONS_PATTERN = "annotations*.jsonl"
+
+
+def event_annotation(event):
+    """
+    How Utils.draw_event marks an event on a screenshot, as metadata
+    """
+    if event.view is not None:
+        return {
+            "action": event.action,
+            "shape": "rect",
+            "bounds": [int(event.view.xmin), int(event.view.ymin), int(event.view.xmax), int(event.view.ymax)],
+            "colour": VIEW_COLOURS.get(event.action, DEFAULT_VIEW_COLOUR),
+            "thickness": 5,
+        }
+    if event.action == "wrong":
+        return {
+            "action": event.action,
+            "shape": "rect",
+            "bounds": [0, 0, 1430, 2550],
+            "colour": (0, 225, 255),
+            "thickness": 20,
+        }
+    return {
+        "action": event.action,
+        "shape": "text",
+        "bounds": [100, 300],
+        "colour": (0, 0, 255),
+        "thickness": 1,
+    }
+
+
+def error_frame_annotation():
+    return {
+        "action": "error",
+        "shape": "rect",
+        "bounds": [1, 1, 1430, 2550],
+        "colour": (0, 0, 255),
+        "thickness": 20,
+    }
+
+
+def annotated_path(screenshot):
+    # screen/1.0_emulator-5554.png -> screen_annotated/1.0_emulator-5554.png
+    directory, name = os.path.split(os.path.normpath(screenshot))
+    return os.path.join(directory + "_annotated", name)
+
+
+def load_annotations(path):
+    """
+    {screenshot: [annotation, ...]} from the annotations file of a run,
+    in the order they were recorded
+    """
+    annotations = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                annotation = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run
+                continue
+            annotations.setdefault(annotation["screenshot"], []).append(annotation)
+    return annotations
+
+
+def render_screenshot(screenshot, annotations):
+    """
+    Draw the annotations on a copy of the screenshot, the raw one is not touched
+    """
+    import cv2
+    image = cv2.imread(screenshot)
+    if image is None:
+        return None
+    for annotation in annotations:
+        colour = tuple(annotation["colour"])
+        bounds = annotation["bounds"]
+        if annotation["shape"] == "rect":
+            cv2.rectangle(image, (bounds[0], bounds[1]), (bounds[2], bounds[3]), colour, annotation["thickness"])
+        else:
+            cv2.putText(image, annotation["action"], (bounds[0], bounds[1]),
+                        cv2.FONT_HERSHEY_SIMPLEX, 5, colour, annotation["thickness"], cv2.LINE_AA)
+    path = annotated_path(screenshot)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(path, image)
+    return path
+
+
+def render_annotations(run_paths, processes=None):
+    """
+    Render the annotations recorded in the given run directories in a
+    process pool. Returns how many screenshots were rendered.
+    """
+    annotations = {}
+    # devices sharing a run directory give it more than once
+    for run_path in sorted(set(run_paths)):
+        for path in sorted(glob.glob(os.path.join(run_path, ANNOTATIONS_PATTERN))):
+            for screenshot, recorded in load_annotations(path).items():
+                annotations.setdefault(screenshot, []).extend(recorded)
+    jobs = list(annotations.items())
+    if not jobs:
+        return 0
+    rendered = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(render_screenshot, screenshot, annotations) for screenshot, annotations in jobs]
+        for future in futures:
+            try:
+                if future.result() is not None:
+                    rendered += 1
+            except Exception as e:
+                print(f"Error rendering annotations: {e}")
+    return rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the event annotations of runs onto copies of their screenshots")
+    parser.add_argument("paths", nargs="+", help="run directories containing annotations*.jsonl")
+    parser.add_argument("-processes", action="store", dest="processes", type=int, default=None,
+                        help="size of the process pool, default one per core")
+    options = parser.parse_args()
+    print(f"Rendered {render_annotations(options.paths, options.processes)} screenshots")
+
+
+if __name__ == "__main__":
+    main()
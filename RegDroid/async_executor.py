@@ -0,0 +1,193 @@
+import asyncio
+import threading
+
+from event import Event
+from executor import Executor
+
+
+async def logcat_tail(device, path):
+    """
+    Follow the crash buffer of the device into path (what Device.log_crash
+    does with a shell redirection) until cancelled
+    """
+    process = await asyncio.create_subprocess_exec(
+        "adb", "-s", device.device_serial, "logcat", "-b", "crash",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                f.write(line)
+                f.flush()
+    finally:
+        if process.returncode is None:
+            process.kill()
+
+
+class AsyncExecutor(Executor):
+    """
+    Executor whose per-step device operations are coroutines on one event
+    loop: event dispatch, hierarchy dump, screenshot, logcat tail and the
+    other device jobs. Each fan-out is an asyncio.gather of one coroutine per
+    device, bounded by job_timeout.
+
+    The logcat tail is an asyncio subprocess. uiautomator2 and the Device
+    methods have no asynchronous api, so their calls run on the device's
+    DeviceWorker: one thread per device, and a device whose call timed out
+    holds only its own calls. Driver processes are not used (start.py
+    rejects -drivers with this engine).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncExecutor, self).__init__(*args, **kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="async-executor", daemon=True)
+        self.loop_thread.start()
+        # device serial -> logcat_tail task
+        self.logcat_tasks = {}
+
+    def run(self, coroutine):
+        # run a coroutine on the loop from the (synchronous) executor code
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def call(self, device, func, *args):
+        return await asyncio.wrap_future(device.get_worker().submit(func, *args))
+
+    async def with_deadline(self, device, coroutine):
+        try:
+            if self.job_timeout is None:
+                return await coroutine
+            return await asyncio.wait_for(coroutine, self.job_timeout)
+        except asyncio.TimeoutError:
+            print(f"Job of device {device.device_serial} timed out, cancelling it")
+            device.get_worker().cancel()
+        except Exception as e:
+            print(f"Error in job of device {device.device_serial}: {e}")
+        return None
+
+    async def gather(self, coroutines):
+        """
+        Run {device: coroutine} together, each within job_timeout.
+        Returns {device: result}, None for failed or timed out devices.
+        """
+        devices = list(coroutines)
+        results = await asyncio.gather(
+            *(self.with_deadline(device, coroutines[device]) for device in devices)
+        )
+        return dict(zip(devices, results))
+
+    async def timed(self, name, device, coroutine):
+        # a profiler span around a device coroutine
+        with self.profiler.span(name, device):
+            return await coroutine
+
+    async def dump_hierarchy(self, device):
+        return await self.call(device, device.use.dump_hierarchy)
+
+    async def screenshot(self, device):
+        return await self.call(device, device.use.screenshot, None, 'opencv')
+
+    async def dispatch(self, device, event):
+        return await self.timed("execute_event", device, self.call(device, self.execute_event, device, event, 0))
+
+    def job_coroutine(self, device, job):
+        # jobs may be wrapped by the profiler, dispatch on the function itself
+        func = getattr(job.func, '__wrapped__', job.func)
+        if func == self.execute_event:
+            return self.dispatch(device, job.args[1])
+        return self.call(device, job.func, *job.args)
+
+    def run_device_jobs(self):
+        jobs = {
+            device: device.thread
+            for device in self.devices
+            if getattr(device, 'thread', None) is not None and not device.thread.started()
+        }
+        results = self.run(self.gather({
+            device: self.job_coroutine(device, job) for device, job in jobs.items()
+        }))
+        for device, job in jobs.items():
+            job.set_result(results[device])
+
+    async def screenshot_and_getstate(self, device, path, event_count, xml=None):
+        # Device.screenshot_and_getstate with the device calls awaited, files go to the writer
+        device.screenshot_path = path + str(event_count) + '_' + device.device_serial + '.png'
+        image = await self.screenshot(device)
+        if xml is None:
+            xml = await self.dump_hierarchy(device)
+        device.save_image(device.screenshot_path, image)
+        device.save_text(path + str(event_count) + '_' + device.device_serial + '.xml', xml)
+        return xml
+
+    async def save_device_state(self, device, path, event_count, xml=None):
+        xml = await self.screenshot_and_getstate(device, path, event_count, xml)
+        capture = self.make_capture(device, xml)
+        device.capture = capture.with_screenshot(device.screenshot_path)
+        if capture.state is not device.state:
+            device.update_state(capture.state)
+        self.record_capture(device, event_count, path)
+
+    async def update_device_state(self, device, path, event_count):
+        xml = await self.dump_hierarchy(device)
+        capture = self.make_capture(device, xml)
+        if device.capture is not None and capture.state is device.capture.state:
+            device.update_state(device.state)
+            return
+        device.capture = capture
+        device.update_state(capture.state)
+        if device.last_state != device.state:
+            await self.save_device_state(device, path, event_count, xml)
+
+    def save_all_state(self, event_count):
+        # the settled dumps are the dumps of this step's captures
+        settled = self.run(self.gather({
+            device: self.timed("settle", device, self.call(device, self.settle.wait, device)) for device in self.devices
+        }))
+        base_device = self.devices[0]
+        self.run(self.gather({
+            base_device: self.timed("save_state", base_device, self.save_device_state(
+                base_device, f"{base_device.path}screen/", event_count, settled[base_device]
+            ))
+        }))
+        self.run(self.gather({
+            device: self.timed("save_state", device, self.save_device_state(
+                device, f"{device.path}screen/", event_count, settled[device]
+            ))
+            for device in self.guest_devices
+        }))
+        for device in self.guest_devices:
+            event = Event(None, "save_state", device, event_count)
+            event.set_count(device.device_num)
+            self.utils.write_event(event, device.device_num, device.f_trace)
+        return event_count + 1
+
+    def update_all_state(self, event_count):
+        event_count = event_count - 1
+        self.run(self.gather({
+            device: self.timed("update_state", device, self.update_device_state(device, f"{device.path}screen/", event_count))
+            for device in self.devices
+        }))
+
+    def log_crash(self, device, path):
+        def restart_tail():
+            task = self.logcat_tasks.pop(device.device_serial, None)
+            if task is not None:
+                task.cancel()
+            self.logcat_tasks[device.device_serial] = self.loop.create_task(logcat_tail(device, path))
+        self.loop.call_soon_threadsafe(restart_tail)
+
+    async def cancel_tails(self):
+        tasks = list(self.logcat_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        self.run(self.cancel_tails())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join(5)
+        super(AsyncExecutor, self).close()
@@ -0,0 +1,64 @@
+import argparse
+import os
+import time
+
+from state import State
+
+
+def load_dumps(paths):
+    dumps = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    if name.endswith(".xml"):
+                        dumps.append(os.path.join(root, name))
+        else:
+            dumps.append(path)
+    xmls = []
+    for dump in dumps:
+        with open(dump, 'r', encoding='utf-8') as f:
+            xmls.append(f.read())
+    return xmls
+
+
+def benchmark(xmls, parser, repeat):
+    start_time = time.time()
+    views = 0
+    for _ in range(repeat):
+        for xml in xmls:
+            views += len(State(xml, parser).all_views)
+    return time.time() - start_time, views
+
+
+def check_same(xmls):
+    # both parsers must build the same trees
+    for xml in xmls:
+        line_state = State(xml, "line")
+        expat_state = State(xml, "expat")
+        line_views = [(v.line, v.instance, v.hash) for v in line_state.all_views]
+        expat_views = [(v.line, v.instance, v.hash) for v in expat_state.all_views]
+        if line_views != expat_views:
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hierarchy parsers of State on saved xml dumps.")
+    parser.add_argument("paths", nargs="+", help="xml dumps or directories containing them (e.g. a screen/ folder)")
+    parser.add_argument("-repeat", action="store", dest="repeat", default=10, type=int,
+                        help="How many times each dump is parsed")
+    opts = parser.parse_args()
+
+    xmls = load_dumps(opts.paths)
+    if not xmls:
+        print("No xml dump found")
+        return
+    print(f"{len(xmls)} dumps, same trees: {check_same(xmls)}")
+    for name in State.PARSERS:
+        cost, views = benchmark(xmls, name, opts.repeat)
+        print(f"{name}: {cost:.3f} seconds, {views / cost:.0f} views/second")
+
+
+if __name__ == "__main__":
+    main()
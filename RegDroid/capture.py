@@ -0,0 +1,30 @@
+import time
+
+
+class Capture(object):
+    """
+    What was read from a device at one step: the hierarchy dump, its State,
+    the ComparisonMask.dump_key of the dump, the screenshot taken with it
+    (None when there is none) and when the dump was taken.
+
+    A capture is never modified: consumers of a step read Device.capture
+    instead of dumping the device again, and a new look at the device makes
+    a new Capture.
+    """
+
+    __slots__ = ('xml', 'state', 'dump_key', 'screenshot', 'timestamp')
+
+    def __init__(self, xml, state, dump_key, screenshot=None, timestamp=None):
+        set_field = super(Capture, self).__setattr__
+        set_field('xml', xml)
+        set_field('state', state)
+        set_field('dump_key', dump_key)
+        set_field('screenshot', screenshot)
+        set_field('timestamp', timestamp if timestamp is not None else time.time())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Capture is immutable")
+
+    def with_screenshot(self, screenshot):
+        # the same dump, now with its screenshot
+        return Capture(self.xml, self.state, self.dump_key, screenshot, self.timestamp)
@@ -4,12 +4,13 @@ import os
 import re
 
 from injector import Injector
+from settle import SettleDetector
 from utils import Utils
 
 
 class Checker(object):
     
-    def __init__(self,devices,app,strategy_list,emulator_path,android_system,root_path,resource_path,testcase_count,event_num,timeout,setting_random_denominator,rest_interval,choice):
+    def __init__(self,devices,app,strategy_list,emulator_path,android_system,root_path,resource_path,testcase_count,event_num,timeout,setting_random_denominator,rest_interval,choice,settle=None):
         
         self.timeout = timeout
         self.app = app
@@ -24,6 +25,7 @@ class Checker(object):
         self.event_num = event_num
         self.setting_random_denominator = setting_random_denominator
         self.rest_interval = rest_interval
+        self.settle = settle if settle is not None else SettleDetector(rest_interval, samples=0)
         self.injector = Injector(devices=devices,
                 app=app,
                 strategy_list=strategy_list,
@@ -36,7 +38,8 @@ class Checker(object):
                 timeout=timeout,
                 setting_random_denominator=setting_random_denominator,
                 rest_interval=rest_interval,
-                choice=choice)
+                choice=choice,
+                settle=self.settle)
         self.utils = Utils(devices=devices)
     
     def check_time(self,path):
@@ -91,8 +94,8 @@ class Checker(object):
                             fw.write(text+'\n\n')
                             fw.flush()
 
-    def check_keyboard(self):
-        for device in self.devices:
+    def check_keyboard(self, devices=None):
+        for device in (devices if devices is not None else self.devices):
             # device.use.set_clipboard('text', 'label')
             lines = device.state.lines
             if "com.sohu.inputmethod.sogou:id/imeview_keyboard" in lines or "com.baidu.input_huawei" in lines or "com.google.android.inputmethod.latin" in lines:
@@ -104,9 +107,14 @@ class Checker(object):
             return True
         return False
     
-    def check_foreground(self):
+    def check_foreground(self,fresh=False):
         packagelist=[self.app.package_name,"com.google.android.permissioncontroller","com.android.packageinstaller","com.android.permissioncontroller"]
-        lines = self.devices[0].use.dump_hierarchy()
+        # the capture of this step, unless the screen is known to have changed since
+        capture = self.devices[0].capture
+        if fresh or capture is None:
+            lines = self.devices[0].use.dump_hierarchy()
+        else:
+            lines = capture.xml
         return any(package in lines for package in packagelist)
     
     def check_start(self,times,strategy):
@@ -188,7 +196,7 @@ class Checker(object):
                 #     device.use(scrollable=True,packageName=self.app.package_name).scroll.vert.forward(steps=5)
                 if device.use(textContains="重试").count>0:
                     device.use(textContains="重试").click()
-                    time.sleep(self.rest_interval*1)
+                    self.settle.wait(device)
             Flag = True
         return Flag
 
@@ -197,17 +205,17 @@ class Checker(object):
         while device.use(className="android.widget.Button",packageName="com.google.android.permissioncontroller").count > 0:
             print("Allow permission:permissioncontroller")
             device.use(className="android.widget.Button",packageName="com.google.android.permissioncontroller").click()
-            time.sleep(self.rest_interval*1)
+            self.settle.wait(device)
             Flag = True
         while device.use(className="android.widget.Button",packageName="com.android.packageinstaller").count > 0:
             print("Allow permission:packageinstaller")
             device.use(className="android.widget.Button",packageName="com.android.packageinstaller",instance=1).click()
-            time.sleep(self.rest_interval*1)
+            self.settle.wait(device)
             Flag = True
         while device.use(className="android.widget.Button",packageName="com.google.android.packageinstaller").count > 0:
             print("Allow permission:packageinstaller")
             device.use(className="android.widget.Button",packageName="com.google.android.packageinstaller",instance=1).click()
-            time.sleep(self.rest_interval*1)
+            self.settle.wait(device)
             Flag = True
         
         permissionlist = ["权限","permission","authoriz"]
@@ -216,14 +224,14 @@ class Checker(object):
         lines2 = device.use.dump_hierarchy()
         if device.use(packageName="com.android.settings",text="Permissions").count>0:
             device.use(packageName="com.android.settings",text="Permissions").click()
-            time.sleep(self.rest_interval*1)
+            self.settle.wait(device)
             while device.use(text="OFF",className="android.widget.Switch").count>0:
                 device.use(text="OFF",className="android.widget.Switch").click()
             while device.use(text="我知道了",resourceId="com.ss.android.ugc.aweme:id/e9y").count>0:
                 device.use(text="我知道了",resourceId="com.ss.android.ugc.aweme:id/e9y").click()
             while device.use(packageName=self.app.package_name).count<1:
                 device.use.press("back")
-                time.sleep(self.rest_interval*1)
+                self.settle.wait(device)
         elif device.use(packageName="com.android.settings",text="APPS").count>0:
             device.use(scrollable=True,instance = 0).scroll.to(text=self.app.app_name)
             device.use(text=self.app.app_name).click()
@@ -255,7 +263,7 @@ class Checker(object):
                 device.use(className="android.widget.Button").click()
                 again_flag=0
             if again_flag==0:
-                time.sleep(self.rest_interval*3)
+                self.settle.wait(device, self.rest_interval*3)
                 self.check_permission_request(device)
                 Flag = True
         return Flag
@@ -266,17 +274,17 @@ class Checker(object):
     def check_loading(self):
         wait_time = 0
         for device in self.devices:
-            if (device.use(className="android.widget.ProgressBar").count > 0 and 
-                wait_time < self.rest_interval * 5):
-                time.sleep(self.rest_interval * 5)
-                wait_time = wait_time + self.rest_interval * 5
-                print("wait load")
+            if wait_time < self.rest_interval * 5:
+                waited = self.settle.wait_loading(device, self.rest_interval * 5 - wait_time)
+                if waited > 0:
+                    wait_time = wait_time + waited
+                    print("wait load")
             elif wait_time > self.rest_interval * 20 or wait_time == self.rest_interval * 20:
                 print("so long wait")
         return wait_time
     
-    def check_crash(self):
-        for device in self.devices:
+    def check_crash(self, devices=None):
+        for device in (devices if devices is not None else self.devices):
             device.last_crash_logcat = device.crash_logcat
             f_crash = open(
                 f"{self.root_path}/{device.device_serial}_logcat.txt",
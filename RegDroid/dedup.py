@@ -0,0 +1,161 @@
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+
+
+class DedupStore(object):
+    """
+    Remember the states already reported as failures.
+
+    Exact tier: states are keyed by State.fingerprint, so a repeated failure
+    costs one dictionary lookup. Near-duplicate tier (optional): a MinHash
+    signature of the state's view hashes is bucketed with LSH, and a state is
+    a duplicate when a recorded state shares a bucket and their estimated
+    Jaccard similarity reaches near_threshold.
+
+    Entries are kept per key (one per device and app version under test),
+    bounded by max_entries with least-recently-used eviction, and appended
+    to a jsonl file so deduplication carries across test cases and separate
+    runs. The file is rewritten with the live entries once it holds twice
+    max_entries lines.
+    """
+
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, path=None, max_entries=10000, near_threshold=0, num_perm=32, bands=8):
+        self.path = path
+        self.max_entries = max_entries
+        self.near_threshold = near_threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        # fixed seed: signatures must stay comparable across runs
+        rnd = random.Random(1)
+        self.perms = [
+            (rnd.randrange(1, self.PRIME), rnd.randrange(0, self.PRIME))
+            for _ in range(num_perm)
+        ]
+        # (key, fingerprint) -> minhash signature or None
+        self.entries = OrderedDict()
+        # (key, band, rows) -> set of (key, fingerprint)
+        self.buckets = {}
+        # entries added since the last save, and the lines of the file
+        self.unsaved = []
+        self.saved_lines = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def minhash(self, state):
+        values = [int.from_bytes(view_hash[:8], 'big') for view_hash in state.compared_view_hashes()]
+        if not values:
+            return [0] * self.num_perm
+        prime = self.PRIME
+        return [min((a * value + b) % prime for value in values) for a, b in self.perms]
+
+    def band_keys(self, key, signature):
+        for band in range(self.bands):
+            rows = tuple(signature[band * self.rows:(band + 1) * self.rows])
+            yield (key, band, rows)
+
+    def similarity(self, signature1, signature2):
+        same = sum(1 for value1, value2 in zip(signature1, signature2) if value1 == value2)
+        return same / self.num_perm
+
+    def contains(self, key, state):
+        with self.lock:
+            entry = (key, state.fingerprint)
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+                return True
+            if not self.near_threshold:
+                return False
+            signature = self.minhash(state)
+            candidates = set()
+            for band_key in self.band_keys(key, signature):
+                candidates.update(self.buckets.get(band_key, ()))
+            for candidate in candidates:
+                if self.similarity(signature, self.entries[candidate]) >= self.near_threshold:
+                    self.entries.move_to_end(candidate)
+                    return True
+            return False
+
+    def add(self, key, state):
+        signature = self.minhash(state) if self.near_threshold else None
+        with self.lock:
+            if self.add_entry(key, state.fingerprint, signature):
+                self.unsaved.append((key, state.fingerprint, signature))
+
+    def add_entry(self, key, fingerprint, signature):
+        # returns whether the entry is new
+        entry = (key, fingerprint)
+        if entry in self.entries:
+            self.entries.move_to_end(entry)
+            return False
+        self.entries[entry] = signature
+        if signature is not None:
+            for band_key in self.band_keys(key, signature):
+                self.buckets.setdefault(band_key, set()).add(entry)
+        while len(self.entries) > self.max_entries:
+            self.remove_entry(next(iter(self.entries)))
+        return True
+
+    def remove_entry(self, entry):
+        signature = self.entries.pop(entry)
+        if signature is not None:
+            for band_key in self.band_keys(entry[0], signature):
+                bucket = self.buckets.get(band_key)
+                if bucket is not None:
+                    bucket.discard(entry)
+                    if not bucket:
+                        del self.buckets[band_key]
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.saved_lines += 1
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted run
+                        continue
+                    signature = item.get("minhash")
+                    if signature is not None and len(signature) != self.num_perm:
+                        # signatures of another size cannot be compared, keep the exact tier only
+                        signature = None
+                    self.add_entry(item["key"], item["fingerprint"], signature)
+        except OSError as e:
+            print(f"Error loading dedup store {self.path}: {e}")
+
+    @staticmethod
+    def entry_line(key, fingerprint, signature):
+        return json.dumps({"key": key, "fingerprint": fingerprint, "minhash": signature}) + '\n'
+
+    def save(self):
+        # append the entries added since the last save
+        if self.path is None:
+            return
+        with self.lock:
+            if self.saved_lines + len(self.unsaved) > 2 * self.max_entries:
+                self.rewrite()
+                return
+            lines = [self.entry_line(*item) for item in self.unsaved]
+            self.unsaved = []
+            self.saved_lines += len(lines)
+        if lines:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+
+    def rewrite(self):
+        # under the lock: the file gets the live entries only
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for (key, fingerprint), signature in self.entries.items():
+                f.write(self.entry_line(key, fingerprint, signature))
+        os.replace(tmp_path, self.path)
+        self.unsaved = []
+        self.saved_lines = len(self.entries)
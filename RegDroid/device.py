@@ -2,25 +2,13 @@ import subprocess
 import os
 import time
 import re
-from threading import Thread
+from contextlib import contextmanager
 
 import uiautomator2 as u2
 
-
-class MyThread(Thread):
-    def __init__(self, func, args):
-        super(MyThread, self).__init__()
-        self.func = func
-        self.args = args
-
-    def run(self):
-        self.result = self.func(*self.args)
-
-    def get_result(self):
-        try:
-            return self.result
-        except Exception:
-            return None
+from adb_client import AdbCommandLost, AdbError, ShellBatch, shell_command
+from install_cache import package_info
+from worker import DeviceWorker, DeviceJob
 
 
 class Device(object):
@@ -29,7 +17,8 @@ class Device(object):
     """
 
     def __init__(
-        self, device_num=None, device_serial=None, is_emulator=True, rest_interval=None
+        self, device_num=None, device_serial=None, is_emulator=True, rest_interval=None, adb=None,
+        action_mode="selector"
     ):
         self.device_num = device_num
         self.device_serial = device_serial
@@ -37,6 +26,21 @@ class Device(object):
         self.use = None
         self.state = None
         self.last_state = None
+        # Capture of the current step, see capture.py
+        self.capture = None
+        self.screenshot_path = None
+        # ArtifactWriter saving screenshots and dumps, None writes them directly
+        self.writer = None
+        # DeviceDriverHandle when dumps and screenshots run in a driver process
+        self.driver = None
+        # AdbDevice of adb_client.AdbClient, None runs the adb binary for every command
+        self.adb = adb.device(device_serial) if adb is not None else None
+        # ShellBatch collecting the shell commands inside batch()
+        self.shell_batch = None
+        # "local": view actions go to the target found in the last captured state, see local_action()
+        self.action_mode = action_mode
+        # selector wait of click/longclick/edit, None is the session's implicit wait
+        self.selector_timeout = 0 if action_mode == "local" else None
         self.strategy = "screen"
         self.crash_logcat = ""
         self.last_crash_logcat = ""
@@ -52,18 +56,25 @@ class Device(object):
         self.permission = True
         self.hourformat = "12h"
         self.app = None
+        # long-lived thread running this device's jobs, see get_worker()
+        self.worker = None
 
     def set_strategy(self, strategy):
         self.strategy = strategy
         self.error_num = 0
         self.wrong_num = 0
 
+    def get_worker(self):
+        if self.worker is None:
+            self.worker = DeviceWorker(f"device-{self.device_serial}")
+        return self.worker
+
     def set_thread(self, execute_event, args):
         # 如果已经有线程，先删除
         if hasattr(self, 'thread'):
             delattr(self, 'thread')
         if execute_event is not None:
-            self.thread = MyThread(execute_event, args)
+            self.thread = DeviceJob(execute_event, args)
         else:
             self.thread = None
 
@@ -109,13 +120,19 @@ class Device(object):
             
             # 等待设备就绪 - 这个命令会阻塞直到设备可用
             print("Waiting for device...")
-            subprocess.run(
-                ["adb", "-s", self.device_serial, "wait-for-device"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True,
-                timeout=60
-            )
+            if self.adb is not None:
+                # the old shell session went down with the emulator
+                self.adb.close()
+                if not self.adb.wait_for_device(60):
+                    raise AdbError(f"{self.device_serial} did not come back in 60s")
+            else:
+                subprocess.run(
+                    ["adb", "-s", self.device_serial, "wait-for-device"],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    check=True,
+                    timeout=60
+                )
             print("Device is ready")
 
             # 等待系统完全启动
@@ -132,16 +149,13 @@ class Device(object):
         
         while time.time() - start_time < timeout:
             try:
-                result = subprocess.run(
-                    ["adb", "-s", self.device_serial, "shell", "getprop", "sys.boot_completed"],
-                    capture_output=True, text=True, timeout=5
-                )
+                status, output = self.run_shell("getprop sys.boot_completed", timeout=5)
                 
-                if result.returncode == 0 and result.stdout.strip() == "1":
+                if status == 0 and output.strip() == "1":
                     print("System boot completed")
                     return
                     
-            except subprocess.TimeoutExpired:
+            except (subprocess.TimeoutExpired, AdbError, OSError):
                 pass
             
             time.sleep(2)
@@ -150,6 +164,81 @@ class Device(object):
 
     
     
+    def shell(self, *args, timeout=None):
+        """
+        adb shell, returns (exit status, output with stderr). Inside batch()
+        the command is only collected: returns its ShellCommand, whose status
+        and output are set when the batch runs.
+        """
+        command = shell_command(*args)
+        if self.shell_batch is not None:
+            return self.shell_batch.add(command)
+        return self.run_shell(command, timeout)
+
+    def run_shell(self, command, timeout=None):
+        """
+        Through the device's shell session when there is an adb client, the
+        adb binary when the client could not send the command. A command
+        sent without a result is not run again: exit status 255.
+        """
+        if self.adb is not None:
+            try:
+                return self.adb.run(command, timeout)
+            except AdbCommandLost as e:
+                print(f"adb client error on {self.device_serial}: {e}")
+                return 255, str(e)
+            except (AdbError, OSError) as e:
+                print(f"adb client error on {self.device_serial}, using adb: {e}")
+        result = subprocess.run(
+            ["adb", "-s", self.device_serial, "shell", command],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=timeout,
+        )
+        return result.returncode, result.stdout
+
+    @contextmanager
+    def batch(self):
+        """
+        Run the shell commands of the block in one shell invocation, at the
+        end of the block or before a push that may depend on them:
+
+            with device.batch():
+                granted = [device.shell("pm", "grant", package, p) for p in permissions]
+            for command in granted:
+                print(command.status, command.output)
+
+        A batch inside a batch joins it.
+        """
+        if self.shell_batch is not None:
+            yield self.shell_batch
+            return
+        self.shell_batch = ShellBatch()
+        try:
+            yield self.shell_batch
+            self.flush_batch()
+        finally:
+            self.shell_batch = None
+
+    def flush_batch(self):
+        if self.shell_batch is not None and self.shell_batch.pending():
+            self.shell_batch.read(*self.run_shell(self.shell_batch.script()))
+
+    def push(self, local, remote):
+        self.flush_batch()
+        if self.adb is not None:
+            try:
+                self.adb.push(local, remote)
+                return
+            except (AdbError, OSError) as e:
+                print(f"adb client error on {self.device_serial}, using adb: {e}")
+        subprocess.run(
+            ["adb", "-s", self.device_serial, "push", local, remote],
+            stdout=subprocess.PIPE,
+        )
+
     def make_strategy(self, root_path):
         start_time = time.time()
         if not os.path.isdir(f"{root_path}strategy_{self.strategy}/"):
@@ -176,6 +265,10 @@ class Device(object):
             os.makedirs(f"{self.path}screen/")
         self.f_read_trace = open(f'{self.path}/read_trace.txt', 'w', encoding='utf-8')
         self.f_trace = open(f'{self.path}/trace.txt', 'w', encoding='utf-8')
+        # screenshot annotations of Utils.draw_event, rendered by annotate.py
+        self.f_annotations = open(f'{self.path}/annotations_{self.device_num}_{self.device_serial}.jsonl', 'w', encoding='utf-8')
+        # saved states of this device, compared offline by oracle.py
+        self.f_captures = open(f'{self.path}/captures_{self.device_num}_{self.device_serial}.jsonl', 'w', encoding='utf-8')
 
         self.error_event_lists = []
         self.wrong_event_lists = []
@@ -187,12 +280,33 @@ class Device(object):
         self.use = u2.connect_usb(self.device_serial)
         self.use.implicitly_wait(5.0)
 
-    def install_app(self, app, app_object):
+    def install_app(self, app, app_object, cache=None):
+        # cache: InstallCache, an install it verifies is reused with pm clear
         start_time = time.time()
         print(app)
-        subprocess.run(
-            ["adb", "-s", self.device_serial, "install", "-g", app], stdout=subprocess.PIPE
-        )
+        if cache is not None and self.reuse_install(app, app_object, cache):
+            end_time = time.time()
+            print(f"install_app {self.device_serial} reused the installed app, time: {end_time - start_time} seconds")
+            return
+        installed = False
+        if self.adb is not None:
+            try:
+                self.adb.install(app, grant_all=True)
+                installed = True
+            except AdbCommandLost:
+                # pm may still be installing: no adb install on top of it, the Provisioner retries
+                raise
+            except (AdbError, OSError) as e:
+                print(f"adb client error on {self.device_serial}, using adb: {e}")
+        if not installed:
+            result = subprocess.run(
+                ["adb", "-s", self.device_serial, "install", "-g", app],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            )
+            output = result.stdout.decode('utf-8', 'replace').strip()
+            if result.returncode != 0 or "Success" not in output:
+                # raised for the Provisioner to try the install again and report it
+                raise AdbError(f"Install of {app} on {self.device_serial} failed: {output}")
 
         # print("check permissions", app_object.permissions)
         # 对于特定的需要手动授权的权限，可以添加额外的授权命令
@@ -201,47 +315,116 @@ class Device(object):
             if app_object.package_name in permission:
                 special_permissions.append(permission)
         
-        for permission in special_permissions:
-            try:
-                subprocess.run(
-                    ["adb", "-s", self.device_serial, "shell", "pm", "grant", 
-                    app_object.package_name, permission],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    check=True
-                )
+        with self.batch():
+            grants = [
+                (permission, self.shell("pm", "grant", app_object.package_name, permission))
+                for permission in special_permissions
+            ]
+        for permission, grant in grants:
+            if grant.status == 0:
                 print(f"Successfully granted permission: {permission}")
-            except subprocess.CalledProcessError as e:
-                print(f"Failed to grant permission {permission}: {e}")
+            else:
+                print(f"Failed to grant permission {permission}: {grant.output.strip()}")
+
+        if cache is not None:
+            self.record_install(app, app_object, cache)
 
         end_time = time.time()
         print(f"install_app {self.device_serial} time: {end_time - start_time} seconds")
 
+    def package_info(self, package):
+        # install_cache.package_info of the package on the device, one batched shell call
+        with self.batch():
+            dumpsys = self.shell("dumpsys", "package", package)
+            # no sha256sum without a base.apk: with no file it would read stdin
+            digest = self.shell(
+                "sh", "-c",
+                "p=$(pm path \"$1\" | sed -n 's/^package://p' | grep base.apk) && [ -n \"$p\" ] && sha256sum \"$p\"",
+                "sh", package)
+        # inside an outer batch: the results are needed now
+        self.flush_batch()
+        return package_info(dumpsys.output, digest.output if digest.status == 0 else None)
+
+    def reuse_install(self, app, app_object, cache):
+        """
+        When the app installed on the device is the APK app (the install cache
+        has its sha256 for this serial and the device still reports the same
+        install), clear its data and grant its permissions again instead of
+        reinstalling it. Returns whether it did.
+        """
+        package = app_object.package_name
+        record = cache.get(self.device_serial, package)
+        if record is None or record["sha256"] != cache.apk_digest(app):
+            return False
+        info = self.package_info(package)
+        if not cache.matches(record, info):
+            print(f"{self.device_serial}: {package} changed since it was installed, reinstalling")
+            cache.forget(self.device_serial, package)
+            return False
+        with self.batch():
+            cleared = self.shell("pm", "clear", package)
+            # pm clear revokes the runtime permissions install -g granted, only those can be granted
+            grants = [
+                (permission, self.shell("pm", "grant", package, permission))
+                for permission in info["runtimePermissions"]
+            ]
+        if cleared.status != 0 or "Success" not in cleared.output:
+            print(f"{self.device_serial}: pm clear {package} failed: {cleared.output.strip()}")
+            return False
+        for permission, grant in grants:
+            if grant.status != 0:
+                # the app would run without it: install again, which grants everything
+                print(f"{self.device_serial}: pm grant {permission} failed: {grant.output.strip()}, reinstalling")
+                return False
+        return True
+
+    def record_install(self, app, app_object, cache):
+        package = app_object.package_name
+        digest = cache.apk_digest(app)
+        info = self.package_info(package)
+        if info["versionCode"] is None or info["sha256"] not in (None, digest):
+            # not installed, or not installed from this file alone (split APKs)
+            cache.forget(self.device_serial, package)
+            return
+        cache.put(self.device_serial, package, {
+            "apk": os.path.abspath(app),
+            "sha256": digest,
+            "versionCode": info["versionCode"],
+            "lastUpdateTime": info["lastUpdateTime"],
+        })
+
     def initialization(self):
         self.use.set_orientation("n")
 
     def initial_setting(self):
         print("initial setting")
 
-    def screenshot_and_getstate(self, path, event_count):
+    def screenshot_and_getstate(self, path, event_count, xml=None):
+        # xml: a dump just taken, so the device is not dumped again
+        # the decoded screenshot goes straight to the writer, which saves it
         self.screenshot_path = (
             path + str(event_count) + '_' + self.device_serial + '.png'
         )
-        self.use.screenshot(path + str(event_count) + '_' + self.device_serial + '.png')
-        xml = self.use.dump_hierarchy()
-        f = open(
-            path + str(event_count) + '_' + self.device_serial + '.xml',
-            'w',
-            encoding='utf-8',
-        )
-        f.write(xml)
-        with open(
-            path + str(event_count) + '_' + self.device_serial + '.xml',
-            'r',
-            encoding='utf-8',
-        ) as f:
-            lines = f.readlines()
-        return lines
+        image = self.use.screenshot(format='opencv')
+        if xml is None:
+            xml = self.use.dump_hierarchy()
+        self.save_image(self.screenshot_path, image)
+        self.save_text(path + str(event_count) + '_' + self.device_serial + '.xml', xml)
+        return xml.splitlines(True)
+
+    def save_image(self, path, image):
+        if self.writer is not None:
+            self.writer.write_image(path, image)
+        else:
+            import cv2
+            cv2.imwrite(path, image)
+
+    def save_text(self, path, text):
+        if self.writer is not None:
+            self.writer.write_text(path, text)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
 
     def update_state(self, state):
         self.last_state = self.state
@@ -259,19 +442,7 @@ class Device(object):
     def start_app(self, app):
         # 启动应用
         print(f"Starting app: {app.package_name}/{app.main_activity}")
-        subprocess.run(
-            [
-                "adb",
-                "-s",
-                self.device_serial,
-                "shell",
-                "am",
-                "start",
-                "-n",
-                f"{app.package_name}/{app.main_activity}",
-            ],
-            stdout=subprocess.PIPE,
-        )
+        self.shell("am", "start", "-n", f"{app.package_name}/{app.main_activity}")
         
         # # 尝试跳过欢迎页面
         # try:
@@ -286,31 +457,88 @@ class Device(object):
         # # self.use.app_wait(app.package_name, front=True, timeout=2.0)
         return True
 
+    def find_view(self, view, instance=None):
+        """
+        Resolve the target of a className/resourceId selector in this device's
+        last state instead of asking uiautomator2 for it
+        """
+        if self.state is None:
+            return None
+        if instance is None:
+            instance = view.instance
+        return self.state.find_view(view.className, view.resourceId, instance)
+
+    def local_target(self, view):
+        """
+        The view an event targets in the last captured state, looked up by
+        its selector (description, text, or className/resourceId/instance).
+        None when it is not there or more than one view matches.
+        """
+        if self.state is None:
+            return None
+        if view.description != "":
+            matches = self.state.find_views("description", view.description, view.package)
+        elif view.text != "":
+            matches = self.state.find_views("text", view.text, view.package)
+        else:
+            target = self.find_view(view)
+            matches = [target] if target is not None and target.package == view.package else []
+        return matches[0] if len(matches) == 1 else None
+
+    def local_action(self, action, view, text=None):
+        """
+        action_mode local: click, longclick or edit the target found in the
+        last captured state at its coordinates, without a selector lookup on
+        the device. Returns the feature, None when there is no unambiguous
+        target (the action then goes through the zero-wait selectors).
+        """
+        if action not in ("click", "longclick", "edit"):
+            return None
+        target = self.local_target(view)
+        if target is None:
+            return None
+        if action == "click":
+            self.use.click(target.x, target.y)
+        elif action == "longclick":
+            self.use.long_click(target.x, target.y, duration=2.0)
+        else:
+            self.use.click(target.x, target.y)
+            self.use.send_keys(text, clear=True)
+        return "local"
+
     def click(self, view, strategy_list):
         try:
             if self.strategy != "language":
                 if view.description != "":
                     self.use(
                         description=view.description, packageName=view.package
-                    ).click()
+                    ).click(timeout=self.selector_timeout)
                     return "description"
                 elif view.text != "":
-                    self.use(text=view.text, packageName=view.package).click()
+                    self.use(text=view.text, packageName=view.package).click(timeout=self.selector_timeout)
                     return "text"
                 else:
+                    target = self.find_view(view)
+                    if target is not None:
+                        self.use.click(target.x, target.y)
+                        return "classNameresourceId"
                     self.use(
                         className=view.className,
                         resourceId=view.resourceId,
                         instance=view.instance
-                    ).click()
+                    ).click(timeout=self.selector_timeout)
                     return "classNameresourceId"
                 
             elif view.instance == 0:
+                target = self.find_view(view)
+                if target is not None and target.package == view.package:
+                    self.use.click(target.x, target.y)
+                    return "classNameresourceId"
                 self.use(
                     className=view.className,
                     resourceId=view.resourceId,
                     packageName=view.package,
-                ).click()
+                ).click(timeout=self.selector_timeout)
                 return "classNameresourceId"
             else:
                 self.use.click(view.x, view.y)
@@ -322,17 +550,21 @@ class Device(object):
     def _click(self, view, text):
         try:
             if text is not None and view.text == text:
-                self.use(text=view.text, packageName=view.package).click()
+                self.use(text=view.text, packageName=view.package).click(timeout=self.selector_timeout)
                 return "text"
             if view.description != "":
-                self.use(description=view.description, packageName=view.package).click()
+                self.use(description=view.description, packageName=view.package).click(timeout=self.selector_timeout)
                 return "description"
             elif view.instance == 0:
+                target = self.find_view(view)
+                if target is not None and target.package == view.package:
+                    self.use.click(target.x, target.y)
+                    return "classNameresourceId"
                 self.use(
                     className=view.className,
                     resourceId=view.resourceId,
                     packageName=view.package,
-                ).click()
+                ).click(timeout=self.selector_timeout)
                 return "classNameresourceId"
             else:
                 self.use.click(view.x, view.y)
@@ -347,27 +579,35 @@ class Device(object):
                 if view.description != "":
                     self.use(
                         description=view.description, packageName=view.package
-                    ).long_click(duration=2.0)
+                    ).long_click(duration=2.0, timeout=self.selector_timeout)
                     return
                 elif view.text != "":
                     self.use(text=view.text, packageName=view.package).long_click(
-                        duration=2.0
+                        duration=2.0, timeout=self.selector_timeout
                     )
                     return
                 elif view.instance == 0:
+                    target = self.find_view(view)
+                    if target is not None and target.package == view.package:
+                        self.use.long_click(target.x, target.y, duration=2.0)
+                        return
                     self.use(
                         className=view.className,
                         resourceId=view.resourceId,
                         packageName=view.package,
-                    ).long_click(duration=2.0)
+                    ).long_click(duration=2.0, timeout=self.selector_timeout)
                 else:
                     self.use.long_click(view.x, view.y, duration=2.0)
             elif view.instance == 0:
+                target = self.find_view(view)
+                if target is not None and target.package == view.package:
+                    self.use.long_click(target.x, target.y, duration=2.0)
+                    return
                 self.use(
                     className=view.className,
                     resourceId=view.resourceId,
                     packageName=view.package,
-                ).long_click(duration=2.0)
+                ).long_click(duration=2.0, timeout=self.selector_timeout)
             else:
                 self.use.long_click(view.x, view.y, duration=2.0)
         except:
@@ -381,13 +621,13 @@ class Device(object):
                 className=view.className,
                 resourceId=view.resourceId,
                 packageName=view.package,
-            ).set_text(text)
+            ).set_text(text, timeout=self.selector_timeout)
         else:
             self.use(
                 className=view.className,
                 resourceId=view.resourceId,
                 packageName=view.package,
-            ).set_text(text)
+            ).set_text(text, timeout=self.selector_timeout)
 
     def scroll(self, view, strategy_list):
         if view.action == "scroll_backward":
@@ -416,35 +656,17 @@ class Device(object):
             ).scroll.horiz.toBeginning(max_swipes=10)
 
     def close_keyboard(self):
-        subprocess.run(
-            ["adb", "-s", self.device_serial, "shell", "input", "keyevent", "111"],
-            stdout=subprocess.PIPE,
-        )
+        self.shell("input", "keyevent", "111")
 
     def add_file(self, resource_path, resource, path):
-        subprocess.run(
-            ["adb", "-s", self.device_serial, "logcat", "-c"], stdout=subprocess.PIPE
-        )
-        subprocess.run(
-            [
-                "adb",
-                "-s",
-                self.device_serial,
-                "push",
-                f"{resource_path}/{resource}",
-                path,
-            ],
-            stdout=subprocess.PIPE,
-        )
+        self.shell("logcat", "-c")
+        self.push(f"{resource_path}/{resource}", path)
 
     def log_crash(self, path):
         os.popen(f"adb -s {self.device_serial} logcat -b crash >{path}")
 
     def mkdir(self, path):
-        subprocess.run(
-            ["adb", "-s", self.device_serial, "shell", "mkdir", path],
-            stdout=subprocess.PIPE,
-        )
+        self.shell("mkdir", path)
 
     def disable_keyboard(self):
         self.use.set_fastinput_ime(True)
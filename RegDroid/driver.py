@@ -0,0 +1,213 @@
+import itertools
+import multiprocessing
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from mask import ComparisonMask
+from state import State
+
+
+class DriverError(Exception):
+    pass
+
+
+class DeviceDriver(object):
+    """
+    The device work of a group of devices, in a driver process: hierarchy
+    dumps and screenshots over the driver's own uiautomator2 connections,
+    encoding and writing the files, hashing and parsing the dumps.
+
+    What goes back to the coordinator is compact: the dump, its dump_key
+    and its State, None when the dump_key is the last one the coordinator
+    has (it keeps its State).
+    """
+
+    def __init__(self, serials, parser="line", mask_spec=None):
+        self.serials = serials
+        self.parser = parser
+        self.mask = ComparisonMask.load(mask_spec)
+        self.connections = {}
+        # the last dump of every device, saved by save() without dumping again
+        self.last_dumps = {}
+
+    def connect(self, serial):
+        import uiautomator2 as u2
+        self.connections[serial] = u2.connect(serial)
+        return self.connections[serial]
+
+    def call(self, serial, func, *args, **kwargs):
+        use = self.connections.get(serial) or self.connect(serial)
+        try:
+            return func(use, *args, **kwargs)
+        except Exception:
+            # the device may have been restarted: reconnect once
+            return func(self.connect(serial), *args, **kwargs)
+
+    def read(self, xml, last_key):
+        dump_key = self.mask.dump_key(xml)
+        if dump_key == last_key:
+            return dump_key, None
+        return dump_key, State(xml.splitlines(), self.parser, self.mask)
+
+    def dump(self, serial):
+        # (dump, dump_key)
+        xml = self.call(serial, lambda use: use.dump_hierarchy())
+        self.last_dumps[serial] = xml
+        return xml, self.mask.dump_key(xml)
+
+    def look(self, serial, last_key):
+        # (dump, dump_key, State or None)
+        xml = self.call(serial, lambda use: use.dump_hierarchy())
+        self.last_dumps[serial] = xml
+        return (xml,) + self.read(xml, last_key)
+
+    def save(self, serial, path, event_count, last_key, reuse_dump=False):
+        """
+        Device.screenshot_and_getstate in the driver: screenshot and dump
+        saved under path, reuse_dump saves the last dump instead of a new one.
+        Returns (dump, dump_key, State or None, screenshot path).
+        """
+        import cv2
+        name = path + str(event_count) + '_' + serial
+        image = self.call(serial, lambda use: use.screenshot(format='opencv'))
+        xml = self.last_dumps.get(serial) if reuse_dump else None
+        if xml is None:
+            xml = self.call(serial, lambda use: use.dump_hierarchy())
+            self.last_dumps[serial] = xml
+        cv2.imwrite(name + '.png', image)
+        with open(name + '.xml', 'w', encoding='utf-8') as f:
+            f.write(xml)
+        return (xml,) + self.read(xml, last_key) + (name + '.png',)
+
+
+def driver_main(connection, serials, parser, mask_spec):
+    # the loop of a driver process: one thread per device, answers in any order
+    driver = DeviceDriver(serials, parser, mask_spec)
+    send_lock = threading.Lock()
+    pool = ThreadPoolExecutor(max_workers=max(1, len(serials)))
+
+    def run(request_id, method, args):
+        try:
+            answer = (True, getattr(driver, method)(*args))
+        except Exception as e:
+            traceback.print_exc()
+            answer = (False, f"{type(e).__name__}: {e}")
+        with send_lock:
+            connection.send((request_id, answer))
+
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        pool.submit(run, *request)
+    pool.shutdown()
+
+
+class DriverProcess(object):
+    """
+    The coordinator's end of a driver process: requests go over a pipe,
+    a reader thread hands the answers to the waiting device workers.
+    """
+
+    def __init__(self, serials, parser="line", mask_spec=None):
+        # spawn: the coordinator runs threads, forking it is not safe
+        context = multiprocessing.get_context("spawn")
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=driver_main,
+            args=(child, serials, parser, mask_spec),
+            name="driver-" + "-".join(serials),
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.ids = itertools.count()
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.reader = threading.Thread(target=self.read, name=self.process.name, daemon=True)
+        self.reader.start()
+
+    def read(self):
+        while True:
+            try:
+                request_id, (ok, result) = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            future = self.futures.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(DriverError(result))
+        # the process is gone: nobody will answer the pending requests
+        with self.lock:
+            self.closed = True
+            for future in self.futures.values():
+                future.set_exception(DriverError(f"{self.process.name} exited"))
+            self.futures.clear()
+
+    def request(self, method, *args):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise DriverError(f"{self.process.name} exited")
+            request_id = next(self.ids)
+            self.futures[request_id] = future
+            self.connection.send((request_id, method, args))
+        return future.result()
+
+    def stop(self):
+        try:
+            with self.lock:
+                self.connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+class DeviceDriverHandle(object):
+    # Device.driver: the requests of one device to its driver process
+
+    def __init__(self, process, serial):
+        self.process = process
+        self.serial = serial
+
+    def dump(self):
+        return self.process.request("dump", self.serial)
+
+    def look(self, last_key):
+        return self.process.request("look", self.serial, last_key)
+
+    def save(self, path, event_count, last_key, reuse_dump=False):
+        return self.process.request("save", self.serial, path, event_count, last_key, reuse_dump)
+
+
+class DriverPool(object):
+    """
+    processes driver processes for the devices, dealt round-robin: as many
+    processes as devices gives one per device.
+    """
+
+    def __init__(self, devices, processes, parser="line", mask_spec=None):
+        processes = max(1, min(processes, len(devices)))
+        groups = [devices[i::processes] for i in range(processes)]
+        self.processes = []
+        for group in groups:
+            process = DriverProcess([device.device_serial for device in group], parser, mask_spec)
+            self.processes.append(process)
+            for device in group:
+                device.driver = DeviceDriverHandle(process, device.device_serial)
+        print(f"Started {len(self.processes)} driver processes for {len(devices)} devices")
+
+    def stop(self):
+        for process in self.processes:
+            process.stop()
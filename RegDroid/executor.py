@@ -1,4 +1,6 @@
+import json
 import os
+import sys
 import threading
 import time
 import subprocess
@@ -9,8 +11,20 @@ from checker import Checker
 from event import Event
 from view import View
 from utils import Utils
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import concurrent.futures
+from dedup import DedupStore
+from tree_diff import diff_states, save_diff
+from mask import ComparisonMask
+from settle import SettleDetector
+from permission import PermissionHandler
+from capture import Capture
+from writer import ArtifactWriter
+from annotate import ANNOTATIONS_FILE, render_annotations
+from worker import wait_all
+from profiler import StepProfiler
+from oracle import capture_record, flag_record, no_effect_record
+from driver import DriverPool
+from provision import ProvisionError, Provisioner
+from install_cache import InstallCache
 
 
 class Executor(object):
@@ -45,6 +59,28 @@ class Executor(object):
         rest_interval,
         trace_path,
         choice,
+        parser="line",
+        dedup_max_entries=10000,
+        dedup_near_threshold=0,
+        mask_spec=None,
+        job_timeout=0,
+        settle_samples=3,
+        settle_max_wait=5,
+        permission_rules=None,
+        writer_max_pending=256,
+        writer_max_pending_mb=256,
+        durability="flush",
+        profile=False,
+        profile_trace=False,
+        max_skew=4,
+        straggler_factor=3.0,
+        straggler_patience=5,
+        compare_mode="online",
+        drivers=0,
+        action_mode="selector",
+        provision_timeout=300,
+        provision_retries=2,
+        reinstall=False,
     ):
 
         self.policy_name = policy_name
@@ -78,8 +114,53 @@ class Executor(object):
         self.guest_devices = self.devices[1:]
         self.trace_path = trace_path
         self.choice = choice
-        self.deduplicate_list1 = []
-        self.deduplicate_lists = [[] for _ in range(len(self.devices)-1)]  # 其他设备
+        self.parser = parser
+        # seconds a device may spend on one job, None waits forever
+        self.job_timeout = job_timeout or None
+        # times the phases of every step, a no-op unless profile is on
+        self.profiler = StepProfiler(enabled=profile, trace=profile_trace)
+        # how far guests may lag the base and when they are demoted (SkewExecutor)
+        self.max_skew = max(1, max_skew)
+        self.straggler_factor = straggler_factor
+        self.straggler_patience = straggler_patience
+        # online: State.same between events, record: fingerprints only, oracle.py compares after each run
+        self.compare_mode = compare_mode
+        self.mask_spec = mask_spec
+        self.oracle_processes = []
+        # dumps, screenshots and parsing in driver processes, 0 = in this process
+        self.drivers = DriverPool(self.devices, drivers, parser, mask_spec) if drivers else None
+        # selector: view actions through uiautomator2 selectors, local: Device.local_action
+        self.action_mode = action_mode
+        # connect, install and logcat of all devices at once, reported in provision.jsonl
+        self.provisioner = Provisioner(provision_timeout, provision_retries, f"{root_path}provision.jsonl")
+        # sha256 of the APK installed on each device, None always reinstalls
+        self.install_cache = None if reinstall else InstallCache(f"{root_path}install_cache.json")
+        # what state comparison and deduplication ignore
+        self.mask = ComparisonMask.load(mask_spec)
+        # saves screenshots and dumps in the background
+        self.writer = ArtifactWriter(
+            max_pending=writer_max_pending,
+            max_pending_bytes=writer_max_pending_mb * 1024 * 1024,
+            durability=durability,
+        )
+        for device in self.devices:
+            device.writer = self.writer
+        # waits for the screens to become idle
+        self.settle = SettleDetector(
+            rest_interval,
+            samples=settle_samples,
+            max_wait=settle_max_wait,
+            mask=self.mask,
+            profiler=self.profiler,
+        )
+        # clicks through permission dialogs after launches and events
+        self.permission_handler = PermissionHandler.load(permission_rules, self.settle, parser, self.mask)
+        # failures already reported, kept on disk across test cases and runs
+        self.dedup_store = DedupStore(
+            path=os.path.join(root_path, "dedup_store.jsonl"),
+            max_entries=dedup_max_entries,
+            near_threshold=dedup_near_threshold,
+        )
         self.injector = Injector(
             devices=devices,
             app=app,
@@ -94,6 +175,7 @@ class Executor(object):
             setting_random_denominator=setting_random_denominator,
             rest_interval=rest_interval,
             choice=choice,
+            settle=self.settle,
         )
         
 
@@ -111,6 +193,7 @@ class Executor(object):
             setting_random_denominator=setting_random_denominator,
             rest_interval=rest_interval,
             choice=self.choice,
+            settle=self.settle,
         )
 
         self.utils = Utils(devices=devices)
@@ -153,20 +236,19 @@ class Executor(object):
             have_view_action = ["click", "longclick", "edit", "scroll"]
             feature = ""
             if event.action in have_view_action and event.view is not None:
-                if (
-                    device.use(resourceId=event.view.resourceId).count == 0
-                    or device.use(className=event.view.className).count == 0
-                ):
-                    lines = device.use.dump_hierarchy()
-                    if (
-                        event.view.resourceId != ""
-                        and event.view.resourceId not in lines
-                    ) or (
-                        event.view.className != "" and event.view.className not in lines
-                    ):
-                        return False
-
-            if event.action.startswith("setting_"):
+                # the target must be on the screen captured at this step, or on the live screen:
+                # the capture may be older than the screen (keyboard / permission handling, replay)
+                on_screen = device.capture is not None and self.target_in(event.view, device.capture.xml)
+                if not on_screen and not self.target_in(event.view, self.settle.dump(device) or ""):
+                    return False
+
+            local_feature = None
+            if self.action_mode == "local" and event.view is not None:
+                local_feature = device.local_action(event.action, event.view, event.text)
+
+            if local_feature is not None:
+                feature = local_feature
+            elif event.action.startswith("setting_"):
                 self.injector.replay_setting(event, self.strategy_list)
             elif event.action == "check_setting_request":
                 self.checker.check_setting_request()
@@ -198,34 +280,16 @@ class Executor(object):
                 self.injector.replay_setting(event, self.strategy_list)
 
             print(device.device_serial + ":" + feature + ":end execute\n")
-            time.sleep(self.rest_interval * 1)
+            xml = self.settle.wait(device)
+
+            if local_feature is not None and not self.changed_screen(device, xml):
+                # recorded, not dispatched again: the action may have run without a visible effect
+                print(f"{device.device_serial}: no visible effect of the local {event.action}")
+                self.record_no_effect(device, event)
 
             # 处理连续的权限弹窗
-            permission_texts = ["OK", "ALLOW", "允许", "确定", "继续", "GRANT", "Get Started"]
-            
-            # 多次尝试处理权限，直到没有更多权限弹窗
-            max_attempts = 5  # 防止无限循环
-            current_attempt = 0
-            
-            while current_attempt < max_attempts:
-                # 标记是否处理了任何权限
-                handled_permission = False
-                
-                for text in permission_texts:
-                    if device.use(text=text).exists():
-                        print(f"Clicking permission2: {text}")
-                        device.use(text=text).click()
-                        time.sleep(1)  # 等待权限处理
-                        handled_permission = True
-                        break  # 处理一个权限后重新检查
-                
-                # 如果没有处理任何权限，退出循环
-                if not handled_permission:
-                    break
-                
-                current_attempt += 1
-            
-            
+            self.permission_handler.handle(device, xml)
+
             return True
         except Exception as ex:
             if num == 0:
@@ -235,6 +299,22 @@ class Executor(object):
                 print(ex)
                 return False
 
+    def target_in(self, view, lines):
+        return not (
+            (view.resourceId != "" and view.resourceId not in lines)
+            or (view.className != "" and view.className not in lines)
+        )
+
+    def changed_screen(self, device, xml):
+        """
+        Whether the screen after an action differs from the capture the
+        action was resolved in, by dump_key (xml is the settled dump, None
+        with fixed sleeps: unknown, taken as changed)
+        """
+        if device.capture is None or xml is None:
+            return True
+        return self.mask.dump_key(xml) != device.capture.dump_key
+
     def replay(self, strategy):
         # init
         self.injector.init_setting()
@@ -270,9 +350,22 @@ class Executor(object):
                     'w',
                     encoding='utf-8',
                 )
+                # the annotations of the replayed screens, rendered at End::
+                f_annotations = open(
+                    os.path.join(self.error_path, linelist[1], ANNOTATIONS_FILE),
+                    'w',
+                    encoding='utf-8',
+                )
+                for device in self.devices:
+                    device.f_annotations = f_annotations
                 print(self.screen_path)
             elif "End::" in line:
                 # end
+                self.writer.flush()
+                f_annotations.close()
+                for device in self.devices:
+                    device.f_annotations = None
+                render_annotations([os.path.join(self.error_path, linelist[1])])
                 if record_flag is True:
                     for theline in self.error_event_lists:
                         self.f_replay_record.write(theline)
@@ -314,7 +407,7 @@ class Executor(object):
                         self.execute_event, args
                     )
                     if event.device.device_num == 1:
-                        self.utils.start_thread()
+                        self.run_device_jobs()
                         for device in self.devices:
                             if device.thread is not None:
                                 success_flag = device.thread.get_result()
@@ -333,6 +426,7 @@ class Executor(object):
                     and not self.devices[0].state.same(self.devices[1].state)
                 ):
                     print("different!")
+                    self.save_state_diff(self.devices[1])
                     event = Event(None, "wrong", self.devices[1], elementlist[0])
                     self.utils.draw_event(event)
                 if "::start::" in line:
@@ -348,13 +442,18 @@ class Executor(object):
             event = Event(view, elementlist[1], self.devices[1], elementlist[0])
         else:
             print(f"{line} error")
+        # take the instance number from the replaying device's state, so device.click can resolve it locally
+        if view is not None and event.device.state is not None:
+            target = event.device.state.find_view_by_line(view.line)
+            if target is not None:
+                view.set_instance(target.instance)
         return event
 
     def start_app(self, event_count):
         for device in self.devices:
             args = (device.app,)
             device.set_thread(device.start_app, args)
-        self.utils.start_thread()
+        self.run_device_jobs()
 
         for device in self.guest_devices:
             self.utils.write_read_event(
@@ -415,7 +514,7 @@ class Executor(object):
             args = (device.app,)
             device.set_thread(device.start_app, args)
 
-        self.utils.start_thread()
+        self.run_device_jobs()
         self.checker.check_start(0, strategy)
         
 
@@ -435,13 +534,13 @@ class Executor(object):
         for device in self.devices:
             device.use.press("back")
         print("Back")
-        time.sleep(self.rest_interval * 1)
-        if not self.checker.check_foreground():
+        self.settle.wait_all(self.devices)
+        if not self.checker.check_foreground(fresh=True):
             for device in self.devices:
                 device.stop_app(device.app)
                 args = (device.app,)
                 device.set_thread(device.start_app, args)
-            self.utils.start_thread()
+            self.run_device_jobs()
             self.checker.check_start(1, strategy)
 
             for device in self.guest_devices:
@@ -472,6 +571,10 @@ class Executor(object):
                 self.utils.write_event(event, device.device_num, device.f_trace)
                 self.utils.draw_event(event)
 
+    def run_device_jobs(self):
+        # run the jobs set with Device.set_thread on all devices and wait for them
+        self.utils.start_thread(self.job_timeout)
+
     def save_all_state(self, event_count):
         # start_time = time.time()
         # time.sleep(self.rest_interval * 1)
@@ -487,23 +590,26 @@ class Executor(object):
         # print(f"save_all_state time: {end_time - start_time} seconds")
         # return event_count + 1
         start_time = time.time()
-        time.sleep(self.rest_interval * 1)
+        # the settled dumps are the dumps of this step's captures
+        settled = self.settle.wait_all(self.devices)
         
         # 先保存基准设备状态（不需要并行）
-        self.save_state(0, f"{self.devices[0].path}screen/", event_count, self.devices[0].f_trace)
+        with self.profiler.span("save_state", self.devices[0]):
+            self.save_state(0, f"{self.devices[0].path}screen/", event_count, self.devices[0].f_trace, settled.get(self.devices[0]))
         
         # 并行处理 guest devices
-        with ThreadPoolExecutor(max_workers=len(self.guest_devices)) as executor:
-            def save_device_state(device):
+        def save_device_state(device):
+            with self.profiler.span("save_state", device):
                 self.save_state(
-                    device.device_num, device.path + "screen/", event_count, device.f_trace
+                    device.device_num, device.path + "screen/", event_count, device.f_trace, settled.get(device)
                 )
-                event = Event(None, "save_state", device, event_count)
-                event.set_count(device.device_num)
-                self.utils.write_event(event, device.device_num, device.f_trace)
-            
-            # 并行执行 guest devices 的状态保存
-            list(executor.map(save_device_state, self.guest_devices))
+            event = Event(None, "save_state", device, event_count)
+            event.set_count(device.device_num)
+            self.utils.write_event(event, device.device_num, device.f_trace)
+
+        # 并行执行 guest devices 的状态保存, 每台设备在自己的 worker 上
+        futures = {device.get_worker().submit(save_device_state, device): device for device in self.guest_devices}
+        wait_all(futures, self.job_timeout)
         
         end_time = time.time()
         # print(f"save_all_state time: {end_time - start_time} seconds")
@@ -529,54 +635,111 @@ class Executor(object):
 
         event_count = event_count - 1
     
-        with ThreadPoolExecutor(max_workers=len(self.devices)) as executor:
-            futures = {}
-            for device_idx, device in enumerate(self.devices):
-                try:
-                    # 重新构造原始方法的完整参数
-                    path = f"{device.path}screen/"
-                    
-                    # 获取设备层级信息
-                    lines = device.use.dump_hierarchy().splitlines()
-                    
-                    # 创建 State 对象
-                    state = State(lines)
-                    
-                    # 提交更新任务，保留原始方法的所有参数
-                    futures[executor.submit(
-                        self.update_state, 
-                        device_idx,  # device_count
-                        path,        # path
-                        event_count, # event_count
-                        device.f_trace  # f_trace
-                    )] = device
-                except Exception as e:
-                    print(f"Error preparing state for device {device.device_serial}: {e}")
-            
-            # 等待并处理结果
-            for future in as_completed(futures):
-                device = futures[future]
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error updating state for device {device.device_serial}: {e}")
+        futures = {}
+        for device_idx, device in enumerate(self.devices):
+            # 重新构造原始方法的完整参数
+            path = f"{device.path}screen/"
+
+            # 提交更新任务到设备的 worker，保留原始方法的所有参数
+            futures[device.get_worker().submit(
+                self.profiler.wrap("update_state", self.update_state, device),
+                device_idx,  # device_count
+                path,        # path
+                event_count, # event_count
+                device.f_trace  # f_trace
+            )] = device
+
+        # 等待并处理结果
+        wait_all(futures, self.job_timeout)
         
         end_time = time.time()
         # print(f"update_all_state time: {end_time - start_time} seconds")
         event_count = event_count + 1
 
-    def save_state(self, device_count, path, event_count, f_trace):
-        # get and save state of all devices
-        lines = self.devices[device_count].screenshot_and_getstate(path, event_count)
-        state = State(lines)
-        self.devices[device_count].update_state(state)
+    def make_capture(self, device, xml):
+        # Capture of a dump, parsing it only when it differs from the last one
+        dump_key = self.mask.dump_key(xml)
+        if device.capture is not None and dump_key == device.capture.dump_key:
+            return Capture(xml, device.capture.state, dump_key)
+        return Capture(xml, State(xml.splitlines(), self.parser, self.mask), dump_key)
+
+    def last_key(self, device):
+        return device.capture.dump_key if device.capture is not None else None
+
+    def driver_capture(self, device, xml, dump_key, state):
+        # Capture of what a driver process read, state is None when the dump did not change
+        if state is None:
+            state = device.capture.state
+        return Capture(xml, state, dump_key)
+
+    def save_state(self, device_count, path, event_count, f_trace, xml=None):
+        # get and save state of all devices, dumping the device only when no fresh dump is given
+        device = self.devices[device_count]
+        if device.driver is not None:
+            # the given dump is the driver's last one
+            xml, dump_key, state, device.screenshot_path = device.driver.save(
+                path, event_count, self.last_key(device), xml is not None
+            )
+            capture = self.driver_capture(device, xml, dump_key, state)
+        else:
+            lines = device.screenshot_and_getstate(path, event_count, xml)
+            capture = self.make_capture(device, ''.join(lines))
+        device.capture = capture.with_screenshot(device.screenshot_path)
+        if capture.state is not device.state:
+            device.update_state(capture.state)
+        self.record_capture(device, event_count, path)
+
+    def record_capture(self, device, event_count, path):
+        # one line per saved state for oracle.py
+        f_captures = getattr(device, 'f_captures', None)
+        if f_captures is None:
+            return
+        xml_path = path + str(event_count) + '_' + device.device_serial + '.xml'
+        record = capture_record(device, event_count, xml_path, device.capture)
+        self.utils.append(device, f_captures, json.dumps(record) + '\n')
+
+    def same_state(self, base_state, state, device=None, event_count=None):
+        # equal fingerprints are always the same state
+        if base_state.fingerprint == state.fingerprint:
+            return True
+        if self.compare_mode == "record":
+            # left to the oracle, which is told about the pair
+            if device is not None:
+                self.flag_for_oracle(device, event_count, base_state, state)
+            return True
+        return base_state.same(state)
+
+    def record_no_effect(self, device, event):
+        # a local action whose screen did not change, next to the captures of the device
+        f_captures = getattr(device, 'f_captures', None)
+        if f_captures is None:
+            return
+        record = no_effect_record(device, event)
+        self.utils.append(device, f_captures, json.dumps(record) + '\n')
+
+    def flag_for_oracle(self, device, event_count, base_state, state):
+        f_captures = getattr(device, 'f_captures', None)
+        if f_captures is None:
+            return
+        record = flag_record(device, event_count, base_state, state)
+        self.utils.append(device, f_captures, json.dumps(record) + '\n')
 
     def update_state(self, device_count, path, event_count, f_trace):
-        lines = self.devices[device_count].use.dump_hierarchy().splitlines()
-        state = State(lines)
-        self.devices[device_count].update_state(state)
-        if self.devices[device_count].last_state != self.devices[device_count].state:
-            self.save_state(device_count, path, event_count, f_trace)
+        device = self.devices[device_count]
+        if device.driver is not None:
+            xml, dump_key, state = device.driver.look(self.last_key(device))
+            capture = self.driver_capture(device, xml, dump_key, state)
+        else:
+            xml = device.use.dump_hierarchy()
+            capture = self.make_capture(device, xml)
+        if device.capture is not None and capture.state is device.capture.state:
+            # same screen as the last capture: keep it, no parsing and no screenshot
+            device.update_state(device.state)
+            return
+        device.capture = capture
+        device.update_state(capture.state)
+        if device.last_state != device.state:
+            self.save_state(device_count, path, event_count, f_trace, xml)
 
     def restart_devices(self, event_count):
         # print("restart_devices")
@@ -651,24 +814,28 @@ class Executor(object):
         for device in self.guest_devices:
             self.checker.check_language(self.root_path + "/strategy_language/")
 
+    def save_state_diff(self, device):
+        # edit script from the base device's state to this device's, next to its screenshot
+        try:
+            operations = diff_states(self.devices[0].state, device.state)
+            save_diff(operations, os.path.splitext(device.screenshot_path)[0] + "_diff.json")
+        except Exception as e:
+            print(f"Error saving state diff for device {device.device_serial}: {e}")
+
+    def dedup_key(self, device):
+        # states are deduplicated per device and app version, which stay stable across runs
+        return f"{device.device_num}:{os.path.basename(device.app.app_path)}"
+
     def checkduplicate(self):
-        # 检查基准设备
-        for screen in self.deduplicate_list1:
-            if self.devices[0].state.same(screen):
+        # 检查所有设备
+        for device in self.devices:
+            if self.dedup_store.contains(self.dedup_key(device), device.state):
                 return True
-                
-        # 检查其他设备
-        for i in range(1, len(self.devices)):
-            device_idx = i - 1  # 转换为deduplicate_lists的索引
-            for screen in self.deduplicate_lists[device_idx]:
-                if self.devices[i].state.same(screen):
-                    return True
-                    
+
         # 保存当前状态
-        self.deduplicate_list1.append(self.devices[0].state)
-        for i in range(1, len(self.devices)):
-            device_idx = i - 1  # 转换为deduplicate_lists的索引
-            self.deduplicate_lists[device_idx].append(self.devices[i].state)
+        for device in self.devices:
+            self.dedup_store.add(self.dedup_key(device), device.state)
+        self.dedup_store.save()
         return False
 
     def restart_devices_and_install_app_and_data(self):
@@ -692,18 +859,7 @@ class Executor(object):
                 print(f"Standard error: {e.stderr.decode('utf-8')}")
                 return
 
-            # self.parallel_device_connect()
-
-
-            for i, device in enumerate(self.devices):
-                device.connect()
-                if i < len(self.app_path):
-                    device.install_app(self.app_path[i], device.app)
-                    print(f"Installed app {self.app_path[i]} on device {device.device_serial}")
-                else:
-                    # 如果设备数量超过应用数量，使用最后一个应用
-                    device.install_app(self.app_path[-1], device.app)
-                    print(f"Installed app {self.app_path[-1]} on device {device.device_serial} (fallback)")
+            self.provision_devices(install=True, disable_keyboard=True)
 
             end_time = time.time()
             print(f"restart_devices_and_install_app_and_data time: {end_time - start_time} seconds")
@@ -728,15 +884,11 @@ class Executor(object):
                 print(f"Standard error: {e.stderr.decode('utf-8')}")
                 return
 
-            for device in self.devices:
-                device.connect()
-            # self.parallel_device_connect()
+            self.provision_devices(install=False, disable_keyboard=True)
 
         # # add some files to all devices
         resourcelist = os.listdir(self.resource_path)
         for device in self.devices:
-            device.disable_keyboard()
-            device.log_crash(f"{self.root_path}/{device.device_serial}_logcat.txt")
             # for resource in resourcelist:
             #     device.add_file(self.resource_path, resource, "/sdcard")
             print(f"Added resources to device {device.device_serial}")
@@ -747,6 +899,58 @@ class Executor(object):
 
     
     
+    def log_crash(self, device, path):
+        device.log_crash(path)
+
+    def provision_devices(self, install=True, restart=False, disable_keyboard=False):
+        """
+        Connect the devices and install the app (or restart them), all
+        devices at once, then hook up their crash logcat. ProvisionError
+        when a device failed or timed out: no run starts on it, least of
+        all while its provisioning job is still running.
+        """
+        def steps_of(device):
+            i = self.devices.index(device)
+            # 如果设备数量超过应用数量，使用最后一个应用
+            app_path = self.app_path[i] if i < len(self.app_path) else self.app_path[-1]
+            steps = [("connect", device.connect)]
+            if install:
+                steps.append(("install", lambda: device.install_app(app_path, device.app, self.install_cache)))
+            if restart:
+                steps.append(("restart", lambda: device.restart(self.emulator_path, self.emulator_name)))
+            if disable_keyboard:
+                steps.append(("disable_keyboard", device.disable_keyboard))
+            steps.append(("logcat", lambda: self.log_crash(device, f"{self.root_path}/{device.device_serial}_logcat.txt")))
+            return steps
+        records = self.provisioner.run(self.devices, steps_of)
+        failed = [
+            record["serial"] for device, record in zip(self.devices, records)
+            if not record["ok"] or device.get_worker().hung()
+        ]
+        if failed:
+            raise ProvisionError(f"Provisioning failed on {', '.join(failed)}")
+        return records
+
+    def start_oracle(self, run_paths):
+        # compare the states of a run in another process while the devices go on
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "oracle.py")]
+        command.extend(run_paths)
+        command.extend(["-parser", self.parser])
+        if self.mask_spec is not None:
+            command.extend(["-mask_spec", self.mask_spec])
+        self.oracle_processes.append(subprocess.Popen(command))
+
+    def close(self):
+        # drain-on-exit: everything queued for the disk is written before leaving
+        self.writer.drain()
+        if self.drivers is not None:
+            self.drivers.stop()
+        for process in self.oracle_processes:
+            process.wait()
+        for device in self.devices:
+            if device.worker is not None:
+                device.worker.stop()
+
     def start(self, strategy):
         # if execute serial, init the strategy of device1, otherwise, init all the guest devices' strategies
         if self.serial_or_parallel == 0:
@@ -773,7 +977,14 @@ class Executor(object):
             print(f"Starting test case {run_count}")
             if run_count > 0:
                 print("Executor start 2 ")
-                self.restart_devices_and_install_app_and_data()
+                try:
+                    with self.profiler.span("restart_devices_and_install_app_and_data"):
+                        self.restart_devices_and_install_app_and_data()
+                except ProvisionError as e:
+                    # the next test case restarts the emulators again
+                    print(f"Skipping test case {run_count + 1}: {e}")
+                    run_count = run_count + 1
+                    continue
             # create folder of new run
             run_count = run_count + 1
 
@@ -790,387 +1001,353 @@ class Executor(object):
             
             # init setting
             event_count = 1.0
-            now_start_time = time.time()
-            event_count = self.save_all_state(event_count) # event count + 1
-            end_time = time.time()
-            # print(f"1.init setting time: {end_time - now_start_time} seconds")
+            with self.profiler.span("init_save_all_state"):
+                event_count = self.save_all_state(event_count) # event count + 1
             
             # self.injector.init_setting()
 
             # clear and start app
-            now_start_time = time.time()
-            event_count = self.clear_and_restart_app(event_count, strategy)
-            end_time = time.time()
-            # print(f"2.clear_and_restart_app time: {end_time - now_start_time} seconds")
+            with self.profiler.span("clear_and_restart_app"):
+                event_count = self.clear_and_restart_app(event_count, strategy)
 
             for device in self.devices:
                 print(f"debug skip_welcome1: {device.app.package_name}")
                 device.skip_welcome(device.app.package_name)
 
             # 处理连续的权限弹窗
-            permission_texts = ["OK", "ALLOW", "允许", "确定", "继续",  "GRANT", "Get Started"]
-
             for device in self.devices:
-                # 多次尝试处理权限，直到没有更多权限弹窗
-                max_attempts = 5  # 防止无限循环
-                current_attempt = 0
-                
-                while current_attempt < max_attempts:
-                    # 标记是否处理了任何权限
-                    handled_permission = False
-                    
-                    for text in permission_texts:
-                        if device.use(text=text).exists():
-                            print(f"Clicking permission1: {text}")
-                            device.use(text=text).click()
-                            time.sleep(1)  # 等待权限处理
-                            handled_permission = True
-                            break  # 处理一个权限后重新检查
-                    
-                    # 如果没有处理任何权限，退出循环
-                    if not handled_permission:
-                        break
-                    
-                    current_attempt += 1
-
-            while event_count < self.event_num:
-                # 更新所有设备状态
-                now_start_time = time.time()
-                self.update_all_state(event_count)
-                end_time = time.time()
-                # print(f"3.update_all_state time: {end_time - now_start_time} seconds")
-                
-                # 只检查非失败设备的状态
-                now_start_time = time.time()
-                active_devices = [device for device in self.devices if not (hasattr(device, 'has_failed') and device.has_failed)]
-                change_flag = any(device.last_state != device.state for device in active_devices)
-                end_time = time.time()
-                # print(f"4.check_state time: {end_time - now_start_time} seconds")
-
-                now_start_time = time.time()
-                if self.devices[0].last_state is not None and change_flag:
-                    # 等待加载
-                    self.wait_load(event_count)
-
-                    # 检查应用是否在前台
-                    if not self.checker.check_foreground():
-                        print("Not foreground")
-                        self.back_to_app(event_count, strategy)
-                        self.checker.check_loading()
-                        event_count = self.save_all_state(event_count)
+                self.permission_handler.handle(device)
 
-                    self.checker.check_crash()
-                    self.checker.check_keyboard()
-                end_time = time.time()
-                # print(f"5.check_crash and check_keyboard time: {end_time - now_start_time} seconds")
+            event_count = self.run_events(run_count, event_count, strategy, start_time)
 
-                # 检查每个非基准设备的状态和执行结果
-                newly_failed = []  # 本次新失败的设备
-                all_failed = True  # 是否所有未失败的设备都失败了
-                
-                # 检查每个非基准设备的状态
-                now_start_time = time.time()
-                for i in range(1, len(self.devices)):
-                    # 跳过已经失败的设备
-                    if hasattr(self.devices[i], 'has_failed') and self.devices[i].has_failed:
-                        continue
-                    
-                    # 检查设备状态是否一致
-                    if not self.devices[0].state.same(self.devices[i].state):
-                        print(f"Device {i} state is different!")
-                        self.utils.write_error(
-                            i,  # 使用实际的设备编号
-                            run_count,
-                            self.devices[i].wrong_event_lists,
-                            self.devices[i].f_wrong,
-                            self.devices[i].wrong_num
-                        )
-                        self.devices[i].wrong_num += 1
-                        
-                        # 记录错误事件
-                        event = Event(None, "wrong", self.devices[i], event_count)
-                        self.utils.draw_event(event)
-                    
-                
+            # event=self.injector.change_setting_after_run(event_count,strategy)
+            # if event is not None:
+            #     event_count = self.write_draw_and_save_one(event,event_count)
 
-                
-                end_time = time.time()
-                # print(f"6.check_state time: {end_time - now_start_time} seconds")
+        
+            # at the end of each run, render the annotations and generate a html file
+            self.writer.flush()
+            render_annotations(sorted({device.path for device in self.devices}))
+            for device in self.guest_devices:
+                self.utils.generate_html(device.path, device.path, run_count)
+            if self.compare_mode == "record":
+                self.start_oracle(sorted({device.path for device in self.devices}))
+            self.profiler.dump(
+                f"{self.root_path}profile_{run_count}.json",
+                f"{self.root_path}profile_{run_count}.trace.json",
+            )
 
-                now_start_time = time.time()
-                
-                # 选择事件（始终从基准设备选择）
-                event = self.policy.choose_event(self.devices[0], event_count)
-                
-                # 更新上一个事件
-                self.last_event = event
+    def run_events(self, run_count, event_count, strategy, start_time):
+        # the events of one run, one step per event on all devices at once
+        while event_count < self.event_num:
+            with self.profiler.span("step"):
+                event_count = self.run_step(run_count, event_count, strategy)
+
+            end_time = time.time()
+            print(f"one run time: {end_time - start_time} seconds")
+
+            # injecte a setting change
+            # event=self.injector.inject_setting_during_run(event_count,strategy,request_flag)
+            # if event is not None:
+            #     event_count = self.write_draw_and_save_one(event,event_count)
+        return event_count
+
+    def run_step(self, run_count, event_count, strategy):
+        # one event on all devices, returns the next event_count
+        # 更新所有设备状态
+        with self.profiler.span("update_all_state"):
+            self.update_all_state(event_count)
+        
+        # 只检查非失败设备的状态
+        with self.profiler.span("check_state_change"):
+            active_devices = [device for device in self.devices if not (hasattr(device, 'has_failed') and device.has_failed)]
+            # every device looked at its screen after the event: the checks run after every event.
+            # last_state is state only says the screen did not change (nothing parsed or saved)
+            change_flag = any(device.last_state is not None for device in active_devices)
+
+        with self.profiler.span("check_crash_and_keyboard"):
+            if self.devices[0].last_state is not None and change_flag:
+                # 等待加载
+                self.wait_load(event_count)
+
+                # 检查应用是否在前台
+                if not self.checker.check_foreground():
+                    print("Not foreground")
+                    self.back_to_app(event_count, strategy)
+                    self.checker.check_loading()
+                    event_count = self.save_all_state(event_count)
+
+                self.checker.check_crash()
+                self.checker.check_keyboard()
+
+        # 检查每个非基准设备的状态和执行结果
+        newly_failed = []  # 本次新失败的设备
+        all_failed = True  # 是否所有未失败的设备都失败了
+        
+        # 检查每个非基准设备的状态
+        with self.profiler.span("compare_states"):
+            for i in range(1, len(self.devices)):
+                # 跳过已经失败的设备
+                if hasattr(self.devices[i], 'has_failed') and self.devices[i].has_failed:
+                    continue
+            
+                # 检查设备状态是否一致
+                if not self.same_state(self.devices[0].state, self.devices[i].state, self.devices[i], event_count):
+                    print(f"Device {i} state is different!")
+                    self.utils.write_error(
+                        i,  # 使用实际的设备编号
+                        run_count,
+                        self.devices[i].wrong_event_lists,
+                        self.devices[i].f_wrong,
+                        self.devices[i].wrong_num
+                    )
+                    self.devices[i].wrong_num += 1
+                    self.save_state_diff(self.devices[i])
                 
-                end_time = time.time()
-                # print(f"8.choose_event time: {end_time - now_start_time} seconds")
+                    # 记录错误事件
+                    event = Event(None, "wrong", self.devices[i], event_count)
+                    self.utils.draw_event(event)
+            
+        
 
-                now_start_time = time.time()
-                self.utils.draw_event(event)
-                event.print_event()
-                end_time = time.time()
-                # print(f"9.draw_event time: {end_time - now_start_time} seconds")
+        
 
-                # 执行事件
-                now_start_time = time.time()
-                for device in self.devices:
-                    # 跳过已经失败的设备
-                    if hasattr(device, 'has_failed') and device.has_failed:
-                        continue
+        with self.profiler.span("choose_event"):
+        
+            # 选择事件（始终从基准设备选择）
+            event = self.policy.choose_event(self.devices[0], event_count)
+        
+            # 更新上一个事件
+            self.last_event = event
+        
 
-                    # 删除已存在的线程属性
-                    if hasattr(device, 'thread'):
-                        delattr(device, 'thread')
-                    
-                    args = (device, event, 0)
-                    device.set_thread(self.execute_event, args)
+        with self.profiler.span("draw_event"):
+            self.utils.draw_event(event)
+            event.print_event()
+
+        # 执行事件
+        with self.profiler.span("run_device_jobs"):
+            for device in self.devices:
+                # 跳过已经失败的设备
+                if hasattr(device, 'has_failed') and device.has_failed:
+                    continue
+
+                # 删除已存在的线程属性
+                if hasattr(device, 'thread'):
+                    delattr(device, 'thread')
+            
+                args = (device, event, 0)
+                device.set_thread(self.profiler.wrap("execute_event", self.execute_event, device), args)
+        
+            # 启动线程执行事件
+            self.run_device_jobs()
+        
+        # 检查基准设备执行结果
+        with self.profiler.span("check_base_device"):
+            base_success = self.devices[0].thread.get_result()
+            if not base_success:
+                # 基准设备失败，直接跳过当前事件
+                print(f"Base device failed at event {event_count}, action: {event.action}")
+            
+                # # 如果是权限相关的失败，添加额外的日志
+                # if event.view and "permission" in str(event.view.resourceId).lower():
+                #     print(f"WARNING: Permission dialog encountered at event {event_count}")
+                #     print(f"Permission details: {event.view.text}, Resource ID: {event.view.resourceId}")
+            
+                self.utils.print_dividing_line(False, event_count)
+                # 递增 event_count，避免卡在同一个事件
+                event_count += 1
+                return event_count
+        
+
+        with self.profiler.span("check_other_devices"):
+            # 检查其他设备的执行结果
+            for i in range(1, len(self.devices)):
+                # 跳过已经失败的设备
+                if hasattr(self.devices[i], 'has_failed') and self.devices[i].has_failed:
+                    continue
+            
+                device_success = self.devices[i].thread.get_result()
+                if device_success:
+                    # 至少有一个设备还在运行
+                    all_failed = False
+                else:
+                    # 设备执行失败
+                    newly_failed.append(i)
+                    self.devices[i].has_failed = True
+                    print(f"Device {i} failed, recording error and skipping its future events")
                 
-                # 启动线程执行事件
-                self.utils.start_thread()
-                end_time = time.time()
-                # print(f"10.start_thread time: {end_time - now_start_time} seconds")
+                    # 记录错误事件
+                    self.utils.print_dividing_line(False, event_count, i)
+                    self.utils.write_event(
+                        event, i, self.devices[i].f_trace
+                    )
+                    self.utils.draw_event(event)
                 
-                # 检查基准设备执行结果
-                now_start_time = time.time()
-                base_success = self.devices[0].thread.get_result()
-                if not base_success:
-                    # 基准设备失败，直接跳过当前事件
-                    print(f"Base device failed at event {event_count}, action: {event.action}")
+                    # 保存失败设备的截图和布局信息
+                    try:
+                        # 将 run_count 转换为字符串
+                        run_count_str = str(int(run_count)) if isinstance(run_count, float) else str(run_count)
                     
-                    # # 如果是权限相关的失败，添加额外的日志
-                    # if event.view and "permission" in str(event.view.resourceId).lower():
-                    #     print(f"WARNING: Permission dialog encountered at event {event_count}")
-                    #     print(f"Permission details: {event.view.text}, Resource ID: {event.view.resourceId}")
+                        # 确保 root_path 和 screen_error 目录存在
+                        screen_error_path = os.path.join(self.root_path, run_count_str, "screen_error/")
+                        os.makedirs(screen_error_path, exist_ok=True)
                     
-                    self.utils.print_dividing_line(False, event_count)
-                    # 递增 event_count，避免卡在同一个事件
-                    event_count += 1
-                    continue
-                
-                end_time = time.time()
-                # print(f"11.check base device time: {end_time - now_start_time} seconds")
-
-                now_start_time = time.time()
-                # 检查其他设备的执行结果
-                for i in range(1, len(self.devices)):
-                    # 跳过已经失败的设备
-                    if hasattr(self.devices[i], 'has_failed') and self.devices[i].has_failed:
-                        continue
+                        # 保存截图和布局
+                        screenshot_path = os.path.join(screen_error_path, f"{event_count}_device_{device.device_num}.png")
+                        xml_path = os.path.join(screen_error_path, f"{event_count}_device_{device.device_num}.xml")
                     
-                    device_success = self.devices[i].thread.get_result()
-                    if device_success:
-                        # 至少有一个设备还在运行
-                        all_failed = False
-                    else:
-                        # 设备执行失败
-                        newly_failed.append(i)
-                        self.devices[i].has_failed = True
-                        print(f"Device {i} failed, recording error and skipping its future events")
+                        # 使用 screenshot_and_getstate 方法同时保存截图和布局
+                        device.screenshot_and_getstate(screen_error_path, event_count)
+                    
+                        # 记录当前事件信息
+                        event_info_path = os.path.join(self.root_path, run_count_str, "event_info_error")
+                        os.makedirs(event_info_path, exist_ok=True)
+                    
+                        with open(os.path.join(event_info_path, f"event_info_error_{event_count}_device_{device.device_num}.txt"), "w") as f:
+                            f.write(f"Run Count: {run_count}\n")
+                            f.write(f"Event Count: {event_count}\n")
                         
-                        # 记录错误事件
-                        self.utils.print_dividing_line(False, event_count, i)
-                        self.utils.write_event(
-                            event, i, self.devices[i].f_trace
-                        )
-                        self.utils.draw_event(event)
+                            # 记录事件详细信息
+                            f.write(f"Action: {event.action}\n")
                         
-                        # 保存失败设备的截图和布局信息
-                        try:
-                            # 将 run_count 转换为字符串
-                            run_count_str = str(int(run_count)) if isinstance(run_count, float) else str(run_count)
-                            
-                            # 确保 root_path 和 screen_error 目录存在
-                            screen_error_path = os.path.join(self.root_path, run_count_str, "screen_error/")
-                            os.makedirs(screen_error_path, exist_ok=True)
-                            
-                            # 保存截图和布局
-                            screenshot_path = os.path.join(screen_error_path, f"{event_count}_device_{device.device_num}.png")
-                            xml_path = os.path.join(screen_error_path, f"{event_count}_device_{device.device_num}.xml")
-                            
-                            # 使用 screenshot_and_getstate 方法同时保存截图和布局
-                            device.screenshot_and_getstate(screen_error_path, event_count)
-                            
-                            # 记录当前事件信息
-                            event_info_path = os.path.join(self.root_path, run_count_str, "event_info_error")
-                            os.makedirs(event_info_path, exist_ok=True)
-                            
-                            with open(os.path.join(event_info_path, f"event_info_error_{event_count}_device_{device.device_num}.txt"), "w") as f:
-                                f.write(f"Run Count: {run_count}\n")
-                                f.write(f"Event Count: {event_count}\n")
-                                
-                                # 记录事件详细信息
-                                f.write(f"Action: {event.action}\n")
-                                
-                                # 记录视图信息（如果存在）
-                                if event.view is not None:
-                                    f.write("View Details:\n")
-                                    f.write(f"  Text: {event.view.text}\n")
-                                    f.write(f"  Description: {event.view.description}\n")
-                                    f.write(f"  Resource ID: {event.view.resourceId}\n")
-                                    f.write(f"  Package: {event.view.package}\n")
-                                    f.write(f"  Class Name: {event.view.className}\n")
-                                    f.write(f"  X: {event.view.x}, Y: {event.view.y}\n")
-                                    f.write(f"  Line: {event.view.line}\n")
-                                
-                                # 记录设备信息
-                                f.write("Device Details:\n")
-                                f.write(f"  Device Number: {device.device_num}\n")
-                                f.write(f"  Device Serial: {device.device_serial}\n")
-                                
-                                f.write(f"Base Device Success: {base_success}\n")
-                                
-                                # 记录基准设备的事件详细信息
-                                base_device = self.devices[0]
-                                f.write("\nBase Device Event Details:\n")
-                                f.write(f"  Base Device Number: {base_device.device_num}\n")
-                                f.write(f"  Base Device Serial: {base_device.device_serial}\n")
-                                
-                                # 记录基准设备当前事件的详细信息
-                                f.write("  Current Event Details:\n")
-                                f.write(f"    Action: {event.action}\n")
-                                
-                                # 记录基准设备当前事件的视图信息（如果存在）
-                                if event.view is not None:
-                                    f.write("    View Details:\n")
-                                    f.write(f"      Text: {event.view.text}\n")
-                                    f.write(f"      Description: {event.view.description}\n")
-                                    f.write(f"      Resource ID: {event.view.resourceId}\n")
-                                    f.write(f"      Package: {event.view.package}\n")
-                                    f.write(f"      Class Name: {event.view.className}\n")
-                                    f.write(f"      X: {event.view.x}, Y: {event.view.y}\n")
-                                    f.write(f"      Line: {event.view.line}\n")
-                                
-                                # 记录基准设备上一个事件的详细信息
-                                if self.last_event is not None:
-                                    f.write("  Last Event Details:\n")
-                                    f.write(f"    Last Action: {self.last_event.action}\n")
-                                    
-                                    if self.last_event.view is not None:
-                                        f.write("    Last View Details:\n")
-                                        f.write(f"      Last Text: {self.last_event.view.text}\n")
-                                        f.write(f"      Last Description: {self.last_event.view.description}\n")
-                                        f.write(f"      Last Resource ID: {self.last_event.view.resourceId}\n")
-                                        f.write(f"      Last Package: {self.last_event.view.package}\n")
-                                        f.write(f"      Last Class Name: {self.last_event.view.className}\n")
-                                        f.write(f"      Last X: {self.last_event.view.x}, Y: {self.last_event.view.y}\n")
-                                        f.write(f"      Last Line: {self.last_event.view.line}\n")
-                                
-                                # 保存上一个事件的截图和布局
-                                if self.last_event is not None:
-                                    try:
-                                        # 保存上一个事件的截图和布局
-                                        last_screenshot_path = os.path.join(screen_error_path, f"last_{event_count}_device_{device.device_num}.png")
-                                        device.screenshot_and_getstate(screen_error_path, event_count)
-                                        
-                                        # 保存上一个事件的基准设备截图和布局
-                                        base_device = self.devices[0]
-                                        last_base_screenshot_path = os.path.join(screen_error_path, f"last_base_{event_count}_device_{base_device.device_num}.png")
-                                        base_device.screenshot_and_getstate(screen_error_path, event_count)
-                                    except Exception as e:
-                                        print(f"Error saving last event info for device {device.device_num}: {e}")
-                                        
-                                        # 保存当前事件的基准设备截图和布局
-                                        base_device = self.devices[0]
-                                        base_screenshot_path = os.path.join(screen_error_path, f"base_{event_count}_device_{base_device.device_num}.png")
-                                        base_device.screenshot_and_getstate(screen_error_path, event_count)
-                        except Exception as e:
-                            print(f"Error saving device {device.device_num} info: {e}")
+                            # 记录视图信息（如果存在）
+                            if event.view is not None:
+                                f.write("View Details:\n")
+                                f.write(f"  Text: {event.view.text}\n")
+                                f.write(f"  Description: {event.view.description}\n")
+                                f.write(f"  Resource ID: {event.view.resourceId}\n")
+                                f.write(f"  Package: {event.view.package}\n")
+                                f.write(f"  Class Name: {event.view.className}\n")
+                                f.write(f"  X: {event.view.x}, Y: {event.view.y}\n")
+                                f.write(f"  Line: {event.view.line}\n")
                         
-                        # 记录错误事件
-                        self.utils.print_dividing_line(False, event_count, i)
-                        self.utils.write_event(
-                            event, i, self.devices[i].f_trace
-                        )
-                        self.utils.draw_event(event)
+                            # 记录设备信息
+                            f.write("Device Details:\n")
+                            f.write(f"  Device Number: {device.device_num}\n")
+                            f.write(f"  Device Serial: {device.device_serial}\n")
+                        
+                            f.write(f"Base Device Success: {base_success}\n")
+                        
+                            # 记录基准设备的事件详细信息
+                            base_device = self.devices[0]
+                            f.write("\nBase Device Event Details:\n")
+                            f.write(f"  Base Device Number: {base_device.device_num}\n")
+                            f.write(f"  Base Device Serial: {base_device.device_serial}\n")
                         
-                        # 检查是否重复
-                        if not self.checkduplicate():
-                            print("write error")
-                            self.utils.draw_error_frame()
-                            self.utils.write_error(
-                                i,
-                                run_count,
-                                self.devices[i].error_event_lists,
-                                self.devices[i].f_error,
-                                self.devices[i].error_num
-                            )
-                            self.devices[i].error_num += 1
+                            # 记录基准设备当前事件的详细信息
+                            f.write("  Current Event Details:\n")
+                            f.write(f"    Action: {event.action}\n")
+                        
+                            # 记录基准设备当前事件的视图信息（如果存在）
+                            if event.view is not None:
+                                f.write("    View Details:\n")
+                                f.write(f"      Text: {event.view.text}\n")
+                                f.write(f"      Description: {event.view.description}\n")
+                                f.write(f"      Resource ID: {event.view.resourceId}\n")
+                                f.write(f"      Package: {event.view.package}\n")
+                                f.write(f"      Class Name: {event.view.className}\n")
+                                f.write(f"      X: {event.view.x}, Y: {event.view.y}\n")
+                                f.write(f"      Line: {event.view.line}\n")
+                        
+                            # 记录基准设备上一个事件的详细信息
+                            if self.last_event is not None:
+                                f.write("  Last Event Details:\n")
+                                f.write(f"    Last Action: {self.last_event.action}\n")
                             
-                            # 保存状态并重启应用
-                            event_count = self.save_all_state(event_count)
-                            event_count = self.clear_and_restart_app(event_count, strategy)
-                            break  # 跳出循环，重新开始事件选择
-                
-                end_time = time.time()
-                # print(f"12.check other devices time: {end_time - now_start_time} seconds")
-
-                now_start_time = time.time()
-                # 如果所有未失败的设备都失败了，重启所有设备
-                if all_failed and newly_failed:
-                    print("All remaining devices have failed, restarting all devices")
-                    # 重置所有设备的失败状态
-                    for device in self.devices[1:]:
-                        if hasattr(device, 'has_failed'):
-                            delattr(device, 'has_failed')
-                    
-                    # 保存状态并重启所有设备
-                    event_count = self.save_all_state(event_count)
-                    event_count = self.clear_and_restart_app(event_count, strategy)
-                    continue
-                
-                end_time = time.time()
-                # print(f"13.check all failed time: {end_time - now_start_time} seconds")
-
-                
-                # 记录执行结果
-                now_start_time = time.time()
-                self.utils.print_dividing_line(True, event_count, self.devices[0].device_num)
-                end_time = time.time()
-                # print(f"14.print_dividing_line time: {end_time - now_start_time} seconds")
-                
-                # 记录基准设备的执行结果
-                now_start_time = time.time()
-                self.utils.write_read_event(
-                    None, event_count, event, "all device", self.devices[0].device_num
-                ) # 只记录base设备的事件
-                self.utils.write_event(event, self.devices[0].device_num, self.devices[0].f_trace)
+                                if self.last_event.view is not None:
+                                    f.write("    Last View Details:\n")
+                                    f.write(f"      Last Text: {self.last_event.view.text}\n")
+                                    f.write(f"      Last Description: {self.last_event.view.description}\n")
+                                    f.write(f"      Last Resource ID: {self.last_event.view.resourceId}\n")
+                                    f.write(f"      Last Package: {self.last_event.view.package}\n")
+                                    f.write(f"      Last Class Name: {self.last_event.view.className}\n")
+                                    f.write(f"      Last X: {self.last_event.view.x}, Y: {self.last_event.view.y}\n")
+                                    f.write(f"      Last Line: {self.last_event.view.line}\n")
+                        
+                            # 保存上一个事件的截图和布局
+                            if self.last_event is not None:
+                                try:
+                                    # 保存上一个事件的截图和布局
+                                    last_screenshot_path = os.path.join(screen_error_path, f"last_{event_count}_device_{device.device_num}.png")
+                                    device.screenshot_and_getstate(screen_error_path, event_count)
+                                
+                                    # 保存上一个事件的基准设备截图和布局
+                                    base_device = self.devices[0]
+                                    last_base_screenshot_path = os.path.join(screen_error_path, f"last_base_{event_count}_device_{base_device.device_num}.png")
+                                    base_device.screenshot_and_getstate(screen_error_path, event_count)
+                                except Exception as e:
+                                    print(f"Error saving last event info for device {device.device_num}: {e}")
+                                
+                                    # 保存当前事件的基准设备截图和布局
+                                    base_device = self.devices[0]
+                                    base_screenshot_path = os.path.join(screen_error_path, f"base_{event_count}_device_{base_device.device_num}.png")
+                                    base_device.screenshot_and_getstate(screen_error_path, event_count)
+                    except Exception as e:
+                        print(f"Error saving device {device.device_num} info: {e}")
                 
-                end_time = time.time()
-                # print(f"15.write_read_event time: {end_time - now_start_time} seconds")
-
-                now_start_time = time.time()
-                # 记录其他设备的执行结果（只记录未失败的设备）
-                for i in range(1, len(self.devices)):
-                    if not (hasattr(self.devices[i], 'has_failed') and self.devices[i].has_failed):
-                        self.utils.write_event(event, i, self.devices[i].f_trace)
+                    # 记录错误事件
+                    self.utils.print_dividing_line(False, event_count, i)
+                    self.utils.write_event(
+                        event, i, self.devices[i].f_trace
+                    )
+                    self.utils.draw_event(event)
                 
-                end_time = time.time()
-                # print(f"16.write_event time: {end_time - now_start_time} seconds")
+                    # 检查是否重复
+                    if not self.checkduplicate():
+                        print("write error")
+                        self.utils.draw_error_frame()
+                        self.utils.write_error(
+                            i,
+                            run_count,
+                            self.devices[i].error_event_lists,
+                            self.devices[i].f_error,
+                            self.devices[i].error_num
+                        )
+                        self.devices[i].error_num += 1
+                    
+                        # 保存状态并重启应用
+                        event_count = self.save_all_state(event_count)
+                        event_count = self.clear_and_restart_app(event_count, strategy)
+                        break  # 跳出循环，重新开始事件选择
+        
 
-                now_start_time = time.time()
-                # 保存所有设备的状态
+        with self.profiler.span("check_all_failed"):
+            # 如果所有未失败的设备都失败了，重启所有设备
+            if all_failed and newly_failed:
+                print("All remaining devices have failed, restarting all devices")
+                # 重置所有设备的失败状态
+                for device in self.devices[1:]:
+                    if hasattr(device, 'has_failed'):
+                        delattr(device, 'has_failed')
+            
+                # 保存状态并重启所有设备
                 event_count = self.save_all_state(event_count)
-                end_time = time.time()
-                # print(f"17.save_all_state time: {end_time - now_start_time} seconds")
-
-                end_time = time.time()
-                print(f"one run time: {end_time - start_time} seconds")
-
-                # injecte a setting change
-                # event=self.injector.inject_setting_during_run(event_count,strategy,request_flag)
-                # if event is not None:
-                #     event_count = self.write_draw_and_save_one(event,event_count)
-
-            # event=self.injector.change_setting_after_run(event_count,strategy)
-            # if event is not None:
-            #     event_count = self.write_draw_and_save_one(event,event_count)
+                event_count = self.clear_and_restart_app(event_count, strategy)
+                return event_count
+        
 
         
-            # at the end of each run, generate a html file
-            for device in self.guest_devices:
-                self.utils.generate_html(device.path, device.path, run_count)
-            
+        # 记录执行结果
+        with self.profiler.span("print_dividing_line"):
+            self.utils.print_dividing_line(True, event_count, self.devices[0].device_num)
         
+        # 记录基准设备的执行结果
+        with self.profiler.span("write_read_event"):
+            self.utils.write_read_event(
+                None, event_count, event, "all device", self.devices[0].device_num
+            ) # 只记录base设备的事件
+            self.utils.write_event(event, self.devices[0].device_num, self.devices[0].f_trace)
+        
+
+        with self.profiler.span("write_event"):
+            # 记录其他设备的执行结果（只记录未失败的设备）
+            for i in range(1, len(self.devices)):
+                if not (hasattr(self.devices[i], 'has_failed') and self.devices[i].has_failed):
+                    self.utils.write_event(event, i, self.devices[i].f_trace)
+        
+
+        with self.profiler.span("save_all_state"):
+            # 保存所有设备的状态
+            event_count = self.save_all_state(event_count)
+        return event_count
@@ -0,0 +1,68 @@
+from xml.parsers import expat
+
+from view import View
+
+
+class ExpatParser(object):
+    """
+    Build the View tree of a hierarchy dump in a single expat pass.
+
+    Produces the same views, in the same order and with the same instance
+    numbers, as State's line parser, but reads every attribute from the
+    parser instead of searching the line for each of them. Attribute values
+    come out unescaped (``&amp;`` -> ``&``); ``view.line`` stays the raw line,
+    so the dump must keep one node per line as uiautomator2 writes it.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def parse(self, lines):
+        if isinstance(lines, str):
+            xml = lines
+            self.lines = xml.split('\n')
+        elif lines and lines[0].endswith('\n'):
+            # readlines(): the lines keep their line ending, as with the line parser
+            xml = ''.join(lines)
+            self.lines = lines
+        else:
+            xml = '\n'.join(lines)
+            self.lines = xml.split('\n')
+        self.all_views = []
+        self.stack = []
+        self.leaf = []
+
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.Parse(xml, True)
+        return self.all_views
+
+    def start_element(self, name, attributes):
+        if name != 'node':
+            return
+        state = self.state
+        line = self.lines[self.parser.CurrentLineNumber - 1]
+        father = self.stack[-1] if self.stack else None
+        view = View(line, father, [], attributes)
+        view = state.get_instance(view)
+        leaf = '/>' in line
+        if leaf:
+            view.compute_hash(self.state.mask)
+            if father is not None:
+                father.add_son(view)
+            self.all_views.append(view)
+        self.stack.append(view)
+        self.leaf.append(leaf)
+
+    def end_element(self, name):
+        if name != 'node':
+            return
+        view = self.stack.pop()
+        if self.leaf.pop():
+            return
+        view = self.state.get_instance(view)
+        view.compute_hash(self.state.mask)
+        self.all_views.append(view)
+        if self.stack:
+            self.stack[-1].add_son(view)
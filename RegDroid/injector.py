@@ -3,6 +3,7 @@ import time
 import random
 
 from event import Event
+from settle import SettleDetector
 from utils import Utils
 
 
@@ -11,7 +12,7 @@ class Injector(object):
     The strategy of changing setting
     """
 
-    def __init__(self, devices, app, strategy_list, emulator_path, android_system, root_path, resource_path, testcase_count, event_num, timeout, setting_random_denominator, rest_interval, choice):
+    def __init__(self, devices, app, strategy_list, emulator_path, android_system, root_path, resource_path, testcase_count, event_num, timeout, setting_random_denominator, rest_interval, choice, settle=None):
 
         self.timeout = timeout
         self.app = app
@@ -25,9 +26,17 @@ class Injector(object):
         self.event_num = event_num
         self.setting_random_denominator = setting_random_denominator
         self.rest_interval = rest_interval
+        self.settle = settle if settle is not None else SettleDetector(rest_interval, samples=0)
         self.utils = Utils(devices=devices)
         self.choice = choice
 
+    def wait_idle(self, device=None):
+        # let the devices settle after a setting change
+        if device is not None:
+            self.settle.wait(device)
+        else:
+            self.settle.wait_all(self.devices)
+
     def change_setting_before_run(self, event_count, strategy):
         print("Change setting before run")
         if strategy == "network_immediate_1":
@@ -269,7 +278,7 @@ class Injector(object):
         device1(text="About emulated device").wait(timeout=3.0)
         device1(text="About emulated device").click()
         for _ in range(7):
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
             device1(text="Build number").click()
         device1.press("back")
         device1(text="Developer options").wait(timeout=3.0)
@@ -278,10 +287,10 @@ class Injector(object):
         device1(text="Don’t keep activities").wait(timeout=3.0)
         device1(text="Don’t keep activities").click()
         device0.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         for _ in range(3):
             device1.press("back")
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
 
     def network_immediate_1(self):
         device = self.devices[1]
@@ -289,16 +298,16 @@ class Injector(object):
         self.devices[0].use.open_quick_settings()
         device.use(description="Airplane mode").wait()
         device.use(description="Airplane mode").click()
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device.use(description="Airplane mode").wait()
         device.use(description="Airplane mode").click()
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device.use.press("back")
         self.devices[0].use.press("back")
         self.devices[1].wifi_state = True
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
 
     def network_lazy_1(self):
         device = self.devices[1]
@@ -314,10 +323,10 @@ class Injector(object):
             self.devices[1].wifi_state = True
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
 
     def network_lazy_2(self):
         device = self.devices[1]
@@ -343,10 +352,10 @@ class Injector(object):
             self.devices[1].wifi_state = True
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
 
     def location_lazy_1(self):
         device0 = self.devices[0].use
@@ -364,7 +373,7 @@ class Injector(object):
         device1(text="Security & Location").click()
         device1(text="Location").wait(timeout=3.0)
         device1(text="Location").click()
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         if self.devices[1].gps_state is True and device1(text="ON").count > 0:
             device1(text="ON").click()
             self.devices[1].gps_state = False
@@ -376,14 +385,14 @@ class Injector(object):
         device1.set_orientation(orientation2)
         backtime = 0
         device1.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device1.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         while backtime < 2:
             backtime = backtime+1
             device0.press("back")
             device1.press("back")
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
 
     def location_lazy_2(self):
         device0 = self.devices[0].use
@@ -426,14 +435,14 @@ class Injector(object):
             if device1(text="AGREE").count > 0:
                 device1(text="AGREE").click()
             self.devices[1].gps_state = True
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         print("End location change")
         device0.set_orientation(orientation1)
         device1.set_orientation(orientation2)
         for _ in range(4):
             device0.press("back")
             device1.press("back")
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
 
     def sound_lazy_1(self):
         device = self.devices[1]
@@ -457,10 +466,10 @@ class Injector(object):
             self.devices[1].sound_state = True
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
 
     def battery_immediate_1(self):
         device = self.devices[1]
@@ -521,10 +530,10 @@ class Injector(object):
 
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
 
     def battery_lazy_1(self):
         device = self.devices[1]
@@ -540,15 +549,15 @@ class Injector(object):
             self.devices[1].battery_state = True
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device.use.press("back")
         self.devices[0].use.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
 
     def display_immediate_2(self):
         self.devices[1].use(
             resourceId="com.android.systemui:id/recent_apps").long_click()
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         self.devices[1].use(
             resourceId="com.android.systemui:id/recent_apps").long_click()
 
@@ -558,7 +567,7 @@ class Injector(object):
         device.use.set_orientation("n")
         device.use.set_orientation("l")
         device.use.set_orientation(orientation1)
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
 
     def permssion_lazy_1(self):
         last_activity = self.devices[1].use.app_current()['activity']
@@ -600,7 +609,7 @@ class Injector(object):
         device1(scrollable=True, instance=0).scroll.to(text="Permissions")
         device0(text="Permissions").click()
         device1(text="Permissions").click()
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         while device0(text="OFF", className="android.widget.Switch").count > 0:
             try:
                 device0(text="OFF", className="android.widget.Switch").click()
@@ -617,7 +626,7 @@ class Injector(object):
         for _ in range(5):
             device0.press("back")
             device1.press("back")
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
 
     def language(self):
         device0 = self.devices[0].use
@@ -627,7 +636,7 @@ class Injector(object):
         device1.set_orientation("n")
 
         if self.devices[1].language == "en":
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
             print("System")
             device1(scrollable=True, instance=0).scroll.to(text="System")
             device1(text="System").click()
@@ -644,7 +653,7 @@ class Injector(object):
             device1(text="中国").click()
             device1(description="More options").wait(timeout=3.0)
             device1(description="More options").click()
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
             device1.click(796, 144)
             device1(text="English (United States)").wait(timeout=3.0)
             device1(text="English (United States)").click()
@@ -664,7 +673,7 @@ class Injector(object):
             device1(text="添加语言").click()
             device1(text="English (United States)").click()
             device1(description="更多选项").click()
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
             device1.click(796, 144)
             device1(text="简体中文（中国）").wait(timeout=3.0)
             device1(text="简体中文（中国）").click()
@@ -673,13 +682,13 @@ class Injector(object):
             device1(text="确定").wait(timeout=3.0)
             device1(text="确定").click()
             self.devices[1].language = "en"
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         device0.press("back")
         device0.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         for _ in range(4):
             device1.press("back")
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
 
     def time(self):
         device0 = self.devices[0].use
@@ -689,7 +698,7 @@ class Injector(object):
         device1.set_orientation("n")
 
         if self.devices[1].hourformat == "12h":
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
             print("System")
             device1(scrollable=True, instance=0).scroll.to(text="System")
             device1(text="System").click()
@@ -699,7 +708,7 @@ class Injector(object):
             device1(text="Use 24-hour format").click()
             self.devices[1].hourformat = "24h"
         elif self.devices[1].hourformat == "24h":
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
             print("System")
             device1(scrollable=True, instance=0).scroll.to(text="System")
             device1(text="System").click()
@@ -711,10 +720,10 @@ class Injector(object):
 
         device0.press("back")
         device1.press("back")
-        time.sleep(self.rest_interval*1)
+        self.wait_idle()
         for _ in range(2):
             device1.press("back")
-            time.sleep(self.rest_interval*1)
+            self.wait_idle()
 
     def clear_and_start_setting(self, device0, device1):
         device0.set_orientation("n")
@@ -731,23 +740,23 @@ class Injector(object):
     def init_setting_emulator8(self):
         for device in self.devices:
             device.use.open_quick_settings()
-            time.sleep(self.rest_interval*1)
+            self.wait_idle(device)
             lines = device.use.dump_hierarchy().splitlines()
             for line in lines:
                 if 'android.widget.Switch' in line and "content-desc=\"Airplane mode" in line and "text=\"On" in line:
                     device.use(description="Airplane mode").click()
-                    time.sleep(self.rest_interval*1)
+                    self.wait_idle(device)
                 elif 'android.widget.Switch' in line and "content-desc=\"Airplane mode" in line and "text=\"On" in line:
                     device.use(description="Airplane mode").click()
-                    time.sleep(self.rest_interval*1)
+                    self.wait_idle(device)
                 elif 'android.widget.Switch' in line and "content-desc=\"Battery Saver" in line and "text=\"On" in line:
                     device.use(description="Battery Saver").click()
-                    time.sleep(self.rest_interval*1)
+                    self.wait_idle(device)
                 elif 'android.widget.TextView' in line and "text=\"Alarms only" in line:
                     device.use(text="Alarms only").click()
                     device.use(text="ON").wait()
                     device.use(text="ON").click()
                     device.use(text="DONE").wait()
                     device.use(text="DONE").click()
-                    time.sleep(self.rest_interval*1)
+                    self.wait_idle(device)
             device.use.press("home")
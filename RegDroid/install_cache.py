@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+
+VERSION_CODE = re.compile(r'versionCode=(\d+)')
+LAST_UPDATE_TIME = re.compile(r'lastUpdateTime=([^\r\n]+)')
+PERMISSION_STATE = re.compile(r'^(\s+)([\w.]+): granted=')
+
+
+def runtime_permissions(dumpsys):
+    # the permissions of the "runtime permissions:" sections of dumpsys package (all users)
+    permissions = set()
+    section_indent = None
+    for line in (dumpsys or "").splitlines():
+        if line.strip() == "runtime permissions:":
+            section_indent = len(line) - len(line.lstrip())
+            continue
+        if section_indent is None:
+            continue
+        match = PERMISSION_STATE.match(line)
+        if match is None or len(match.group(1)) <= section_indent:
+            section_indent = None
+            continue
+        permissions.add(match.group(2))
+    return sorted(permissions)
+
+
+def package_info(dumpsys, sha256sum=None):
+    """
+    versionCode and lastUpdateTime from the output of dumpsys package, and
+    the sha256 of the installed base.apk from the output of sha256sum.
+    None values when the package is not installed (or no sha256sum).
+    runtimePermissions: the runtime (dangerous) permissions the package requests.
+    """
+    version_code = VERSION_CODE.search(dumpsys or "")
+    last_update_time = LAST_UPDATE_TIME.search(dumpsys or "")
+    digest = (sha256sum or "").split()
+    return {
+        "versionCode": version_code.group(1) if version_code else None,
+        "lastUpdateTime": last_update_time.group(1).strip() if last_update_time else None,
+        "sha256": digest[0] if digest and re.fullmatch(r'[0-9a-f]{64}', digest[0]) else None,
+        "runtimePermissions": runtime_permissions(dumpsys),
+    }
+
+
+class InstallCache(object):
+    """
+    The sha256 of the APK installed on each device serial, with the
+    versionCode and lastUpdateTime the device reported after the install.
+    Saved as json in path, shared by the threads provisioning the devices.
+
+    A device whose dumpsys still reports them (and whose base.apk has the
+    same sha256) has the same install: its data is cleared instead of
+    reinstalling the app. Any reinstall changes lastUpdateTime.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (apk path, size, mtime) -> sha256, so an APK is hashed once per run
+        self.digests = {}
+        self.records = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.records = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring install cache {path}: {e}")
+
+    def apk_digest(self, apk):
+        status = os.stat(apk)
+        key = (os.path.abspath(apk), status.st_size, status.st_mtime)
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(apk, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            with self.lock:
+                self.digests[key] = digest
+        return digest
+
+    def get(self, serial, package):
+        with self.lock:
+            return self.records.get(serial, {}).get(package)
+
+    def matches(self, record, info):
+        # info: package_info() of the device now
+        return (
+            info["versionCode"] is not None
+            and info["versionCode"] == record["versionCode"]
+            and info["lastUpdateTime"] == record["lastUpdateTime"]
+            and (info["sha256"] is None or info["sha256"] == record["sha256"])
+        )
+
+    def put(self, serial, package, record):
+        with self.lock:
+            self.records.setdefault(serial, {})[package] = record
+            self.save()
+
+    def forget(self, serial, package):
+        with self.lock:
+            if self.records.get(serial, {}).pop(package, None) is not None:
+                self.save()
+
+    def save(self):
+        # under the lock
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.records, f, indent=1)
+        os.replace(temp_path, self.path)
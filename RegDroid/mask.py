@@ -0,0 +1,148 @@
+import hashlib
+import json
+import re
+from sys import intern
+
+
+class ComparisonMask(object):
+    """
+    What State.same() and the dedup store ignore when comparing screens.
+
+    spec (all keys optional):
+        ignore_attributes: attribute names left out of the comparison, e.g. ["text"]
+        ignore_packages: regexes of packages whose top-level views are not compared
+        ignore_resource_ids: regexes of resource-ids whose views (with their sons) are not compared
+        bounds_grid: bounds are snapped to a grid of this many pixels (each
+            value floor-divided by it): bounds in the same cells compare equal.
+            This is not a tolerance, a one pixel move across a cell edge is a
+            change; a tolerance would not survive hashing (it is not transitive).
+
+    The spec is compiled once. Views are normalized when they are hashed at
+    parse time (view.key), so comparing two states costs the same with or
+    without a mask.
+    """
+
+    DEFAULT_SPEC = {
+        "ignore_attributes": [],
+        "ignore_packages": [r"com\.google\.android\.inputmethod\.latin", r"com\.android\.systemui"],
+        "ignore_resource_ids": [],
+        "bounds_grid": 0,
+    }
+
+    def __init__(self, spec=None):
+        spec = dict(self.DEFAULT_SPEC, **(spec or {}))
+        self.spec = spec
+        self.ignore_attributes = list(spec["ignore_attributes"])
+        self.bounds_grid = int(spec["bounds_grid"] or 0)
+
+        self.package_pattern = self.compile_any(spec["ignore_packages"])
+        self.resource_id_pattern = self.compile_any(spec["ignore_resource_ids"])
+        # removes ignored attributes from a line
+        self.attribute_pattern = None
+        if self.ignore_attributes:
+            names = "|".join(re.escape(name) for name in self.ignore_attributes)
+            self.attribute_pattern = re.compile(r'\s(?:%s)="[^"]*"' % names)
+        self.bounds_pattern = re.compile(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]')
+        # does the key of a view differ from its line at all
+        self.normalizes = bool(self.attribute_pattern or self.bounds_grid)
+
+        # top-level views of ignored packages and views of ignored resource-ids,
+        # dropped from a raw dump with their sons before it is hashed
+        packages = "|".join(spec["ignore_packages"])
+        self.dump_package_pattern = None
+        if packages:
+            self.dump_package_pattern = re.compile(r'package="(?:%s)"' % packages)
+        resource_ids = "|".join(spec["ignore_resource_ids"])
+        self.dump_resource_id_pattern = None
+        if resource_ids:
+            self.dump_resource_id_pattern = re.compile(r'resource-id="(?:%s)"' % resource_ids)
+
+    @staticmethod
+    def compile_any(patterns):
+        if not patterns:
+            return None
+        return re.compile("|".join("(?:%s)" % pattern for pattern in patterns))
+
+    @staticmethod
+    def load(path):
+        if path is None:
+            return DEFAULT_MASK
+        with open(path, 'r', encoding='utf-8') as f:
+            return ComparisonMask(json.load(f))
+
+    def snap_bounds(self, match):
+        grid = self.bounds_grid
+        return "[%d,%d][%d,%d]" % tuple(int(value) // grid for value in match.groups())
+
+    def normalize(self, text):
+        if self.attribute_pattern is not None:
+            text = self.attribute_pattern.sub('', text)
+        if self.bounds_grid:
+            text = self.bounds_pattern.sub(self.snap_bounds, text)
+        return text
+
+    def view_key(self, view):
+        """
+        Comparison key of a view: its line with the ignored attributes removed,
+        or None when the view is ignored altogether
+        """
+        if self.resource_id_pattern is not None and self.resource_id_pattern.fullmatch(view.resourceId):
+            return None
+        if not self.normalizes:
+            return view.line
+        # the indentation stays: it is the depth of the view
+        return intern(self.normalize(view.line.rstrip('\r\n')))
+
+    def compares(self, view):
+        # top-level views of ignored packages are not compared
+        if view.key is None:
+            return False
+        return self.package_pattern is None or not self.package_pattern.fullmatch(view.package)
+
+    def ignored_line(self, line):
+        # the line of a view State.same() does not compare, with its sons
+        if '<node ' not in line:
+            return False
+        package_pattern = self.dump_package_pattern
+        if package_pattern is not None and line.find('<node ') == 2 and package_pattern.search(line):
+            # a top-level view (View.level 2), as compares() sees it
+            return True
+        resource_id_pattern = self.dump_resource_id_pattern
+        return resource_id_pattern is not None and resource_id_pattern.search(line) is not None
+
+    def drop_ignored_subtrees(self, xml):
+        # the lines of the views compares() and view_key ignore and of their sons
+        if not any(
+            pattern is not None and pattern.search(xml) is not None
+            for pattern in (self.dump_package_pattern, self.dump_resource_id_pattern)
+        ):
+            return xml
+        lines = []
+        # open nodes of the ignored subtree being skipped
+        depth = 0
+        for line in xml.split('\n'):
+            if depth:
+                if '<node ' in line and '/>' not in line:
+                    depth += 1
+                elif '</node>' in line:
+                    depth -= 1
+                continue
+            if self.ignored_line(line):
+                if '/>' not in line:
+                    depth = 1
+                continue
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def dump_key(self, xml):
+        """
+        Fast hash of a raw hierarchy dump with the ignored views and attributes
+        normalized away: an unchanged key means the screen did not change
+        """
+        xml = xml.replace('\r\n', '\n')
+        xml = self.drop_ignored_subtrees(xml)
+        xml = self.normalize(xml)
+        return hashlib.blake2b(xml.encode('utf-8'), digest_size=16).digest()
+
+
+DEFAULT_MASK = ComparisonMask()
@@ -0,0 +1,217 @@
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from mask import ComparisonMask
+from state import State
+from tree_diff import diff_states, save_diff
+
+
+# one line per saved state of a device in a run, written by Executor.record_capture,
+# one per state the online check flagged as different from the base's (Executor.flag_for_oracle)
+# and one per local action without a visible effect (Executor.record_no_effect)
+CAPTURES_PATTERN = "captures_*.jsonl"
+ORACLE_FILE = "oracle_%s.jsonl"
+
+
+def capture_record(device, event_count, xml_path, capture):
+    return {
+        "event_count": event_count,
+        "device_num": device.device_num,
+        "serial": device.device_serial,
+        "xml": os.path.relpath(xml_path, device.path),
+        "dump_key": capture.dump_key.hex(),
+        "fingerprint": capture.state.fingerprint,
+    }
+
+
+def flag_record(device, event_count, base_state, state):
+    return {
+        "flag": True,
+        "event_count": event_count,
+        "device_num": device.device_num,
+        "serial": device.device_serial,
+        "base_fingerprint": base_state.fingerprint,
+        "fingerprint": state.fingerprint,
+    }
+
+
+def no_effect_record(device, event):
+    view = event.view
+    return {
+        "no_effect": event.action,
+        "event_count": event.event_count,
+        "device_num": device.device_num,
+        "serial": device.device_serial,
+        "line": view.line if view is not None else None,
+    }
+
+
+def load_captures(path, flags=None):
+    """
+    {event_count: record} of a captures file, the last record of an event
+    count wins (a state saved again after waiting for it to load).
+    The flag records go to the flags list when one is given.
+    """
+    captures = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run
+                continue
+            if record.get("flag"):
+                if flags is not None:
+                    flags.append(record)
+                continue
+            if "no_effect" in record:
+                continue
+            captures[record["event_count"]] = record
+    return captures
+
+
+def find_pairs(paths):
+    """
+    (base captures, guest captures) of every guest run found under paths.
+    The base is the device 0 file of the same run directory, or else of a
+    run directory with the same run count.
+    """
+    files = []
+    for path in paths:
+        files.extend(glob.glob(os.path.join(path, "**", CAPTURES_PATTERN), recursive=True))
+    bases_by_dir = {}
+    bases_by_run = {}
+    guests = []
+    for path in sorted(set(files)):
+        captures = load_captures(path)
+        if not captures:
+            continue
+        run_dir = os.path.dirname(path)
+        if next(iter(captures.values()))["device_num"] == 0:
+            bases_by_dir[run_dir] = path
+            bases_by_run.setdefault(os.path.basename(run_dir), path)
+        else:
+            guests.append(path)
+    pairs = []
+    for path in guests:
+        run_dir = os.path.dirname(path)
+        base = bases_by_dir.get(run_dir) or bases_by_run.get(os.path.basename(run_dir))
+        if base is None:
+            print(f"No base device captures for {path}")
+            continue
+        pairs.append((base, path))
+    return pairs
+
+
+def read_state(captures_path, record, parser, mask):
+    path = os.path.join(os.path.dirname(captures_path), record["xml"])
+    with open(path, 'r', encoding='utf-8') as f:
+        return State(f.read().splitlines(), parser, mask)
+
+
+def compare_pair(base_path, guest_path, mask_spec=None, parser="line"):
+    """
+    Compare the states a guest saved with the base states of the same event
+    counts. Equal fingerprints are the same state without parsing anything.
+    Writes oracle_<serial>.jsonl (and a tree diff per different state) next
+    to the guest's captures, returns its findings.
+
+    The pairs the run flagged are compared too: the two devices may have
+    saved those states under different event counts.
+    """
+    mask = ComparisonMask.load(mask_spec)
+    base_captures = load_captures(base_path)
+    flags = []
+    guest_captures = load_captures(guest_path, flags)
+    guest_dir = os.path.dirname(guest_path)
+    pairs = [
+        (event_count, base_captures[event_count], guest_captures[event_count])
+        for event_count in sorted(set(base_captures) & set(guest_captures))
+    ]
+    base_by_fingerprint = {record["fingerprint"]: record for record in base_captures.values()}
+    guest_by_fingerprint = {record["fingerprint"]: record for record in guest_captures.values()}
+    compared = {(base_record["fingerprint"], guest_record["fingerprint"]) for _, base_record, guest_record in pairs}
+    for flag in flags:
+        key = (flag["base_fingerprint"], flag["fingerprint"])
+        if key in compared:
+            continue
+        compared.add(key)
+        if key[0] not in base_by_fingerprint or key[1] not in guest_by_fingerprint:
+            print(f"No captures of the states flagged at event {flag['event_count']} of {guest_path}")
+            continue
+        pairs.append((flag["event_count"], base_by_fingerprint[key[0]], guest_by_fingerprint[key[1]]))
+    findings = []
+    for event_count, base_record, guest_record in pairs:
+        if base_record["fingerprint"] == guest_record["fingerprint"]:
+            continue
+        try:
+            base_state = read_state(base_path, base_record, parser, mask)
+            guest_state = read_state(guest_path, guest_record, parser, mask)
+        except OSError as e:
+            print(f"Error reading the states of event {event_count}: {e}")
+            continue
+        if base_state.same(guest_state):
+            continue
+        diff_path = os.path.splitext(os.path.join(guest_dir, guest_record["xml"]))[0] + "_diff.json"
+        save_diff(diff_states(base_state, guest_state), diff_path)
+        findings.append({
+            "event_count": event_count,
+            "device_num": guest_record["device_num"],
+            "serial": guest_record["serial"],
+            "base_xml": os.path.relpath(os.path.join(os.path.dirname(base_path), base_record["xml"]), guest_dir),
+            "guest_xml": guest_record["xml"],
+            "diff": os.path.relpath(diff_path, guest_dir),
+            # the same divergence in another run has the same signature
+            "signature": base_state.fingerprint + ":" + guest_state.fingerprint,
+        })
+    serial = next(iter(guest_captures.values()))["serial"]
+    with open(os.path.join(guest_dir, ORACLE_FILE % serial), 'w', encoding='utf-8') as f:
+        for finding in findings:
+            f.write(json.dumps(finding) + '\n')
+    return findings
+
+
+def run_oracle(paths, mask_spec=None, parser="line", processes=None):
+    """
+    Compare every guest run under paths with its base run, one process per
+    (base, guest) pair in a pool. Returns the findings of all pairs.
+    """
+    pairs = find_pairs(paths)
+    if not pairs:
+        return []
+    findings = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(compare_pair, base, guest, mask_spec, parser): guest for base, guest in pairs}
+        for future, guest in futures.items():
+            try:
+                findings.extend(future.result())
+            except Exception as e:
+                print(f"Error comparing {guest}: {e}")
+    return findings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the states recorded by the guest devices with the base device's")
+    parser.add_argument("paths", nargs="+", help="output or run directories containing captures_*.jsonl")
+    parser.add_argument("-mask_spec", action="store", dest="mask_spec", default=None,
+                        help="Json file of what state comparison ignores, as for start.py")
+    parser.add_argument("-parser", action="store", dest="parser", default="line", choices=State.PARSERS,
+                        help="hierarchy parser used to read the states")
+    parser.add_argument("-processes", action="store", dest="processes", type=int, default=None,
+                        help="size of the process pool, default one per core")
+    options = parser.parse_args()
+    findings = run_oracle(options.paths, options.mask_spec, options.parser, options.processes)
+    signatures = {finding["signature"] for finding in findings}
+    print(f"Oracle: {len(findings)} different states, {len(signatures)} distinct")
+    for finding in findings:
+        print(f"  event {finding['event_count']} device {finding['device_num']}: {finding['diff']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import json
+import re
+
+from state import State
+
+
+class PermissionHandler(object):
+    """
+    Click through permission dialogs using one hierarchy dump per round
+    instead of asking uiautomator2 about every candidate text.
+
+    spec (all keys optional):
+        gate_packages: packages of the dialogs; the gated rules are only
+            tried on a dump mentioning one of them. Empty list = always look.
+        rules: ordered list of {"text": ..., "package": regex, "class": regex,
+            "gate": bool}, the first rule matching a view of the dump is
+            clicked. Only text is required; it is matched exactly, like text=
+            selectors. "gate": false tries the rule on any screen (the
+            onboarding buttons of the app itself), default true.
+            A dump containing none of the texts of the rules left to try is
+            not parsed.
+        max_attempts: how many dialogs in a row are handled
+    """
+
+    DEFAULT_SPEC = {
+        "gate_packages": [
+            "com.google.android.permissioncontroller",
+            "com.android.permissioncontroller",
+            "com.android.packageinstaller",
+            "com.google.android.packageinstaller",
+        ],
+        "rules": [
+            {"text": "OK", "gate": False},
+            {"text": "ALLOW"},
+            {"text": "允许"},
+            {"text": "确定", "gate": False},
+            {"text": "继续", "gate": False},
+            {"text": "GRANT"},
+            {"text": "Get Started", "gate": False},
+        ],
+        "max_attempts": 5,
+    }
+
+    def __init__(self, spec=None, settle=None, parser="line", mask=None):
+        spec = dict(self.DEFAULT_SPEC, **(spec or {}))
+        self.spec = spec
+        self.settle = settle
+        self.parser = parser
+        # ComparisonMask of the executor, so the dumps are parsed as everywhere else
+        self.mask = mask
+        self.max_attempts = spec["max_attempts"]
+        self.gate = ['package="%s"' % package for package in spec["gate_packages"]]
+        self.rules = [
+            (
+                rule["text"],
+                re.compile(rule["package"]) if rule.get("package") else None,
+                re.compile(rule["class"]) if rule.get("class") else None,
+                rule.get("gate", True),
+            )
+            for rule in spec["rules"]
+        ]
+
+    @staticmethod
+    def load(path, settle=None, parser="line", mask=None):
+        if path is None:
+            return PermissionHandler(settle=settle, parser=parser, mask=mask)
+        with open(path, 'r', encoding='utf-8') as f:
+            return PermissionHandler(json.load(f), settle=settle, parser=parser, mask=mask)
+
+    def find_target(self, xml):
+        """
+        The view to click in a dump, or None
+        """
+        gate_open = not self.gate or any(package in xml for package in self.gate)
+        rules = [rule for rule in self.rules if (gate_open or not rule[3]) and rule[0] in xml]
+        if not rules:
+            return None
+        state = State(xml.splitlines(), self.parser, self.mask)
+        for text, package, class_name, _ in rules:
+            for view in state.all_views:
+                if view.text != text:
+                    continue
+                if package is not None and not package.fullmatch(view.package):
+                    continue
+                if class_name is not None and not class_name.fullmatch(view.className):
+                    continue
+                return view
+        return None
+
+    def handle(self, device, xml=None):
+        """
+        Click through the dialogs on the device, returns how many were clicked.
+        xml: a dump just taken, used for the first round
+        """
+        clicked = 0
+        while clicked < self.max_attempts:
+            if xml is None:
+                xml = device.use.dump_hierarchy()
+            target = self.find_target(xml)
+            if target is None:
+                break
+            print(f"Clicking permission: {target.text}")
+            device.use.click(target.x, target.y)
+            clicked += 1
+            # 等待权限处理
+            xml = self.settle.wait(device) if self.settle is not None else None
+        return clicked
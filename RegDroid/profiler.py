@@ -0,0 +1,184 @@
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+
+class Span(object):
+    """
+    One timed phase, used as a context manager
+    """
+
+    __slots__ = ('profiler', 'name', 'device', 'start')
+
+    def __init__(self, profiler, name, device):
+        self.profiler = profiler
+        self.name = name
+        self.device = device
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
+
+    def stop(self):
+        self.profiler.record(self.name, self.device, self.start, time.perf_counter())
+
+
+class NullSpan(object):
+    # what span() returns when profiling is off: nothing is timed or kept
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def percentile(values, p):
+    # nearest rank on sorted values
+    if not values:
+        return 0.0
+    index = max(0, min(len(values), int(math.ceil(p / 100.0 * len(values)))) - 1)
+    return values[index]
+
+
+class StepProfiler(object):
+    """
+    Time the phases of a step, overall and per device.
+
+        with self.profiler.span("update_all_state"):
+            ...
+        with self.profiler.span("execute_event", device):
+            ...
+
+    summary() gives count/total/mean/p50/p95/max in seconds for every phase
+    and every (phase, device), dump() writes it as json and, with trace on,
+    a Chrome trace-event file (chrome://tracing or Perfetto) with one row
+    per thread.
+
+    Disabled, span() returns a shared no-op context manager, so instrumented
+    code pays one method call per phase.
+    """
+
+    def __init__(self, enabled=False, trace=False):
+        self.enabled = enabled
+        self.trace = enabled and trace
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # {phase: [seconds]} and {(phase, device serial): [seconds]}
+        self.durations = {}
+        self.device_durations = {}
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def span(self, name, device=None):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, device)
+
+    def wrap(self, name, func, device=None):
+        # func timed as a span on every call, func itself when disabled
+        if not self.enabled:
+            return func
+
+        @functools.wraps(func)
+        def timed(*args):
+            with self.span(name, device):
+                return func(*args)
+        return timed
+
+    def record(self, name, device, start, end):
+        duration = end - start
+        serial = device.device_serial if device is not None else None
+        with self.lock:
+            self.durations.setdefault(name, []).append(duration)
+            if serial is not None:
+                self.device_durations.setdefault((name, serial), []).append(duration)
+            if self.trace:
+                self.events.append({
+                    "name": name,
+                    "cat": serial or "executor",
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.current_thread().name,
+                    "args": {"device": serial} if serial is not None else {},
+                })
+
+    @staticmethod
+    def stats(durations):
+        values = sorted(durations)
+        return {
+            "count": len(values),
+            "total": sum(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": values[-1],
+        }
+
+    def summary(self):
+        with self.lock:
+            phases = {name: self.stats(values) for name, values in self.durations.items()}
+            devices = {}
+            for (name, serial), values in self.device_durations.items():
+                devices.setdefault(serial, {})[name] = self.stats(values)
+        return {"phases": phases, "devices": devices}
+
+    def chrome_trace(self):
+        with self.lock:
+            events = list(self.events)
+        # Chrome wants integer thread ids, keep the names as metadata
+        tids = {}
+        events = [dict(event, tid=tids.setdefault(event["tid"], len(tids) + 1)) for event in events]
+        for name, tid in tids.items():
+            events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path, trace_path=None):
+        """
+        Write the summary (and the trace) of what was recorded since the
+        last reset, print the slowest phases and start over
+        """
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        if self.trace and trace_path is not None:
+            with open(trace_path, 'w', encoding='utf-8') as f:
+                json.dump(self.chrome_trace(), f)
+        self.print_summary(summary)
+        self.reset()
+        return summary
+
+    @staticmethod
+    def print_summary(summary, top=10):
+        phases = sorted(summary["phases"].items(), key=lambda item: item[1]["total"], reverse=True)
+        print("Profile (seconds): phase count total p50 p95 max")
+        for name, stats in phases[:top]:
+            print(f"  {name} {stats['count']} {stats['total']:.3f} {stats['p50']:.3f} {stats['p95']:.3f} {stats['max']:.3f}")
+        for serial, device_phases in sorted(summary["devices"].items()):
+            slowest = max(device_phases.items(), key=lambda item: item[1]["total"])
+            print(f"  {serial}: slowest phase {slowest[0]}, total {slowest[1]['total']:.3f} p95 {slowest[1]['p95']:.3f}")
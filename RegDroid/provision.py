@@ -0,0 +1,75 @@
+import json
+import time
+
+from worker import wait_all
+
+
+class ProvisionError(Exception):
+    pass
+
+
+class Provisioner(object):
+    """
+    Provision the devices together, each on its own worker: the steps of a
+    device (connect, install, logcat...) run in order, a failed step is
+    tried again up to retries times, and a device gets timeout seconds for
+    all its steps. Every round is reported with the latency of each step.
+    """
+
+    def __init__(self, timeout=300, retries=2, report_path=None):
+        self.timeout = timeout if timeout and timeout > 0 else None
+        self.retries = max(0, retries)
+        # provision rounds are appended to this jsonl file
+        self.report_path = report_path
+
+    def provision_device(self, device, steps):
+        record = {"serial": device.device_serial, "ok": True, "steps": {}, "attempts": {}}
+        start_time = time.time()
+        for name, func in steps:
+            for attempt in range(self.retries + 1):
+                step_start = time.time()
+                try:
+                    func()
+                    error = None
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    print(f"Provisioning {device.device_serial}: {name} failed (attempt {attempt + 1}): {error}")
+                record["steps"][name] = round(time.time() - step_start, 3)
+                record["attempts"][name] = attempt + 1
+                if error is None:
+                    break
+            if error is not None:
+                record["ok"] = False
+                record["error"] = f"{name}: {error}"
+                break
+        record["seconds"] = round(time.time() - start_time, 3)
+        return record
+
+    def run(self, devices, steps_of):
+        """
+        Provision devices with the [(name, func)] steps_of(device) gives,
+        returns the records of the round in device order
+        """
+        start_time = time.time()
+        futures = {
+            device.get_worker().submit(self.provision_device, device, steps_of(device)): device
+            for device in devices
+        }
+        records = []
+        for device, record in zip(futures.values(), wait_all(futures, self.timeout)):
+            if record is None:
+                record = {"serial": device.device_serial, "ok": False, "steps": {}, "attempts": {},
+                          "error": "timed out", "seconds": round(time.time() - start_time, 3)}
+            records.append(record)
+        self.report(records, time.time() - start_time)
+        return records
+
+    def report(self, records, seconds):
+        print(f"Provisioned {sum(record['ok'] for record in records)}/{len(records)} devices in {seconds:.2f} seconds")
+        for record in records:
+            steps = ", ".join(f"{name} {value:.2f}s" for name, value in record["steps"].items())
+            status = "ok" if record["ok"] else f"FAILED ({record['error']})"
+            print(f"  {record['serial']}: {record['seconds']:.2f}s {status} [{steps}]")
+        if self.report_path is not None:
+            with open(self.report_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"time": time.time(), "seconds": round(seconds, 3), "devices": records}) + '\n')
@@ -7,9 +7,13 @@ import traceback
 import subprocess
 from threading import Timer
 
+from adb_client import AdbClient
 from device import Device
 from app import App
 from executor import Executor
+from provision import ProvisionError
+from async_executor import AsyncExecutor
+from skew import SkewExecutor
 from utils import Utils
 
 
@@ -46,7 +50,31 @@ class RegDroid(object):
                  emulator_name=None,
                  is_login_app=None,
                  rest_interval=None,
-                 trace_path=None):
+                 trace_path=None,
+                 parser="line",
+                 dedup_max_entries=10000,
+                 dedup_near_threshold=0,
+                 mask_spec=None,
+                 job_timeout=0,
+                 engine="thread",
+                 settle_samples=3,
+                 settle_max_wait=5,
+                 permission_rules=None,
+                 writer_max_pending=256,
+                 writer_max_pending_mb=256,
+                 durability="flush",
+                 profile=False,
+                 profile_trace=False,
+                 max_skew=4,
+                 straggler_factor=3.0,
+                 straggler_patience=5,
+                 compare_mode="online",
+                 drivers=0,
+                 adb_mode="client",
+                 action_mode="selector",
+                 provision_timeout=300,
+                 provision_retries=2,
+                 reinstall=False):
 
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger('RegDroid')
@@ -84,6 +112,32 @@ class RegDroid(object):
         self.is_login_app = is_login_app
         self.rest_interval = rest_interval
         self.trace_path = trace_path
+        self.parser = parser
+        self.dedup_max_entries = dedup_max_entries
+        self.dedup_near_threshold = dedup_near_threshold
+        self.mask_spec = mask_spec
+        self.job_timeout = job_timeout
+        self.engine = engine
+        self.settle_samples = settle_samples
+        self.settle_max_wait = settle_max_wait
+        self.permission_rules = permission_rules
+        self.writer_max_pending = writer_max_pending
+        self.writer_max_pending_mb = writer_max_pending_mb
+        self.durability = durability
+        self.profile = profile
+        self.profile_trace = profile_trace
+        self.max_skew = max_skew
+        self.straggler_factor = straggler_factor
+        self.straggler_patience = straggler_patience
+        self.compare_mode = compare_mode
+        self.drivers = drivers
+        self.adb_mode = adb_mode
+        self.action_mode = action_mode
+        self.provision_timeout = provision_timeout
+        self.provision_retries = provision_retries
+        self.reinstall = reinstall
+        # one client of the adb server shared by the devices
+        self.adb = AdbClient() if adb_mode == "client" else None
 
         if root_path is not None:
             if not os.path.isdir(root_path):
@@ -101,14 +155,22 @@ class RegDroid(object):
                 device_serial=device_serial,
                 is_emulator=is_emulator,
                 device_num=i,
-                rest_interval=rest_interval)
+                rest_interval=rest_interval,
+                adb=self.adb,
+                action_mode=action_mode)
              # 为每个 device 创建对应的 app 对象
             device.app = App(app_path[i], root_path, app_name)
             print(f"Device {i}: Package Name = {device.app.package_name}, Main Activity = {device.app.main_activity}")
             self.devices.append(device)
             i = i+1
 
-        self.executor = Executor(
+        if engine == "async":
+            executor_class = AsyncExecutor
+        elif engine == "skew":
+            executor_class = SkewExecutor
+        else:
+            executor_class = Executor
+        self.executor = executor_class(
             devices=self.devices,
             app=self.app,
             app_path=self.app_path,
@@ -137,7 +199,29 @@ class RegDroid(object):
             is_login_app=self.is_login_app,
             rest_interval=self.rest_interval,
             trace_path=self.trace_path,
-            choice=self.choice)
+            choice=self.choice,
+            parser=self.parser,
+            dedup_max_entries=self.dedup_max_entries,
+            dedup_near_threshold=self.dedup_near_threshold,
+            mask_spec=self.mask_spec,
+            job_timeout=self.job_timeout,
+            settle_samples=self.settle_samples,
+            settle_max_wait=self.settle_max_wait,
+            permission_rules=self.permission_rules,
+            writer_max_pending=self.writer_max_pending,
+            writer_max_pending_mb=self.writer_max_pending_mb,
+            durability=self.durability,
+            profile=self.profile,
+            profile_trace=self.profile_trace,
+            max_skew=self.max_skew,
+            straggler_factor=self.straggler_factor,
+            straggler_patience=self.straggler_patience,
+            compare_mode=self.compare_mode,
+            drivers=self.drivers,
+            action_mode=self.action_mode,
+            provision_timeout=self.provision_timeout,
+            provision_retries=self.provision_retries,
+            reinstall=self.reinstall)
 
     @staticmethod
     def get_instance():
@@ -177,34 +261,18 @@ class RegDroid(object):
             return
 
 
-         # 连接和准备设备
-        for device in self.devices:
-            # 如果需要，可以保留一些设备初始化逻辑
-            device.connect()
-            print(f"Emulator {device.device_serial} is ready")
-
-        print("Regdroid start 1 ")
-
-        # connect device and install app
-        if self.is_login_app != 0: #默认是1
-            # self.devices[0].connect()
-            # self.devices[0].install_app(self.app_path[0])
-            # self.devices[1].connect()
-            # self.devices[1].install_app(self.app_path[1])
-            print("Regdroid start 2 ")
-            for i, device in enumerate(self.devices):
-                # device.connect()
-                device.install_app(self.app_path[i], device.app)  # 使用当前设备的 app 对象
-        else:
-            for device in self.devices:
-                device.restart(self.emulator_path, self.emulator_name)
-                # device.connect()
+        # 连接和准备设备: connect and install the app (is_login_app 默认是1) or restart, on all devices at once
+        try:
+            self.executor.provision_devices(
+                install=self.is_login_app != 0,
+                restart=self.is_login_app == 0)
+        except ProvisionError as e:
+            print(f"Error provisioning the devices: {e}")
+            return
 
         # add some files to the devices
-        resourcelist = os.listdir(self.resource_path)
-        for device in self.devices:
-            device.log_crash(self.root_path+"/" +
-                             device.device_serial+"_logcat.txt")
+        # resourcelist = os.listdir(self.resource_path)
+        # for device in self.devices:
             # for resource in resourcelist:
             #     device.add_file(self.resource_path, resource, "/sdcard")
             # if "anki" in self.app.package_name:
@@ -262,5 +330,8 @@ class RegDroid(object):
         #             self.resize(image_path)
         self.enabled = False
         print(time.time() - self.start_time)
+        self.executor.close()
+        if self.adb is not None:
+            self.adb.close()
         if self.timer and self.timer.isAlive():
             self.timer.cancel()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from mask import DEFAULT_MASK
+from profiler import StepProfiler
+from worker import wait_all
+
+
+class SettleDetector(object):
+    """
+    Wait for the screen of a device to settle instead of sleeping a fixed
+    rest_interval.
+
+    The hierarchy is dumped every poll_interval seconds and fingerprinted with
+    ComparisonMask.dump_key (so a ticking clock in the status bar does not
+    count as a change). The screen is idle once samples fingerprints in a row
+    are equal, or when max_wait seconds have passed.
+
+    With samples = 0 every wait is the old fixed sleep: rest_interval, or
+    max_wait when given.
+    """
+
+    PROGRESS_BAR = 'class="android.widget.ProgressBar"'
+
+    def __init__(self, rest_interval, samples=3, poll_interval=0.1, max_wait=5, mask=None, profiler=None):
+        self.rest_interval = rest_interval
+        self.samples = samples
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.mask = mask if mask is not None else DEFAULT_MASK
+        self.profiler = profiler if profiler is not None else StepProfiler()
+
+    def dump(self, device):
+        return self.look(device)[0]
+
+    def look(self, device):
+        # a dump and its dump_key, both from the driver process when the device has one
+        try:
+            if getattr(device, 'driver', None) is not None:
+                return device.driver.dump()
+            xml = device.use.dump_hierarchy()
+            return xml, self.mask.dump_key(xml)
+        except Exception as e:
+            print(f"Error dumping {device.device_serial} while waiting: {e}")
+            return None, None
+
+    def wait(self, device, max_wait=None):
+        """
+        Wait until the device is idle, returns the last dump (the idle
+        screen), None with fixed sleeps
+        """
+        if not self.samples:
+            time.sleep(self.rest_interval if max_wait is None else max_wait)
+            return None
+        if max_wait is None:
+            max_wait = self.max_wait
+        start_time = time.time()
+        last_key = None
+        stable = 0
+        while True:
+            xml, key = self.look(device)
+            if key is not None and key == last_key:
+                stable += 1
+            else:
+                stable = 1
+            last_key = key
+            if stable >= self.samples or time.time() - start_time >= max_wait:
+                return xml
+            time.sleep(self.poll_interval)
+
+    def wait_all(self, devices, max_wait=None):
+        """
+        Wait until all devices are idle, each on its own worker.
+        Returns {device: last dump}, empty with fixed sleeps.
+        """
+        if not self.samples:
+            time.sleep(self.rest_interval if max_wait is None else max_wait)
+            return {}
+        if threading.current_thread() is not threading.main_thread():
+            # called from a device job: other workers may be waiting on this one
+            return {device: self.profiler.wrap("settle", self.wait, device)(device, max_wait) for device in devices}
+        futures = {
+            device.get_worker().submit(self.profiler.wrap("settle", self.wait, device), device, max_wait): device
+            for device in devices
+        }
+        return dict(zip(devices, wait_all(futures)))
+
+    def wait_loading(self, device, max_wait):
+        """
+        Wait while the device shows a ProgressBar, at most max_wait seconds.
+        Returns the seconds waited, 0 when nothing was loading.
+        """
+        if not self.samples:
+            if device.use(className="android.widget.ProgressBar").count > 0:
+                time.sleep(max_wait)
+                return max_wait
+            return 0
+        start_time = time.time()
+        loading = False
+        while True:
+            xml = self.dump(device)
+            if xml is None or self.PROGRESS_BAR not in xml:
+                break
+            loading = True
+            if time.time() - start_time >= max_wait:
+                break
+            time.sleep(self.poll_interval)
+        return time.time() - start_time if loading else 0
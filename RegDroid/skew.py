@@ -0,0 +1,307 @@
+import copy
+import statistics
+import time
+from collections import deque
+from concurrent.futures import wait as wait_futures
+
+from annotate import event_annotation
+from event import Event
+from executor import Executor
+from tree_diff import diff_states, save_diff
+
+
+class StragglerDetector(object):
+    """
+    Spot devices that are persistently slower than the others.
+
+    The step latencies of the last window events of every device are kept.
+    A device whose median latency is above factor times the median of the
+    other devices, patience events in a row, is a straggler.
+    factor = 0 turns the detector off.
+    """
+
+    def __init__(self, factor=3.0, patience=5, window=20):
+        self.factor = factor
+        self.patience = patience
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.latencies = {}
+        self.strikes = {}
+
+    def forget(self, device):
+        self.latencies.pop(device, None)
+        self.strikes.pop(device, None)
+
+    def record(self, device, latency):
+        """
+        Record the latency of one step, returns True when the device is a straggler
+        """
+        self.latencies.setdefault(device, deque(maxlen=self.window)).append(latency)
+        others = [statistics.median(values) for other, values in self.latencies.items() if other is not device]
+        if not self.factor or not others:
+            return False
+        if statistics.median(self.latencies[device]) > self.factor * statistics.median(others):
+            self.strikes[device] = self.strikes.get(device, 0) + 1
+        else:
+            self.strikes[device] = 0
+        return self.strikes[device] >= self.patience
+
+
+class SkewExecutor(Executor):
+    """
+    Executor where the guest devices may lag the base device by up to
+    max_skew events, instead of every step waiting for the slowest device.
+
+    The base device picks and executes the events. Every guest gets them in
+    order on its DeviceWorker and executes them at its own pace, saving its
+    state under the event count of the event. That state is compared with
+    the base state of the same event count once both exist. The base only
+    waits for a guest with max_skew events still to execute.
+
+    A guest that stays much slower than the others (StragglerDetector) is
+    demoted: it gets no new events until the app is restarted on all
+    devices, so it cannot hold back the rest.
+
+    Steps that act on all devices at once (back to app, restart after an
+    error) first wait for every guest to catch up.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SkewExecutor, self).__init__(*args, **kwargs)
+        self.straggler_detector = StragglerDetector(self.straggler_factor, self.straggler_patience)
+        # {device: deque of (event_count, event, future)} not compared yet
+        self.pending = {}
+        # {event_count: state of the base device}, None when the base failed
+        self.base_states = {}
+
+    def reset_lanes(self):
+        # all devices are at the same point again: demoted guests come back
+        self.pending = {device: deque() for device in self.guest_devices}
+        self.base_states = {}
+        self.straggler_detector.reset()
+        for device in self.guest_devices:
+            if hasattr(device, 'demoted'):
+                delattr(device, 'demoted')
+
+    def set_base_state(self, index, state):
+        # the base state of an event, a failed event of the base stays None
+        if index in self.base_states and self.base_states[index] is None:
+            return
+        self.base_states[index] = state
+
+    def active_guests(self):
+        return [
+            device for device in self.guest_devices
+            if not (hasattr(device, 'has_failed') and device.has_failed)
+            and not (hasattr(device, 'demoted') and device.demoted)
+        ]
+
+    def demote(self, device, reason):
+        print(f"Device {device.device_num} demoted ({reason}), it gets no new events until the next restart")
+        device.demoted = True
+        self.straggler_detector.forget(device)
+
+    def guest_step(self, device, event, event_count):
+        # one event on a guest, run on its worker: (success, state, screenshot, seconds)
+        start_time = time.time()
+        if hasattr(device, 'has_failed') and device.has_failed:
+            return None
+        self.utils.annotate(device, event_annotation(event))
+        success = self.execute_event(device, event, 0)
+        if success:
+            self.save_state(device.device_num, f"{device.path}screen/", event_count, device.f_trace)
+            self.checker.check_crash([device])
+            self.checker.check_keyboard([device])
+        return success, device.state, device.screenshot_path, time.time() - start_time
+
+    def bound_skew(self):
+        # wait until no active guest has max_skew events still to execute
+        for device in self.active_guests():
+            running = [future for index, event, future in self.pending[device] if not future.done()]
+            if len(running) < self.max_skew:
+                continue
+            done, not_done = wait_futures(running[:len(running) - self.max_skew + 1], self.job_timeout)
+            if not_done:
+                self.demote(device, f"more than {self.max_skew} events behind for {self.job_timeout} seconds")
+
+    def collect(self, run_count, block=False):
+        """
+        Compare the guest states whose base state is known, in event order.
+        block: wait for every event given to the guests first.
+        Returns the numbers of the guests that failed an event.
+        """
+        newly_failed = []
+        for device in self.guest_devices:
+            lane = self.pending.get(device)
+            while lane:
+                index, event, future = lane[0]
+                if block and not future.done():
+                    wait_futures([future], self.job_timeout)
+                    if not future.done():
+                        print(f"Device {device.device_num} timed out at event {index}, cancelling its events")
+                        device.get_worker().cancel()
+                        self.demote(device, "timed out")
+                        lane.clear()
+                        break
+                if not future.done() or index not in self.base_states:
+                    break
+                lane.popleft()
+                if self.compare_result(device, index, event, future, run_count) is False:
+                    newly_failed.append(device.device_num)
+        # base states no guest is waiting for
+        oldest = min((lane[0][0] for lane in self.pending.values() if lane), default=None)
+        for index in list(self.base_states):
+            if oldest is None or index < oldest:
+                del self.base_states[index]
+        return newly_failed
+
+    def compare_result(self, device, index, event, future, run_count):
+        # returns False when the guest failed the event
+        try:
+            result = None if future.cancelled() else future.result()
+        except Exception as e:
+            print(f"Error in event {index} of device {device.device_num}: {e}")
+            result = (False, None, None, 0)
+        if result is None:
+            # skipped by a failed device, or cancelled
+            return None
+        if self.base_states[index] is None:
+            # the base failed the event: like the lockstep executor, its guests are not checked
+            return None
+        success, state, screenshot, seconds = result
+        i = device.device_num
+        if not success:
+            device.has_failed = True
+            print(f"Device {i} failed, recording error and skipping its future events")
+            self.utils.print_dividing_line(False, index, i)
+            self.utils.write_event(event, i, device.f_trace)
+            return False
+        self.utils.write_event(event, i, device.f_trace)
+        if self.straggler_detector.record(device, seconds) and not (hasattr(device, 'demoted') and device.demoted):
+            self.demote(device, "persistently slower than the other devices")
+        base_state = self.base_states[index]
+        if not self.same_state(base_state, state, device, index):
+            print(f"Device {i} state is different at event {index}!")
+            self.utils.write_error(i, run_count, device.wrong_event_lists, device.f_wrong, device.wrong_num)
+            device.wrong_num += 1
+            try:
+                save_diff(diff_states(base_state, state), f"{device.path}screen/{index}_{device.device_serial}_diff.json")
+            except Exception as e:
+                print(f"Error saving state diff for device {device.device_serial}: {e}")
+            self.utils.annotate(device, event_annotation(Event(None, "wrong", device, index)), screenshot)
+        return True
+
+    def restart_all(self, run_count, event_count, strategy, failed_device=None):
+        # the lockstep error handling, once every guest has caught up
+        self.collect(run_count, block=True)
+        if failed_device is not None:
+            if self.checkduplicate():
+                return event_count
+            print("write error")
+            self.utils.draw_error_frame()
+            device = self.devices[failed_device]
+            self.utils.write_error(failed_device, run_count, device.error_event_lists, device.f_error, device.error_num)
+            device.error_num += 1
+        else:
+            print("All remaining devices have failed, restarting all devices")
+            for device in self.guest_devices:
+                if hasattr(device, 'has_failed'):
+                    delattr(device, 'has_failed')
+        event_count = self.save_all_state(event_count)
+        event_count = self.clear_and_restart_app(event_count, strategy)
+        self.reset_lanes()
+        return event_count
+
+    def run_events(self, run_count, event_count, strategy, start_time):
+        # the events of one run, the guests following the base device by up to max_skew events
+        base = self.devices[0]
+        self.reset_lanes()
+        while event_count < self.event_num:
+            with self.profiler.span("step"):
+                event_count = self.run_step(run_count, event_count, strategy)
+
+            end_time = time.time()
+            print(f"one run time: {end_time - start_time} seconds")
+
+        # the guests finish the run before its report
+        self.set_base_state(event_count - 1, base.state)
+        self.collect(run_count, block=True)
+        return event_count
+
+    def run_step(self, run_count, event_count, strategy):
+        # one event of the base device (the guests run it on their workers), returns the next event_count
+        base = self.devices[0]
+
+        # the base state of the last event, the one the guests are compared with
+        with self.profiler.span("update_base_state"):
+            self.update_state(0, f"{base.path}screen/", event_count - 1, base.f_trace)
+            self.set_base_state(event_count - 1, base.state)
+
+        with self.profiler.span("collect"):
+            newly_failed = self.collect(run_count)
+        if newly_failed:
+            restarted = event_count
+            event_count = self.restart_all(run_count, event_count, strategy, newly_failed[0])
+            if all(hasattr(device, 'has_failed') and device.has_failed for device in self.guest_devices):
+                event_count = self.restart_all(run_count, event_count, strategy)
+            if event_count != restarted:
+                return event_count
+
+        with self.profiler.span("check_base"):
+            # after every event, also when the screen did not change (last_state is state)
+            if base.last_state is not None:
+                if self.settle.wait_loading(base, self.rest_interval * 5) > 0:
+                    print("wait load")
+                    self.save_state(0, f"{base.path}screen/", event_count - 1, base.f_trace)
+                    self.set_base_state(event_count - 1, base.state)
+                if not self.checker.check_foreground():
+                    print("Not foreground")
+                    self.collect(run_count, block=True)
+                    self.back_to_app(event_count, strategy)
+                    self.checker.check_loading()
+                    event_count = self.save_all_state(event_count)
+                    self.reset_lanes()
+                self.checker.check_crash([base])
+                self.checker.check_keyboard([base])
+
+        with self.profiler.span("choose_event"):
+            event = self.policy.choose_event(base, event_count)
+            self.last_event = event
+            self.utils.annotate(base, event_annotation(event))
+            event.print_event()
+
+        with self.profiler.span("bound_skew"):
+            self.bound_skew()
+
+        for device in self.active_guests():
+            # its own copy: write_event sets the device of the event while the guest runs it
+            guest_event = copy.copy(event)
+            future = device.get_worker().submit(
+                self.profiler.wrap("guest_step", self.guest_step, device), device, guest_event, event_count
+            )
+            self.pending[device].append((event_count, guest_event, future))
+
+        with self.profiler.span("execute_base"):
+            base_start = time.time()
+            with self.profiler.span("execute_event", base):
+                base_success = self.execute_event(base, event, 0)
+        if not base_success:
+            print(f"Base device failed at event {event_count}, action: {event.action}")
+            self.utils.print_dividing_line(False, event_count)
+            # the next step must not take the state after the failure for the base state of this event
+            self.base_states[event_count] = None
+            event_count += 1
+            return event_count
+
+        self.utils.print_dividing_line(True, event_count, base.device_num)
+        self.utils.write_read_event(None, event_count, event, "all device", base.device_num)
+        self.utils.write_event(event, base.device_num, base.f_trace)
+
+        with self.profiler.span("save_base_state"):
+            with self.profiler.span("save_state", base):
+                self.save_state(0, f"{base.path}screen/", event_count, base.f_trace)
+        self.straggler_detector.record(base, time.time() - base_start)
+        event_count += 1
+        return event_count
@@ -76,8 +76,64 @@ def parse_args():
                         help="time to sleep")
     parser.add_argument("-trace_path", action="store", dest="trace_path", required=False, default="../Trace",
                         help="path of traces")
+    parser.add_argument("-parser", action="store", dest="parser", required=False, default="line",
+                        choices=["line", "expat"], help="Hierarchy parser used to build states")
+    parser.add_argument("-dedup_max_entries", action="store", dest="dedup_max_entries", required=False, default=10000, type=int,
+                        help="How many failure states the deduplication store keeps")
+    parser.add_argument("-dedup_near_threshold", action="store", dest="dedup_near_threshold", required=False, default=0, type=float,
+                        help="MinHash similarity above which a failure is a near duplicate, 0 disables it")
+    parser.add_argument("-mask_spec", action="store", dest="mask_spec", required=False, default=None,
+                        help="Json file of attributes, packages, resource-ids ignored by state comparison and the bounds grid")
+    parser.add_argument("-job_timeout", action="store", dest="job_timeout", required=False, default=0, type=float,
+                        help="Seconds a device may spend on one job before it is cancelled, 0 waits forever")
+    parser.add_argument("-engine", action="store", dest="engine", required=False, default="thread",
+                        choices=["thread", "async", "skew"],
+                        help="thread = one worker thread per device, async = device operations as coroutines on one event loop, skew = guests follow the base device up to -max_skew events behind")
+    parser.add_argument("-settle_samples", action="store", dest="settle_samples", required=False, default=3, type=int,
+                        help="Equal hierarchy samples in a row for a screen to count as idle, 0 = fixed rest_interval sleeps")
+    parser.add_argument("-settle_max_wait", action="store", dest="settle_max_wait", required=False, default=5, type=float,
+                        help="Longest wait in seconds for a screen to become idle")
+    parser.add_argument("-permission_rules", action="store", dest="permission_rules", required=False, default=None,
+                        help="Json file of the permission dialog rules")
+    parser.add_argument("-writer_max_pending", action="store", dest="writer_max_pending", required=False, default=256, type=int,
+                        help="Screenshots, dumps and trace lines queued for writing before the test loop waits for the disk")
+    parser.add_argument("-writer_max_pending_mb", action="store", dest="writer_max_pending_mb", required=False, default=256, type=int,
+                        help="Megabytes of screenshots and dumps queued for writing before the test loop waits for the disk")
+    parser.add_argument("-durability", action="store", dest="durability", required=False, default="flush",
+                        choices=["none", "flush", "fsync"],
+                        help="none = traces reach the OS when the writer is flushed, flush = every write, fsync = also fsynced in batches")
+    parser.add_argument("-profile", dest="profile", required=False, action="store_true",
+                        help="time the phases of every step per device and write profile_<run>.json to the output directory")
+    parser.add_argument("-profile_trace", dest="profile_trace", required=False, action="store_true",
+                        help="with -profile, also write a Chrome trace-event file profile_<run>.trace.json")
+    parser.add_argument("-max_skew", action="store", dest="max_skew", required=False, default=4, type=int,
+                        help="with -engine skew, how many events a guest device may lag behind the base device")
+    parser.add_argument("-straggler_factor", action="store", dest="straggler_factor", required=False, default=3.0, type=float,
+                        help="with -engine skew, a guest whose step latency stays above this many times the others' is demoted, 0 = never")
+    parser.add_argument("-straggler_patience", action="store", dest="straggler_patience", required=False, default=5, type=int,
+                        help="with -engine skew, how many slow events in a row make a straggler")
+    parser.add_argument("-compare_mode", action="store", dest="compare_mode", required=False, default="online",
+                        choices=["online", "record"],
+                        help="online = compare states between events, record = only compare fingerprints online and run oracle.py on each run in the background")
+    parser.add_argument("-drivers", action="store", dest="drivers", required=False, default=0, type=int,
+                        help="Driver processes doing the dumps, screenshots and parsing of the devices (dealt round-robin), 0 = all in the control process")
+    parser.add_argument("-adb_mode", action="store", dest="adb_mode", required=False, default="client",
+                        choices=["client", "binary"],
+                        help="client = device commands over the adb server socket with a persistent shell per device, binary = one adb process per command")
+    parser.add_argument("-action_mode", action="store", dest="action_mode", required=False, default="selector",
+                        choices=["selector", "local"],
+                        help="selector = click/longclick/edit find their target with uiautomator2 selectors (5s implicit wait), local = at the coordinates of the target in the captured state, zero-wait selectors otherwise, and the effect checked on the next dump")
+    parser.add_argument("-provision_timeout", action="store", dest="provision_timeout", required=False, default=300, type=int,
+                        help="Seconds a device gets to be provisioned (connect, install, grant, logcat), 0 = no limit")
+    parser.add_argument("-provision_retries", action="store", dest="provision_retries", required=False, default=2, type=int,
+                        help="How many times a failed provisioning step of a device is tried again")
+    parser.add_argument("-reinstall", dest="reinstall", required=False, action="store_true",
+                        help="Always reinstall the APKs instead of clearing the data of an install the install cache verifies")
 
     options = parser.parse_args()
+    if options.engine == "async" and options.drivers > 0:
+        # the coroutines dump and screenshot the devices themselves
+        parser.error("-engine async does not use driver processes, run it with -drivers 0")
     # print options
     return options
 
@@ -165,7 +221,31 @@ def main():
         emulator_name=opts.emulator_name,
         is_login_app=opts.is_login_app,
         rest_interval=opts.rest_interval,
-        trace_path=opts.trace_path
+        trace_path=opts.trace_path,
+        parser=opts.parser,
+        dedup_max_entries=opts.dedup_max_entries,
+        dedup_near_threshold=opts.dedup_near_threshold,
+        mask_spec=opts.mask_spec,
+        job_timeout=opts.job_timeout,
+        engine=opts.engine,
+        settle_samples=opts.settle_samples,
+        settle_max_wait=opts.settle_max_wait,
+        permission_rules=opts.permission_rules,
+        writer_max_pending=opts.writer_max_pending,
+        writer_max_pending_mb=opts.writer_max_pending_mb,
+        durability=opts.durability,
+        profile=opts.profile,
+        profile_trace=opts.profile_trace,
+        max_skew=opts.max_skew,
+        straggler_factor=opts.straggler_factor,
+        straggler_patience=opts.straggler_patience,
+        compare_mode=opts.compare_mode,
+        drivers=opts.drivers,
+        adb_mode=opts.adb_mode,
+        action_mode=opts.action_mode,
+        provision_timeout=opts.provision_timeout,
+        provision_retries=opts.provision_retries,
+        reinstall=opts.reinstall
     )
     start_time = time.time()
     regdroid.start()
@@ -1,5 +1,9 @@
 
+import hashlib
+
 from view import View
+from hierarchy_parser import ExpatParser
+from mask import DEFAULT_MASK
 
 
 class State(object):
@@ -7,55 +11,125 @@ class State(object):
     Record the information of the app's state
     """
 
-    def __init__(self, lines):
-        self.lines = lines
-        self.classname_list = []
-        self.resourceid_list = []
-        self.num_list = []
-        self.all_views = self.get_view()
+    # "line": scan the dump line by line, "expat": single pass with the expat parser
+    PARSERS = ["line", "expat"]
+
+    # the raw dump is not kept: the views hold everything that is compared
+    __slots__ = (
+        'parser', 'mask', 'instance_count', 'selector_index', 'all_views', 'views',
+        'view_hashes', 'lang_hashes', 'views_by_key', 'views_by_resourceid', 'fingerprint',
+    )
+
+    def __init__(self, lines, parser="line", mask=None):
+        self.parser = parser
+        # ComparisonMask applied when the views are hashed
+        self.mask = mask if mask is not None else DEFAULT_MASK
+        # (className, resourceId) -> last instance number handed out
+        self.instance_count = {}
+        self.all_views = self.get_view(lines)
         self.views = []
         for view in self.all_views:
             if view.level == 2:
                 self.views.append(view)
+        self.build_hash_index()
+        self.build_selector_index()
+
+    @property
+    def lines(self):
+        return [view.line for view in self.all_views]
+
+    def build_hash_index(self):
+        # index the level-2 views by hash, and by key / resource-id for the rare slow path
+        self.view_hashes = set()
+        self.lang_hashes = set()
+        self.views_by_key = {}
+        self.views_by_resourceid = {}
+        for view in self.views:
+            if view.key is None:
+                continue
+            self.view_hashes.add(view.hash)
+            self.lang_hashes.add(view.lang_hash)
+            self.views_by_key.setdefault(view.key, []).append(view)
+            self.views_by_resourceid.setdefault(view.resourceId, []).append(view)
+        # canonical digest of the compared views: states with equal fingerprints are same()
+        h = hashlib.blake2b(digest_size=16)
+        for view_hash in sorted({view.hash for view in self.views if self.is_compared(view)}):
+            h.update(view_hash)
+        self.fingerprint = h.hexdigest()
+
+    def is_compared(self, view):
+        return self.mask.compares(view)  # Decrease accuracy
+
+    def compared_view_hashes(self):
+        # hashes of every compared view and its descendants
+        hashes = set()
+        stack = [view for view in self.views if self.is_compared(view)]
+        while stack:
+            view = stack.pop()
+            if view.key is not None:
+                hashes.add(view.hash)
+                stack.extend(view.sons)
+        return hashes
+
+    def build_selector_index(self):
+        # (className, resourceId, instance) -> view, to resolve selectors without asking the device
+        self.selector_index = {}
+        for view in self.all_views:
+            self.selector_index[(view.className, view.resourceId, view.instance)] = view
+
+    def find_view(self, className, resourceId, instance):
+        return self.selector_index.get((className, resourceId, instance))
+
+    def find_views(self, attribute, value, package=None):
+        # views whose attribute (text, description...) is value, in package when given
+        return [
+            view for view in self.all_views
+            if getattr(view, attribute) == value and (package is None or view.package == package)
+        ]
+
+    def find_view_by_line(self, line):
+        for view in self.all_views:
+            if view.line == line:
+                return view
+        return None
 
     def same_but_not_language(self, state):
         for view in self.views:
-            if "com.google.android.inputmethod.latin" not in view.line and "com.android.systemui" not in view.line:  # Decrease accuracy
-                flag = any(view.same_but_not_language(view2) for view2 in state.views)
+            if self.is_compared(view):
+                if view.lang_hash in state.lang_hashes:
+                    continue
+                candidates = state.views_by_resourceid.get(view.resourceId, [])
+                flag = any(view.same_but_not_language(view2) for view2 in candidates)
                 if not flag:
                     return False
         return True
 
     def same(self, state):
         for view in self.views:
-            if "com.google.android.inputmethod.latin" not in view.line and "com.android.systemui" not in view.line:  # Decrease accuracy
-                flag = any(view.same(view2) for view2 in state.views)
+            if self.is_compared(view):
+                if view.hash in state.view_hashes:
+                    continue
+                candidates = state.views_by_key.get(view.key, [])
+                flag = any(view.same(view2) for view2 in candidates)
                 if not flag:
                     return False
         return True
 
     def get_instance(self, view):
-        # get_instance
-        flag = False
-        i = 0
-        while i < len(self.classname_list):
-            if self.classname_list[i] == view.className and self.resourceid_list[i] == view.resourceId:
-                flag = True
-                self.num_list[i] = self.num_list[i]+1
-                view.set_instance(self.num_list[i])
-                break
-            i += 1
-        if flag is False:
-            self.classname_list.append(view.className)
-            self.resourceid_list.append(view.resourceId)
-            self.num_list.append(0)
-            view.set_instance(0)
+        key = (view.className, view.resourceId)
+        instance = self.instance_count.get(key, -1) + 1
+        self.instance_count[key] = instance
+        view.set_instance(instance)
         return view
 
-    def get_view(self):
+    def get_view(self, lines):
+        if self.parser == "expat":
+            return ExpatParser(self).parse(lines)
+        if isinstance(lines, str):
+            lines = lines.splitlines()
         all_views = []
         stack = []
-        for line in self.lines:
+        for line in lines:
             if '<node ' in line and '/>' in line:
                 if not stack:
                     view = View(line, None, [])
@@ -63,6 +137,7 @@ class State(object):
                     view = View(line, stack[-1], [])
                     stack[-1].add_son(view)
                 view = self.get_instance(view)
+                view.compute_hash(self.mask)
                 all_views.append(view)
             elif '<node ' in line:
                 view = View(line, None, []) if not stack else View(line, stack[-1], [])
@@ -72,6 +147,7 @@ class State(object):
                 view = stack[-1]
                 stack.pop()
                 view = self.get_instance(view)
+                view.compute_hash(self.mask)
                 all_views.append(view)
                 if stack:
                     stack[-1].add_son(view)
@@ -0,0 +1,114 @@
+import json
+
+
+# xml attribute name -> View field, compared by update operations
+ATTRIBUTES = (
+    ('index', 'index'),
+    ('text', 'text'),
+    ('resource-id', 'resourceId'),
+    ('class', 'className'),
+    ('package', 'package'),
+    ('content-desc', 'description'),
+    ('checkable', 'checkable'),
+    ('clickable', 'clickable'),
+    ('enabled', 'enabled'),
+    ('focusable', 'focusable'),
+    ('focused', 'focused'),
+    ('scrollable', 'scrollable'),
+    ('long-clickable', 'longClickable'),
+    ('password', 'password'),
+    ('selected', 'selected'),
+    ('visible-to-user', 'visibleToUser'),
+    ('bounds', 'bounds'),
+)
+
+
+def diff_states(base_state, guest_state):
+    """
+    Edit script turning the base device's view tree into the guest's.
+
+    Subtrees with equal hashes are matched and skipped without being walked.
+    The remaining views are paired by (className, resourceId) in document
+    order: a pair whose line differs gives an "update" with the changed
+    attributes, unpaired base views a "delete" and unpaired guest views an
+    "insert" (one operation for the whole subtree).
+    """
+    operations = []
+    diff_views(
+        [view for view in base_state.views if base_state.is_compared(view)],
+        [view for view in guest_state.views if guest_state.is_compared(view)],
+        "",
+        operations,
+    )
+    return operations
+
+
+def diff_views(base_views, guest_views, path, operations):
+    # identical subtrees first
+    guest_by_hash = {}
+    for view in guest_views:
+        guest_by_hash.setdefault(view.hash, []).append(view)
+    base_left = []
+    for view in base_views:
+        same_views = guest_by_hash.get(view.hash)
+        if same_views:
+            same_views.pop()
+        else:
+            base_left.append(view)
+    unmatched = set()
+    for same_views in guest_by_hash.values():
+        unmatched.update(id(view) for view in same_views)
+    guest_left = [view for view in guest_views if id(view) in unmatched]
+
+    # then pair the rest by class and resource-id
+    guest_by_key = {}
+    for view in guest_left:
+        guest_by_key.setdefault((view.className, view.resourceId), []).append(view)
+    for key in guest_by_key:
+        guest_by_key[key].reverse()
+    for view in base_left:
+        candidates = guest_by_key.get((view.className, view.resourceId))
+        if not candidates:
+            operations.append(operation("delete", view_path(path, view), view))
+            continue
+        guest_view = candidates.pop()
+        view_path_ = view_path(path, view)
+        if view.key != guest_view.key:
+            operations.append(update_operation(view_path_, view, guest_view))
+        diff_views(
+            [son for son in view.sons if son.key is not None],
+            [son for son in guest_view.sons if son.key is not None],
+            view_path_,
+            operations,
+        )
+    for candidates in guest_by_key.values():
+        for view in reversed(candidates):
+            operations.append(operation("insert", view_path(path, view), view))
+
+
+def view_path(path, view):
+    return f"{path}/{view.className}[{view.index}]"
+
+
+def operation(op, path, view):
+    return {"op": op, "path": path, "bounds": view.bounds, "line": view.line.strip()}
+
+
+def update_operation(path, base_view, guest_view):
+    attributes = {}
+    for name, field in ATTRIBUTES:
+        base_value = getattr(base_view, field)
+        guest_value = getattr(guest_view, field)
+        if base_value != guest_value:
+            attributes[name] = [base_value, guest_value]
+    return {
+        "op": "update",
+        "path": path,
+        "bounds": guest_view.bounds,
+        "attributes": attributes,
+    }
+
+
+def save_diff(operations, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(operations, f, ensure_ascii=False, indent=1)
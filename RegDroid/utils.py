@@ -1,8 +1,11 @@
 
+import json
 import os
 import re
+import time
 import traceback
 
+from annotate import event_annotation, error_frame_annotation, annotated_path
 from event import Event
 
 
@@ -11,21 +14,28 @@ class Utils(object):
     def __init__(self, devices):
         self.devices = devices
 
+    def append(self, device, f, text):
+        # trace lines go through the device's ArtifactWriter when there is one
+        if device.writer is not None:
+            device.writer.append(f, text)
+        else:
+            f.write(text)
+            f.flush()
+
     def write_error(self, fail_device, run_count, event_list, f_write, num):
         # print("write_error")
         event_count = 0
-        f_write.write("Start::"+str(num+1)+"::run_count::"+str(run_count)+'\n')
+        lines = ["Start::"+str(num+1)+"::run_count::"+str(run_count)+'\n']
         for event in event_list:
             event_count = event_count+1
             if event.view is not None:
-                f_write.write(str(event.event_count)+"::"+event.action+"::device" +
-                              str(event.device.device_num)+"::"+event.text+"::"+event.view.line)
+                lines.append(str(event.event_count)+"::"+event.action+"::device" +
+                             str(event.device.device_num)+"::"+event.text+"::"+event.view.line)
             else:
-                f_write.write(str(event.event_count)+"::"+event.action+"::device" +
-                              str(event.device.device_num)+"::"+event.text+"::None::"+'\n')
-            f_write.flush
-        f_write.write("End::"+'\n'+'\n')
-        f_write.flush()
+                lines.append(str(event.event_count)+"::"+event.action+"::device" +
+                             str(event.device.device_num)+"::"+event.text+"::None::"+'\n')
+        lines.append("End::"+'\n'+'\n')
+        self.append(self.devices[fail_device], f_write, ''.join(lines))
 
     def write_read_event(self, string, event_count, event, device_string, device_count):
         # f_read_trace = self.devices[device_count].f_read_trace
@@ -40,12 +50,13 @@ class Utils(object):
         #                            "::"+device_string+"::"+event.text+"::None::None"+'\n')
         # f_read_trace.flush()
         
-        f_read_trace = self.devices[device_count].f_read_trace
+        device = self.devices[device_count]
+        f_read_trace = device.f_read_trace
         if string is not None:
-            f_read_trace.write(str(event_count)+string)
+            self.append(device, f_read_trace, str(event_count)+string)
         else:
             if event.view is not None:
-                f_read_trace.write(
+                self.append(device, f_read_trace,
                     str(event_count)+"::"+
                     event.action+"::"+
                     device_string+"::"+
@@ -57,38 +68,35 @@ class Utils(object):
                     event.view.bounds+'\n'
                 )
             else:
-                f_read_trace.write(
+                self.append(device, f_read_trace,
                     str(event_count)+"::"+
                     event.action+"::"+
                     device_string+"::"+
                     event.text+"::None::None::None::None::None::None"+'\n'
                 )
-        f_read_trace.flush()
 
     def write_one_device_event(self, event, device_count, f_trace):
         if event.view is not None:
-            f_trace.write(str(event.event_count)+"::"+event.action+"::device"+str(
+            self.append(self.devices[device_count], f_trace, str(event.event_count)+"::"+event.action+"::device"+str(
                 self.devices[device_count].device_num)+"::"+event.text+"::"+event.view.line)
         else:
-            f_trace.write(str(event.event_count)+"::"+event.action+"::device" +
-                          str(self.devices[device_count].device_num)+"::"+event.text+"::None"+'\n')
-        f_trace.flush()
+            self.append(self.devices[device_count], f_trace, str(event.event_count)+"::"+event.action+"::device" +
+                        str(self.devices[device_count].device_num)+"::"+event.text+"::None"+'\n')
         event.set_device(self.devices[device_count])
         self.devices[device_count].error_event_lists.append(event)
         self.devices[device_count].wrong_event_lists.append(event)
 
     def write_event(self, event, device_count, f_trace):
         if event.view is not None:
-            f_trace.write(str(event.event_count)+"::"+event.action+"::device"+str(
+            self.append(self.devices[device_count], f_trace, str(event.event_count)+"::"+event.action+"::device"+str(
                 self.devices[device_count].device_num)+"::"+event.text+"::"+event.view.line)
             # f_trace.write(str(event.event_count)+"::"+event.action+"::device" +
             #               str(self.devices[0].device_num)+"::"+event.text+"::"+event.view.line)
         else:
-            f_trace.write(str(event.event_count)+"::"+event.action+"::device" +
-                          str(self.devices[device_count].device_num)+"::"+event.text+"::None"+'\n')
+            self.append(self.devices[device_count], f_trace, str(event.event_count)+"::"+event.action+"::device" +
+                        str(self.devices[device_count].device_num)+"::"+event.text+"::None"+'\n')
             # f_trace.write(str(event.event_count)+"::"+event.action+"::device" +
             #               str(self.devices[0].device_num)+"::"+event.text+"::None"+'\n')
-        f_trace.flush()
         event.set_device(self.devices[0])
         self.devices[device_count].error_event_lists.append(event)
         self.devices[device_count].wrong_event_lists.append(event)
@@ -97,29 +105,40 @@ class Utils(object):
         self.devices[device_count].error_event_lists.append(new_event)
         self.devices[device_count].wrong_event_lists.append(new_event)
 
-    def start_thread(self):
+    def start_thread(self, timeout=None):
         # 只启动未启动的线程
         for device in self.devices:
             if hasattr(device, 'thread') and device.thread is not None:
                 # 检查线程是否已经启动
-                if not hasattr(device.thread, '_started') or not device.thread._started.is_set():
-                    device.thread.start()
+                if not device.thread.started():
+                    device.thread.start(device.get_worker())
         
-        # 等待所有线程完成
+        # 等待所有线程完成, 超时的设备取消其任务
+        deadline = None if timeout is None else time.time() + timeout
         for device in self.devices:
             if hasattr(device, 'thread') and device.thread is not None:
-                device.thread.join()
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                if not device.thread.join(remaining):
+                    print(f"Device {device.device_serial} timed out, cancelling its jobs")
+                    device.get_worker().cancel()
 
     def create_dir(self, path):
         if not os.path.isdir(path):
             os.makedirs(path)
 
+    def annotate(self, device, annotation, screenshot=None):
+        # annotations are recorded next to the trace and rendered at report time (annotate.py)
+        f_annotations = getattr(device, 'f_annotations', None)
+        if screenshot is None:
+            screenshot = device.screenshot_path
+        if screenshot is None or f_annotations is None:
+            return
+        annotation = dict(annotation, screenshot=screenshot)
+        self.append(device, f_annotations, json.dumps(annotation) + '\n')
+
     def draw_error_frame(self):
         for device in self.devices:
-            import cv2
-            image = cv2.imread(device.screenshot_path)
-            cv2.rectangle(image, (1, 1), (1430, 2550), (0, 0, 255), 20)
-            cv2.imwrite(device.screenshot_path, image)
+            self.annotate(device, error_frame_annotation())
 
     # def draw_event(self, event):
     #     try:
@@ -148,37 +167,9 @@ class Utils(object):
     
     def draw_event(self, event):
         try:
-            import cv2
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            
-            def process_device_image(device):
-                image = cv2.imread(device.screenshot_path)
-                if device.screenshot_path is not None and event.view is not None:
-                    if event.action == "click":
-                        cv2.rectangle(image, (int(event.view.xmin), int(event.view.ymin)), (int(event.view.xmax), int(event.view.ymax)), (0, 0, 255), 5)
-                    elif event.action == "longclick":
-                        cv2.rectangle(image, (int(event.view.xmin), int(event.view.ymin)), (int(event.view.xmax), int(event.view.ymax)), (0, 225, 255), 5)
-                    elif event.action == "edit":
-                        cv2.rectangle(image, (int(event.view.xmin), int(event.view.ymin)), (int(event.view.xmax), int(event.view.ymax)), (225, 0, 255), 5)
-                    else:
-                        cv2.rectangle(image, (int(event.view.xmin), int(event.view.ymin)), (int(event.view.xmax), int(event.view.ymax)), (225, 225, 255), 5)
-                else:
-                    if event.action == "wrong":
-                        cv2.rectangle(image, (0, 0), (1430, 2550), (0, 225, 255), 20)
-                    else:
-                        cv2.putText(image, event.action, (100, 300),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 5, (0, 0, 255), 1, cv2.LINE_AA)
-                cv2.imwrite(device.screenshot_path, image)
-            
-            with ThreadPoolExecutor(max_workers=len(self.devices)) as executor:
-                futures = {executor.submit(process_device_image, device): device for device in self.devices}
-                
-                for future in as_completed(futures):
-                    try:
-                        future.result()
-                    except Exception as e:
-                        print(f"Error processing device {futures[future].device_serial}: {e}")
-        
+            annotation = event_annotation(event)
+            for device in self.devices:
+                self.annotate(device, annotation)
         except Exception:
             traceback.print_exc()
 
@@ -258,10 +249,14 @@ class Utils(object):
             line_content = "      <li>"
             line_content += "<div class=\"device-images\">"
             for img_file in device_imgs:
+                # the annotated copy when the annotations were rendered
+                screen_dir = "screen"
+                if os.path.exists(annotated_path(os.path.join(path, "screen", img_file))):
+                    screen_dir = "screen_annotated"
                 if path == html_path:
-                    line_content += f"<img src=\"screen/{img_file}\" class=\"img\">"
+                    line_content += f"<img src=\"{screen_dir}/{img_file}\" class=\"img\">"
                 else:
-                    line_content += f"<img src=\"{run_count}/screen/{img_file}\" class=\"img\">"
+                    line_content += f"<img src=\"{run_count}/{screen_dir}/{img_file}\" class=\"img\">"
             line_content += "</div>"
             
             # 尝试找到对应的动作描述
@@ -1,13 +1,78 @@
+import hashlib
+import weakref
+from sys import intern
+
 
 class View(object):
 
-    def __init__(self, line, father, sons):
+    # views are created for every node of every dump, so keep them compact:
+    # no per-instance __dict__, interned attribute strings (shared between the
+    # states of a stable screen) and only a weak reference to the father, so an
+    # Event holding a view does not keep the whole screen alive
+    __slots__ = (
+        'level', '_father', 'line', 'key', 'sons', 'instance', 'hash', 'lang_hash',
+        'index', 'text', 'resourceId', 'className', 'package', 'description',
+        'checkable', 'clickable', 'enabled', 'focusable', 'focused', 'scrollable',
+        'longClickable', 'password', 'selected', 'visibleToUser', 'bounds',
+        'xmin', 'ymin', 'xmax', 'ymax', 'x', 'y', '__weakref__',
+    )
+
+    def __init__(self, line, father, sons, attributes=None):
         self.level = line.find('<node ')
         self.father = father
-        self.line = line
+        self.line = intern(line)
         self.sons = sons
         self.instance = -1
-        self.extract_attributes()
+        # comparison key and structural hashes, filled by compute_hash() once the sons are known
+        self.key = line
+        self.hash = None
+        self.lang_hash = None
+        if attributes is None:
+            self.extract_attributes()
+        else:
+            self.set_attributes(attributes)
+
+    @property
+    def father(self):
+        return self._father() if self._father is not None else None
+
+    @father.setter
+    def father(self, father):
+        self._father = weakref.ref(father) if father is not None else None
+
+    # pickling (driver processes send whole states): the weak reference is
+    # sent as the father itself and made weak again on arrival
+    PICKLED = tuple(name for name in __slots__ if name not in ('_father', '__weakref__'))
+
+    def __getstate__(self):
+        return (self.father,) + tuple(getattr(self, name, None) for name in self.PICKLED)
+
+    def __setstate__(self, state):
+        self.father = state[0]
+        for name, value in zip(self.PICKLED, state[1:]):
+            setattr(self, name, value)
+
+    def set_attributes(self, attributes):
+        # attributes already parsed by a hierarchy parser (see hierarchy_parser.py)
+        get = attributes.get
+        self.index = intern(get('index', ''))
+        self.text = intern(get('text', ''))
+        self.resourceId = intern(get('resource-id', ''))
+        self.className = intern(get('class', ''))
+        self.package = intern(get('package', ''))
+        self.description = intern(get('content-desc', ''))
+        self.checkable = intern(get('checkable', ''))
+        self.clickable = intern(get('clickable', ''))
+        self.enabled = intern(get('enabled', ''))
+        self.focusable = intern(get('focusable', ''))
+        self.focused = intern(get('focused', ''))
+        self.scrollable = intern(get('scrollable', ''))
+        self.longClickable = intern(get('long-clickable', ''))
+        self.password = intern(get('password', ''))
+        self.selected = intern(get('selected', ''))
+        self.visibleToUser = intern(get('visible-to-user', ''))
+        self.bounds = intern(get('bounds', ''))
+        self.get_bounds_value()
 
     def extract_attributes(self):
         self.index = self.get_attribute('index=')
@@ -34,23 +99,18 @@ class View(object):
         attributenum = line.find(keywords)
         line = line[attributenum+len(keywords)+1:-1]
         marksnum = line.find('\"')
-        return line[:marksnum]
+        return intern(line[:marksnum])
 
     def set_instance(self, instance):
         self.instance = instance
 
     def get_bounds_value(self):
-        num1 = self.bounds.find(",")
-        self.xmin = self.bounds[1:num1]
-        num2 = self.bounds.find("]")
-        self.ymin = self.bounds[num1+1:num2]
-
-        line = self.bounds[num2+1:]
-
-        num1 = line.find(",")
-        self.xmax = line[1:num1]
-        num2 = line.find("]")
-        self.ymax = line[num1+1:num2]
+        # "[xmin,ymin][xmax,ymax]"
+        xmin, ymin, xmax, ymax = self.bounds[1:-1].replace('][', ',').split(',')
+        self.xmin = intern(xmin)
+        self.ymin = intern(ymin)
+        self.xmax = intern(xmax)
+        self.ymax = intern(ymax)
 
         self.x = (int(self.xmin) + int(self.xmax)) / 2
         self.y = (int(self.ymin) + int(self.ymax)) / 2
@@ -58,24 +118,62 @@ class View(object):
     def add_son(self, son):
         self.sons.append(son)
 
+    def compute_hash(self, mask):
+        """
+        Bottom-up (Merkle) hash of the comparison key (the line, normalized by
+        the ComparisonMask) and the set of the compared sons' hashes.
+        The sons must already be hashed. Two views with equal hashes are same().
+        The subtree is complete once hashed, so sons is frozen into a tuple.
+        """
+        self.sons = tuple(self.sons)
+        self.key = mask.view_key(self)
+        if self.key is None:
+            return
+        h = hashlib.blake2b(self.key.encode('utf-8'), digest_size=16)
+        h.update(b'\0')
+        for son_hash in sorted({son.hash for son in self.sons if son.key is not None}):
+            h.update(son_hash)
+        self.hash = h.digest()
+
+        h = hashlib.blake2b(self.resourceId.encode('utf-8'), digest_size=16)
+        h.update(b'\0')
+        for son_hash in sorted({son.lang_hash for son in self.sons if son.key is not None}):
+            h.update(son_hash)
+        self.lang_hash = h.digest()
+
     def print_tree(self):
         print(f"level_{str(self.level)}:{self.line}")
         for son in self.sons:
             son.print_tree()
 
     def same(self, view):
-        if self.line != view.line:
+        if self.hash is not None and self.hash == view.hash:
+            return True
+        if self.key != view.key:
             return False
+        # every compared son of mine needs a match among his sons; equal hashes match at once
+        his_hashes = {hisson.hash for hisson in view.sons}
         for myson in self.sons:
+            if myson.key is None:
+                continue
+            if myson.hash is not None and myson.hash in his_hashes:
+                continue
             flag = any(myson.same(hisson) for hisson in view.sons)
             if not flag:
                 return False
         return True
 
     def same_but_not_language(self, view):
+        if self.lang_hash is not None and self.lang_hash == view.lang_hash:
+            return True
         if self.resourceId != view.resourceId:
             return False
+        his_hashes = {hisson.lang_hash for hisson in view.sons}
         for myson in self.sons:
+            if myson.key is None:
+                continue
+            if myson.lang_hash is not None and myson.lang_hash in his_hashes:
+                continue
             flag = any(myson.same_but_not_language(hisson) for hisson in view.sons)
             if not flag:
                 return False
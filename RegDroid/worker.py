@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, CancelledError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+class DeviceWorker(object):
+    """
+    One long-lived thread per device running the jobs submitted to it in
+    order, instead of a new thread or thread pool for every step.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # the thread left behind by cancel(), still running a hung job
+        self.abandoned = None
+        self.start()
+
+    def start(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, args=(self.queue, self.abandoned), name=self.name, daemon=True
+        )
+        self.thread.start()
+
+    def hung(self):
+        # whether a cancelled job is still running on the device
+        return self.abandoned is not None and self.abandoned.is_alive()
+
+    def run(self, jobs, abandoned=None):
+        if abandoned is not None:
+            # one thread drives the device at a time: the new jobs wait for the hung one
+            abandoned.join()
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            future, func, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as ex:
+                future.set_exception(ex)
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        if threading.current_thread() is self.thread:
+            # a job submitting to its own worker would wait for itself
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as ex:
+                future.set_exception(ex)
+            return future
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def cancel(self):
+        """
+        Cancel the pending jobs and leave a hung job behind: the device gets a
+        fresh thread, the old one exits once its job returns. The fresh
+        thread only starts running jobs then, so two threads never drive
+        the same uiautomator2 session.
+        """
+        jobs = self.queue
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job[0].cancel()
+        jobs.put(None)
+        self.abandoned = self.thread
+        self.start()
+
+    def stop(self):
+        self.queue.put(None)
+
+
+class DeviceJob(object):
+    """
+    A call run on a device's worker, with the start / join / get_result
+    interface Device.thread always had
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.future = None
+
+    def start(self, worker):
+        self.future = worker.submit(self.func, *self.args)
+
+    def started(self):
+        return self.future is not None
+
+    def set_result(self, result):
+        # the job was run elsewhere (see AsyncExecutor)
+        self.future = Future()
+        self.future.set_result(result)
+
+    def join(self, timeout=None):
+        """
+        Wait for the job, at most timeout seconds. Returns False when it timed out.
+        """
+        try:
+            self.future.result(timeout)
+        except FutureTimeoutError:
+            return False
+        except CancelledError:
+            pass
+        except Exception as ex:
+            print(ex)
+        return True
+
+    def get_result(self):
+        try:
+            return self.future.result(0)
+        except (Exception, CancelledError):
+            return None
+
+
+def wait_all(futures, timeout=None):
+    """
+    Wait for the jobs of {future: device}, together at most timeout seconds.
+    A device whose job is still running at the deadline gets its worker
+    cancelled. Returns the results in order, None for failed jobs.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for future, device in futures.items():
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        try:
+            results.append(future.result(remaining))
+        except FutureTimeoutError:
+            print(f"Job of device {device.device_serial} timed out, cancelling it")
+            device.get_worker().cancel()
+            results.append(None)
+        except (Exception, CancelledError) as e:
+            print(f"Error in job of device {device.device_serial}: {e}")
+            results.append(None)
+    return results
@@ -0,0 +1,194 @@
+import os
+import queue
+import threading
+import time
+import traceback
+
+
+class ArtifactWriter(object):
+    """
+    Write screenshots, hierarchy dumps and trace lines on a background
+    thread, so the control loop never waits for the disk.
+
+    The queue holds at most max_pending writes and max_pending_bytes of
+    images and text: when the disk falls behind, the producer blocks
+    (backpressure) instead of piling up screenshots in memory (a decoded
+    1440x2560 screenshot is 11 MB). One thread does all the writing, so
+    writes to the same file happen in the order they were submitted.
+
+    durability:
+        none: trace files are flushed only by flush() and drain()
+        flush: every write is handed to the OS right away (the old behaviour)
+        fsync: like flush, and the files written are fsynced in batches,
+            every sync_batch writes or sync_interval seconds, and on drain()
+    """
+
+    DURABILITY = ("none", "flush", "fsync")
+
+    def __init__(self, max_pending=256, max_pending_bytes=256 * 1024 * 1024, durability="flush",
+                 sync_interval=1.0, sync_batch=64):
+        if durability not in self.DURABILITY:
+            raise ValueError(f"Unknown durability {durability}")
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
+        self.queue = queue.Queue(maxsize=max_pending)
+        # bytes held by the queued writes, a write bigger than the bound still goes alone
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.pending_condition = threading.Condition()
+        # paths and handles written since the last fsync
+        self.unsynced_paths = set()
+        self.unsynced_files = {}
+        self.last_sync = time.time()
+        # how often a producer had to wait for a full queue
+        self.stalls = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="artifact-writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=self.sync_interval)
+            except queue.Empty:
+                self.sync()
+                continue
+            try:
+                if job is None:
+                    self.flush_files()
+                    self.sync()
+                    return
+                func, args, size = job
+                try:
+                    func(*args)
+                finally:
+                    self.release(size)
+                if self.durability == "fsync" and (
+                    len(self.unsynced_paths) + len(self.unsynced_files) >= self.sync_batch
+                    or time.time() - self.last_sync >= self.sync_interval
+                ):
+                    self.sync()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args, size=0):
+        # size: the bytes the write holds until it is done
+        if self.closed:
+            # after drain() the writes are done by the caller
+            func(*args)
+            self.flush_files()
+            return
+        with self.pending_condition:
+            if self.pending_bytes and self.pending_bytes + size > self.max_pending_bytes:
+                self.stalls += 1
+                self.pending_condition.wait_for(
+                    lambda: not self.pending_bytes or self.pending_bytes + size <= self.max_pending_bytes
+                )
+            self.pending_bytes += size
+        try:
+            self.queue.put_nowait((func, args, size))
+        except queue.Full:
+            self.stalls += 1
+            self.queue.put((func, args, size))
+
+    def release(self, size):
+        if not size:
+            return
+        with self.pending_condition:
+            self.pending_bytes -= size
+            self.pending_condition.notify_all()
+
+    def write_text(self, path, text):
+        self.submit(self.save_text, path, text, size=len(text))
+
+    def write_image(self, path, image):
+        self.submit(self.save_image, path, image, size=getattr(image, 'nbytes', 0))
+
+    def append(self, f, text):
+        # a line (or lines) of an open trace file
+        self.submit(self.append_file, f, text, size=len(text))
+
+    def save_text(self, path, text):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        self.written(path)
+
+    def save_image(self, path, image):
+        import cv2
+        cv2.imwrite(path, image)
+        self.written(path)
+
+    def append_file(self, f, text):
+        f.write(text)
+        if self.durability != "none":
+            f.flush()
+        if self.durability != "flush":
+            self.unsynced_files[id(f)] = f
+
+    def written(self, path):
+        if self.durability == "fsync":
+            self.unsynced_paths.add(path)
+
+    def flush_files(self):
+        for f in self.unsynced_files.values():
+            if not f.closed:
+                f.flush()
+        if self.durability == "none":
+            self.unsynced_files.clear()
+
+    def sync(self):
+        if self.durability != "fsync":
+            return
+        for f in self.unsynced_files.values():
+            if not f.closed:
+                f.flush()
+                os.fsync(f.fileno())
+        for path in self.unsynced_paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced_files.clear()
+        self.unsynced_paths.clear()
+        self.last_sync = time.time()
+
+    def flush(self):
+        # wait until everything submitted so far is written
+        if self.closed:
+            return
+        self.queue.join()
+        self.submit(self.flush_files)
+        self.queue.join()
+
+    def drain(self):
+        """
+        Write everything still queued, sync it and stop the thread.
+        Later writes are done synchronously by the caller.
+        """
+        if self.closed:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.closed = True
+        # writes submitted while the thread was stopping
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                func, args, size = job
+                func(*args)
+                self.release(size)
+        if self.stalls:
+            print(f"Artifact writer: producers waited for a full queue {self.stalls} times")
+
+    def close(self):
+        self.drain()